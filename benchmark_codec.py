@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+'''
+Benchmark of the CreatePositiveResponse path of modbus_server.py.
+
+Compares the shared codecs encoding into a pooled output buffer against
+building new response objects with struct.pack and bytes concatenation, in
+time and in the peak of memory allocated per request.
+
+Input:
+    * Data protocol: tcp = Modbus TCP, rtu = Modbus RTU.
+    * Iterations: How many requests are encoded (optional).
+    Example: ./benchmark_codec.py rtu 100000
+
+Output:
+    Time and peak allocated bytes per request.
+'''
+
+import os
+import sys
+import struct
+import timeit
+import tracemalloc
+
+from modbus_server import CreateServer
+from modbus_crc import CalculateCRC
+
+# The response objects modbus_server.py created per request before the shared codecs.
+class PackedRtuResponse():
+    def __init__(self, slaveAddress, function):
+        self.slaveAddress = slaveAddress
+        self.function = function
+
+    def CreatePositiveResponse(self, data):
+        response = struct.pack("BBB", self.slaveAddress, self.function, len(data))
+        response += data
+        crc = CalculateCRC(response)
+        response += struct.pack("H", crc)
+        return response
+
+class PackedTcpResponse():
+    def __init__(self, slaveAddress, function, tid, pid):
+        self.slaveAddress = slaveAddress
+        self.function = function
+        self.tid = tid
+        self.pid = pid
+
+    def CreatePositiveResponse(self, data):
+        response = struct.pack(">HHHBBB", self.tid, self.pid, 3 + len(data), self.slaveAddress, self.function, len(data))
+        response += data
+        return response
+
+# Encode a response the way it was done before the shared codecs.
+def PackedResponse(dataProtocol, request, data):
+    if dataProtocol == "tcp":
+        response = PackedTcpResponse(request.slaveAddress, request.function, request.tid, request.pid)
+    else:
+        response = PackedRtuResponse(request.slaveAddress, request.function)
+    return response.CreatePositiveResponse(data)
+
+# Encode a response with the shared codec into the output buffer of a connection.
+def PooledResponse(server, output, request, data):
+    return server.response.CreatePositiveResponse(request, data, output)
+
+# Get the peak of memory allocated during one call of a function, in bytes.
+def PeakBytesPerCall(function, calls=1000):
+    function()
+    tracemalloc.start()
+    peak = 0
+    for i in range(calls):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+    return peak
+
+# Print the time and allocations per request of a benchmark.
+def Report(name, function, iterations):
+    seconds = timeit.timeit(function, number=iterations)
+    print("%-8s %10.3f us/request %8d peak bytes/request"%(name, seconds * 1e6 / iterations, PeakBytesPerCall(function)))
+
+def Main(args):
+    if len(args) < 2 or (args[1] != "tcp" and args[1] != "rtu"):
+        print("Usage: %s <data protocol: tcp = Modbus TCP, rtu = Modbus rtu> [iterations]"%(os.path.basename(args[0])))
+        sys.exit()
+
+    dataProtocol = args[1]
+    iterations = 100000
+    if len(args) > 2 and args[2].isdigit():
+        iterations = int(args[2])
+
+    server = CreateServer(dataProtocol)
+    output = server.buffers.Acquire()
+
+    # A read of 10 registers.
+    if dataProtocol == "tcp":
+        frame = bytes.fromhex("00010000000601030000000A")
+    else:
+        frame = bytes.fromhex("01030000000A")
+        crc = CalculateCRC(frame)
+        frame += bytes([crc & 0xFF, crc >> 8])
+
+    request = server.ParseRequest(frame)
+    data = server.units.Bank(1, 0x03).Read(0, 10)
+
+    Report("Packed", lambda: PackedResponse(dataProtocol, request, data), iterations)
+    Report("Pooled", lambda: PooledResponse(server, output, request, data), iterations)
+
+if __name__ == "__main__":
+    Main(sys.argv)
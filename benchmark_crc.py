@@ -0,0 +1,92 @@
+#!/usr/bin/python3
+
+'''
+Micro-benchmark of the table driven CRC against the bit-by-bit CRC loop.
+
+Input:
+    * Iterations: How many times each frame set is checked (optional).
+    Example: ./benchmark_crc.py 2000
+
+Output:
+    Time per frame for the bit loop, the table and the batch verification.
+    The batch verification is also timed against VerifyFrame for a capture
+    of mixed lengths, and for many frames of one length.
+'''
+
+import os
+import sys
+import random
+import timeit
+
+from modbus_crc import CalculateCRC, VerifyFrame, VerifyFrames
+
+# The CRC loop modbus_server.py used before the table.
+def BitLoopCRC(data):
+    crc = 0xFFFF
+    for pos in data:
+        crc ^= pos
+        for i in range(8):
+            if ((crc & 1) != 0):
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+    return crc
+
+# Create a RTU frame with a correct CRC.
+def CreateFrame(data):
+    crc = CalculateCRC(data)
+    return data + bytes([crc & 0xFF, crc >> 8])
+
+# Print the time per frame of a benchmark.
+def Report(name, seconds, frames):
+    print("%-32s %10.3f us/frame"%(name, seconds * 1e6 / frames))
+
+if __name__ == "__main__":
+    iterations = 1000
+    if len(sys.argv) > 1:
+        if sys.argv[1].isdigit() == False:
+            print("Usage: %s [iterations]"%(os.path.basename(sys.argv[0])))
+            sys.exit()
+        iterations = int(sys.argv[1])
+
+    # A read request and a read response of 125 registers.
+    request = CreateFrame(bytes.fromhex("01030000000A"))
+    response = CreateFrame(bytes([0x01, 0x03, 250]) + bytes(range(250)))
+    frames = [request, response] * 50
+
+    # Make sure both CRC's agree before timing them.
+    for frame in frames:
+        if BitLoopCRC(frame[:-2]) != CalculateCRC(frame[:-2]):
+            print("Error: CRC mismatch.")
+            sys.exit()
+
+    total = iterations * len(frames)
+
+    seconds = timeit.timeit(lambda: [BitLoopCRC(frame[:-2]) for frame in frames], number=iterations)
+    Report("Bit loop", seconds, total)
+
+    seconds = timeit.timeit(lambda: [CalculateCRC(frame[:-2]) for frame in frames], number=iterations)
+    Report("Table", seconds, total)
+
+    seconds = timeit.timeit(lambda: [VerifyFrame(frame) for frame in frames], number=iterations)
+    Report("VerifyFrame", seconds, total)
+
+    seconds = timeit.timeit(lambda: VerifyFrames(frames), number=iterations)
+    Report("VerifyFrames (batch)", seconds, total)
+
+    # Requests and responses of a capture, and many polls of the same registers.
+    random.seed(1)
+    sets = (
+        ("mixed lengths", [CreateFrame(bytes(random.randrange(256) for i in range(random.randint(6, 253)))) for i in range(2000)]),
+        ("one length", [CreateFrame(bytes([0x01, 0x03, 20]) + bytes(random.randrange(256) for i in range(20))) for i in range(2000)]),
+    )
+    for name, frameSet in sets:
+        if VerifyFrames(frameSet) != [VerifyFrame(frame) for frame in frameSet]:
+            print("Error: VerifyFrames and VerifyFrame disagree.")
+            sys.exit()
+        number = max(1, iterations // 100)
+        seconds = timeit.timeit(lambda: [VerifyFrame(frame) for frame in frameSet], number=number)
+        Report("VerifyFrame, " + name, seconds, number * len(frameSet))
+        seconds = timeit.timeit(lambda: VerifyFrames(frameSet), number=number)
+        Report("VerifyFrames, " + name, seconds, number * len(frameSet))
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+'''
+Benchmark of the bulk block decoder against unpacking one value at a time.
+
+Input:
+    * Values: The amount of values in a block (optional).
+    * Blocks: The amount of blocks decoded (optional).
+    Example: ./benchmark_decode.py 100 1000
+
+Output:
+    Time per value for each way of decoding.
+'''
+
+import os
+import sys
+import time
+import random
+import struct
+
+from modbus_decode import BlockDecoder
+from modbus_optional import OptionalModule
+from modbus_datatypes import DataTypeRegisterCount
+
+# Decode one value the way ModbusTcpResponse.py does, with an if/elif chain and struct.unpack.
+def ValueFromDataType(dataType, data):
+    if dataType == '?':
+        return data[0] > 0x00 or data[1] > 0x00
+    elif dataType == 'b':
+        return struct.unpack('>b', data[1:2])[0]
+    elif dataType == 'B':
+        return struct.unpack('>B', data[1:2])[0]
+    elif dataType == 'h':
+        return struct.unpack('>h', data)[0]
+    elif dataType == 'H':
+        return struct.unpack('>H', data)[0]
+    elif dataType == 'i':
+        return struct.unpack('>i', data)[0]
+    elif dataType == 'I':
+        return struct.unpack('>I', data)[0]
+    elif dataType == 'q':
+        return struct.unpack('>q', data)[0]
+    elif dataType == 'Q':
+        return struct.unpack('>Q', data)[0]
+    elif dataType == 'f':
+        return struct.unpack('>f', data)[0]
+    elif dataType == 'd':
+        return struct.unpack('>d', data)[0]
+
+# Decode a block one value at a time.
+def DecodePerValue(schema, payload):
+    return [ValueFromDataType(dataType, payload[2 * offset:2 * (offset + DataTypeRegisterCount(dataType))]) for offset, dataType in schema]
+
+# Create a schema of random data types, packed one after the other.
+def CreateSchema(values):
+    schema = []
+    offset = 0
+    for i in range(values):
+        dataType = random.choice(["?", "b", "B", "h", "H", "i", "I", "q", "Q", "f", "d"])
+        schema.append((offset, dataType))
+        offset += DataTypeRegisterCount(dataType)
+    return schema, offset
+
+# Print the time per value of a benchmark.
+def Report(name, seconds, values):
+    print("%-24s %10.3f us/value"%(name, seconds * 1e6 / values))
+
+if __name__ == "__main__":
+    values = 100
+    blocks = 1000
+    if len(sys.argv) > 2:
+        if sys.argv[1].isdigit() == False or sys.argv[2].isdigit() == False:
+            print("Usage: %s [values] [blocks]"%(os.path.basename(sys.argv[0])))
+            sys.exit()
+        values = int(sys.argv[1])
+        blocks = int(sys.argv[2])
+
+    random.seed(1)
+    schema, registers = CreateSchema(values)
+    payloads = [bytes(random.getrandbits(8) for i in range(2 * registers)) for j in range(blocks)]
+    decoder = BlockDecoder(schema)
+
+    # Make sure the decoders agree before timing them, NaN is not equal to itself.
+    expected = [repr(value) for value in DecodePerValue(schema, payloads[0])]
+    if [repr(value) for value in decoder.Decode(payloads[0])] != expected:
+        print("Error: Decoded values differ.")
+        sys.exit()
+
+    total = values * blocks
+
+    start = time.perf_counter()
+    for payload in payloads:
+        DecodePerValue(schema, payload)
+    Report("Per value", time.perf_counter() - start, total)
+
+    start = time.perf_counter()
+    for payload in payloads:
+        decoder.Decode(payload)
+    Report("Block", time.perf_counter() - start, total)
+
+    start = time.perf_counter()
+    decoder.DecodeColumns(payloads)
+    Report("Columns (NumPy)" if OptionalModule("numpy") is not None else "Columns", time.perf_counter() - start, total)
@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+
+'''
+Benchmark of the polling scheduler against a running Modbus TCP server.
+
+Polls three scan groups of holding register tags, at 10 ms, 100 ms and 1 s,
+and reports the tags decoded per second with the overruns, skipped scans and the scan
+lateness of each group. Start the server first, for example:
+    ./modbus_server.py 127.0.0.1 5020 tcp tcp --server=async
+
+Input:
+    * IP: The IP address of the server.
+    * Port: The port of the server.
+    * Tags: The amount of tags in each group (optional).
+    * Seconds: How long to poll (optional).
+    Example: ./benchmark_scheduler.py 127.0.0.1 5020 2000 5
+
+Output:
+    Tags per second and the statistics of each group.
+'''
+
+import os
+import sys
+import time
+import asyncio
+
+from modbus_client import ClientPool
+from modbus_scheduler import PollScheduler
+
+DATA_TYPES = ["H", "h", "i", "f"]
+
+# Create tags of 1 or 2 registers each, packed one after the other.
+def CreateTags(count):
+    tags = []
+    register = 0
+    for i in range(count):
+        dataType = DATA_TYPES[i % len(DATA_TYPES)]
+        tags.append((1, 0x03, register % 0xFF00, dataType))
+        register += 1 if dataType in ("H", "h") else 2
+    return tags
+
+async def Benchmark(ip, port, count, seconds):
+    pool = ClientPool(connections=2, maxInFlight=32)
+    scheduler = PollScheduler(pool, maxOutstanding=32)
+    decoded = [0]
+
+    def OnValues(group, values):
+        decoded[0] += len(values)
+
+    tags = CreateTags(count)
+    for name, interval in (("10 ms", 0.01), ("100 ms", 0.1), ("1 s", 1.0)):
+        scheduler.AddGroup(name, interval, ip, port, tags, OnValues)
+
+    start = time.perf_counter()
+    await scheduler.Run(seconds)
+    elapsed = time.perf_counter() - start
+    await pool.Close()
+
+    print("%.0f tags/s"%(decoded[0] / elapsed))
+    for stats in scheduler.Stats():
+        print("%-8s scans=%-6d overruns=%-6d skipped=%-6d errors=%-4d lateness p50=%.3f ms p99=%.3f ms max=%.3f ms"%(
+            stats["group"], stats["scans"], stats["overruns"], stats["skipped"], stats["errors"],
+            1e3 * stats.get("lateness_p50", 0), 1e3 * stats.get("lateness_p99", 0), 1e3 * stats.get("lateness_max", 0)))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[2].isdigit() == False:
+        print("Usage: %s <IP> <port> [tags] [seconds]"%(os.path.basename(sys.argv[0])))
+        sys.exit()
+    count = int(sys.argv[3]) if len(sys.argv) > 3 and sys.argv[3].isdigit() else 2000
+    seconds = float(sys.argv[4]) if len(sys.argv) > 4 else 5.0
+    asyncio.run(Benchmark(sys.argv[1], int(sys.argv[2]), count, seconds))
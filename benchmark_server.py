@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+
+'''
+Load and latency benchmark of modbus_server.py.
+
+Starts the server locally for every transport and data protocol combination,
+udp/tcp x tcp/rtu, and drives it with concurrent clients. Each client sends a
+request, waits for the response and sends the next. The requests are a mix
+of valid reads, reads of invalid addresses and requests with a bad CRC. Modbus
+TCP has no CRC, so there the bad CRC share is sent to a unit that is not
+hosted instead.
+
+Usage: ./benchmark_server.py [options]
+Options:
+    --requests=<N>          Requests per combination (default 20000)
+    --concurrency=<N>       Concurrent clients (default 8)
+    --mix=<V,A,C>           Percent valid reads, invalid addresses, bad CRCs (default 90,5,5)
+    --server=<sync | async> Server of modbus_server.py (default async)
+    --workers=<N>           Worker processes of the server (default 1)
+    --combinations=<list>   Such as udp/tcp,tcp/rtu (default all four)
+    --output=<path>         Write the results as JSON
+    --baseline=<path>       Compare with the JSON results of an earlier run
+    Example: ./benchmark_server.py --requests=50000 --output=results.json
+
+Output:
+    Requests per second, p50/p99/p999 latency and server CPU time per request
+    of each combination.
+
+Results format (JSON):
+    {"options": {...}, "python": "3.11.7", "platform": "...", "time": "...",
+     "results": [{"combination": "tcp/rtu", "requests": N, "errors": N,
+                  "seconds": s, "rps": r, "p50_us": u, "p99_us": u, "p999_us": u,
+                  "server_cpu_us": u, "client_cpu_us": u}, ...]}
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import struct
+import random
+import asyncio
+import platform
+import subprocess
+
+from modbus_crc import CalculateCRC
+from modbus_options import ParseOptions
+
+COMBINATIONS = ["udp/tcp", "udp/rtu", "tcp/tcp", "tcp/rtu"]
+TIMEOUT = 2.0
+VALID, BAD_ADDRESS, BAD_CRC = 0, 1, 2
+
+# The --name=value options and their defaults.
+DEFAULT_OPTIONS = {
+    "requests": "20000",
+    "concurrency": "8",
+    "mix": "90,5,5",
+    "server": "async",
+    "workers": "1",
+    "combinations": ",".join(COMBINATIONS),
+    "output": None,
+    "baseline": None,
+}
+
+#=== Requests =================================================================
+
+# Create a request of a kind with the expected length of its response, without the MBAP header.
+def CreateRequest(kind, dataProtocol):
+    count = 10
+    unit = 1
+    start = 0
+    if kind == BAD_ADDRESS:
+        start = 0xFFFF
+    elif kind == BAD_CRC and dataProtocol == "tcp":
+        unit = 2
+
+    pdu = struct.pack(">BBHH", unit, 0x03, start, count)
+    responseLength = 3 + 2 * count if kind == VALID else 3
+    if dataProtocol == "rtu":
+        crc = CalculateCRC(pdu)
+        if kind == BAD_CRC:
+            crc ^= 0xFFFF
+        return pdu + struct.pack("<H", crc), responseLength + 2
+    return pdu, responseLength
+
+# Create the request kinds of a mix in percent, as a list to pick from at random.
+def CreateMix(mix, dataProtocol):
+    requests = []
+    for kind, percent in enumerate(mix):
+        requests.extend([CreateRequest(kind, dataProtocol)] * percent)
+    return requests
+
+#=== Clients ==================================================================
+
+class UdpClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.response = None
+
+    def datagram_received(self, data, address):
+        if self.response is not None and self.response.done() == False:
+            self.response.set_result(data)
+
+async def RunUdpClient(address, dataProtocol, requests, remaining, latencies, errors):
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(UdpClient, remote_addr=address)
+    tid = 0
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            request, length = random.choice(requests)
+            if dataProtocol == "tcp":
+                tid = (tid + 1) & 0xFFFF
+                request = struct.pack(">HHH", tid, 0, len(request)) + request
+            client.response = loop.create_future()
+            start = time.perf_counter()
+            transport.sendto(request)
+            try:
+                await asyncio.wait_for(client.response, TIMEOUT)
+                latencies.append(time.perf_counter() - start)
+            except asyncio.TimeoutError:
+                errors[0] += 1
+    finally:
+        transport.close()
+
+async def RunTcpClient(address, dataProtocol, requests, remaining, latencies, errors):
+    reader, writer = await asyncio.open_connection(*address)
+    tid = 0
+    try:
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            request, length = random.choice(requests)
+            if dataProtocol == "tcp":
+                tid = (tid + 1) & 0xFFFF
+                request = struct.pack(">HHH", tid, 0, len(request)) + request
+                length += 6
+            start = time.perf_counter()
+            writer.write(request)
+            try:
+                await asyncio.wait_for(reader.readexactly(length), TIMEOUT)
+                latencies.append(time.perf_counter() - start)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                errors[0] += 1
+                return
+    finally:
+        writer.close()
+
+async def RunClients(address, transportProtocol, dataProtocol, requests, count, concurrency):
+    remaining = [count]
+    latencies = []
+    errors = [0]
+    run = RunUdpClient if transportProtocol == "udp" else RunTcpClient
+    await asyncio.gather(*[run(address, dataProtocol, requests, remaining, latencies, errors) for i in range(concurrency)])
+    return latencies, errors[0]
+
+#=== Server ===================================================================
+
+# Get a port that is free for both UDP and TCP.
+def FreePort():
+    while True:
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.bind(("127.0.0.1", 0))
+        port = tcp.getsockname()[1]
+        udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp.bind(("127.0.0.1", port))
+            return port
+        except OSError:
+            continue
+        finally:
+            tcp.close()
+            udp.close()
+
+# Start the server and wait until it answers a request.
+def StartServer(port, transportProtocol, dataProtocol, options):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "modbus_server.py")
+    server = subprocess.Popen([sys.executable, script, "127.0.0.1", str(port), transportProtocol, dataProtocol,
+        "--server=%s"%(options["server"]), "--workers=%s"%(options["workers"])],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    request, length = CreateRequest(VALID, dataProtocol)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            break
+        try:
+            asyncio.run(RunClients(("127.0.0.1", port), transportProtocol, dataProtocol, [(request, length)], 1, 1))
+            return server
+        except OSError:
+            time.sleep(0.1)
+    StopServer(server)
+    raise RuntimeError("Server did not start: %s/%s"%(transportProtocol, dataProtocol))
+
+def StopServer(server):
+    server.terminate()
+    try:
+        server.wait(5)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+# CPU seconds used by a process and its workers, None where /proc is not available.
+def ProcessCpuTime(pid):
+    try:
+        ticks = 0
+        pids = [pid]
+        with open("/proc/%d/task/%d/children"%(pid, pid)) as children:
+            pids.extend(int(child) for child in children.read().split())
+        for p in pids:
+            with open("/proc/%d/stat"%(p)) as stat:
+                # The command name may contain spaces, the fields after it do not.
+                fields = stat.read().rsplit(")", 1)[1].split()
+            ticks += int(fields[11]) + int(fields[12])
+        return ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError):
+        return None
+
+#=== Benchmark ================================================================
+
+# Get a percentile of sorted latencies, in microseconds.
+def Percentile(latencies, percent):
+    if len(latencies) == 0:
+        return 0.0
+    return 1e6 * latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+def Benchmark(combination, options, mix):
+    transportProtocol, dataProtocol = combination.split("/")
+    count = int(options["requests"])
+    port = FreePort()
+    server = StartServer(port, transportProtocol, dataProtocol, options)
+    try:
+        requests = CreateMix(mix, dataProtocol)
+        serverCpu = ProcessCpuTime(server.pid)
+        clientCpu = time.process_time()
+        start = time.perf_counter()
+        latencies, errors = asyncio.run(RunClients(("127.0.0.1", port), transportProtocol, dataProtocol, requests, count, int(options["concurrency"])))
+        seconds = time.perf_counter() - start
+        clientCpu = time.process_time() - clientCpu
+        if serverCpu is not None:
+            serverCpu = ProcessCpuTime(server.pid) - serverCpu
+    finally:
+        StopServer(server)
+
+    latencies.sort()
+    answered = max(len(latencies), 1)
+    return {
+        "combination": combination,
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": seconds,
+        "rps": len(latencies) / seconds,
+        "p50_us": Percentile(latencies, 50),
+        "p99_us": Percentile(latencies, 99),
+        "p999_us": Percentile(latencies, 99.9),
+        "server_cpu_us": None if serverCpu is None else 1e6 * serverCpu / answered,
+        "client_cpu_us": 1e6 * clientCpu / answered,
+    }
+
+# Print a result, with the change from the baseline result of the same combination.
+def Report(result, baseline):
+    cpu = "n/a" if result["server_cpu_us"] is None else "%.1f"%(result["server_cpu_us"])
+    line = "%-8s %10.0f req/s  p50 %8.1f us  p99 %8.1f us  p999 %8.1f us  cpu %6s us/req  errors %d"%(
+        result["combination"], result["rps"], result["p50_us"], result["p99_us"], result["p999_us"], cpu, result["errors"])
+    if baseline is not None:
+        line += "  (req/s %+.1f%%, p99 %+.1f%%)"%(
+            100.0 * (result["rps"] / baseline["rps"] - 1), 100.0 * (result["p99_us"] / max(baseline["p99_us"], 1e-9) - 1))
+    print(line)
+
+if __name__ == "__main__":
+    options = ParseOptions(sys.argv[1:], DEFAULT_OPTIONS)
+
+    for name in ("requests", "concurrency", "workers"):
+        if options[name].isdigit() == False or int(options[name]) == 0:
+            print("Invalid %s"%(name))
+            sys.exit()
+
+    mix = options["mix"].split(",")
+    if len(mix) != 3 or any(percent.isdigit() == False for percent in mix) or sum(int(percent) for percent in mix) == 0:
+        print("Invalid mix")
+        sys.exit()
+    mix = [int(percent) for percent in mix]
+
+    if options["server"] != "sync" and options["server"] != "async":
+        print("Invalid server")
+        sys.exit()
+
+    combinations = options["combinations"].split(",")
+    if any(combination not in COMBINATIONS for combination in combinations):
+        print("Invalid combinations")
+        sys.exit()
+
+    baselines = {}
+    if options["baseline"] is not None:
+        with open(options["baseline"]) as file:
+            baselines = {result["combination"]: result for result in json.load(file)["results"]}
+
+    random.seed(1)
+    results = []
+    for combination in combinations:
+        result = Benchmark(combination, options, mix)
+        Report(result, baselines.get(combination))
+        results.append(result)
+
+    if options["output"] is not None:
+        with open(options["output"], "w") as file:
+            json.dump({
+                "options": options,
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": results,
+            }, file, indent=4)
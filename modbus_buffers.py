@@ -0,0 +1,35 @@
+'''
+Pool of preallocated output buffers.
+
+Responses are encoded straight into a buffer taken from the pool with
+struct.pack_into, instead of building a new bytes object per part of the
+response. The buffer is given back to the pool when the response is sent.
+
+Usage:
+    buffer = pool.Acquire()
+    try:
+        end = codec.CreatePositiveResponse(request, data, buffer, 0)
+        sock.sendall(memoryview(buffer)[:end])
+    finally:
+        pool.Release(buffer)
+'''
+
+MAX_RESPONSE_LENGTH = 260   # Largest Modbus TCP response, MBAP header and 253 bytes PDU.
+
+class BufferPool():
+    def __init__(self, size=0x10000, keep=64):
+        self.size = max(size, MAX_RESPONSE_LENGTH)
+        self.keep = keep        # Most buffers kept for reuse.
+        self.free = []
+
+    # Get a buffer, reusing a released one if there is any.
+    def Acquire(self):
+        try:
+            return self.free.pop()
+        except IndexError:
+            return bytearray(self.size)
+
+    # Give a buffer back to the pool.
+    def Release(self, buffer):
+        if len(self.free) < self.keep:
+            self.free.append(buffer)
@@ -0,0 +1,281 @@
+'''
+Streaming decoding of captured Modbus TCP traffic.
+
+The frames of a capture are read one at a time by a generator, responses are
+matched to their requests by TID and the values of each response are decoded
+and written as CSV or JSON lines. Only the requests waiting for a response are
+kept, at most one per TID, so memory does not grow with the capture.
+
+A frame is taken as the response of a request with the same TID that is
+waiting, and as a request otherwise. Trace files know which frames are
+requests and which are responses.
+
+The values of a read are decoded with a block decoder per request (unit,
+function, start, count), compiled on first use. Without tags, the registers
+of a response are decoded as values of one data type, one after the other.
+With tags, only the tags inside the registers of the request are decoded.
+
+Capture formats:
+    * hex: One frame per line, as hex. Empty lines and lines starting with #
+      are skipped.
+    * raw: Frames back to back, as sent on a TCP connection.
+    * trace: A trace file of modbus_server.py (--trace-file).
+    * recording: A Modbus TCP recording of modbus_server.py (--record-file).
+
+Tags format (CSV):
+    <unit>,<function>,<register>,<data type>
+    1,3,100,f
+
+Output format (csv), one row per value:
+    tid,unit,function,register,type,value,error
+
+Output format (json), one line per response:
+    {"tid": 1, "unit": 1, "function": 3, "start": 100, "values": {"100": 21.5}}
+    {"tid": 2, "unit": 1, "function": 3, "error": 2}
+
+Usage:
+    errors = collections.Counter()
+    frames = ReadCaptureFrames("capture.txt", "hex", errors)
+    records = MatchTransactions(frames, TagDecoders(tags, "H"), errors)
+    WriteCsv(records, sys.stdout)
+'''
+
+import os
+import csv
+import json
+import mmap
+import bisect
+import struct
+
+from modbus_decode import BlockDecoder
+from modbus_datatypes import DataTypeRegisterCount
+from modbus_log import TRACE_RECORD, REQUEST, RESPONSE
+from modbus_recording import MapRecording, ReadRecords
+
+CAPTURE_FORMATS = ("hex", "raw", "trace", "recording")
+OUTPUT_FORMATS = ("csv", "json")
+READ_FUNCTIONS = (0x03, 0x04)
+
+MBAP_HEADER = struct.Struct(">HHH")         # [TID TID] [PID PID] [LEN LEN]
+REQUEST_FIELDS = struct.Struct(">BBHH")     # ADR FUNC [START START] [COUNT COUNT]
+
+MAX_DECODERS = 4096     # Compiled decoders kept, all are dropped when there are more.
+WRITE_BATCH = 1024      # Rows written at once.
+
+#=== Capture readers ==========================================================
+
+# Read a capture of hex frames, one per line. Lines that are not hex are counted in errors.
+def ReadHexFrames(path, errors):
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if len(line) == 0 or line[0] == "#":
+                continue
+            try:
+                yield None, bytes.fromhex(line)
+            except ValueError:
+                errors["lines"] += 1
+
+# Map a capture file for reading. The frames are views of the mapping, so it is
+# unmapped when the last frame is no longer used instead of when reading ends.
+def MapCapture(path):
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+# Read a capture of frames back to back, split by the LEN of the MBAP header.
+def ReadRawFrames(path, errors):
+    memory = MapCapture(path)
+    view = memoryview(memory)
+    position = 0
+    while position + 6 <= len(memory):
+        length = (memory[position + 4] << 8) | memory[position + 5]
+        end = position + 6 + length
+        if end > len(memory):
+            errors["truncated"] += 1
+            break
+        yield None, view[position:end]
+        position = end
+
+# Read the frames of a trace file of modbus_server.py.
+def ReadTraceFrames(path, errors):
+    memory = MapCapture(path)
+    view = memoryview(memory)
+    position = 0
+    while position + TRACE_RECORD.size <= len(memory):
+        timestamp, direction, length = TRACE_RECORD.unpack_from(memory, position)
+        position += TRACE_RECORD.size
+        if position + length > len(memory):
+            errors["truncated"] += 1
+            break
+        yield direction, view[position:position + length]
+        position += length
+
+# Read the frames of a recording of modbus_server.py, only Modbus TCP frames can be matched.
+def ReadRecordingFrames(path, errors):
+    protocol, memory = MapRecording(path)
+    if protocol != "tcp":
+        raise ValueError("Recording %s is not of Modbus TCP."%(path))
+    return RecordingFrames(memory, errors)
+
+def RecordingFrames(memory, errors):
+    for timestamp, request, response in ReadRecords(memory, errors):
+        yield REQUEST, request
+        if len(response) > 0:
+            yield RESPONSE, response
+
+# Read the (direction, frame) of a capture, the direction is None if it is not known.
+def ReadCaptureFrames(path, captureFormat, errors):
+    if captureFormat == "hex":
+        return ReadHexFrames(path, errors)
+    elif captureFormat == "raw":
+        return ReadRawFrames(path, errors)
+    elif captureFormat == "trace":
+        return ReadTraceFrames(path, errors)
+    elif captureFormat == "recording":
+        return ReadRecordingFrames(path, errors)
+    raise ValueError("Invalid capture format: %s."%(captureFormat))
+
+#=== Decoders =================================================================
+
+# Read a tags file of unit,function,register,data type lines.
+def ReadTags(path):
+    tags = []
+    with open(path, "r", newline="") as file:
+        for number, row in enumerate(csv.reader(file), 1):
+            if len(row) == 0 or row[0].startswith("#"):
+                continue
+            if len(row) != 4 or not (row[0].isdigit() and row[1].isdigit() and row[2].isdigit()):
+                raise ValueError("Tags line %d: Expected unit,function,register,data type."%(number))
+            tags.append((int(row[0]), int(row[1]), int(row[2]), row[3].strip()))
+    return tags
+
+# The decoders of the requests in a capture, compiled on first use.
+class TagDecoders():
+    def __init__(self, tags=None, dataType="H"):
+        self.dataType = dataType
+        self.registers = DataTypeRegisterCount(dataType)
+        self.tags = {}          # (unit, function): sorted list of (register, data type).
+        for unit, function, register, tagType in tags or []:
+            DataTypeRegisterCount(tagType)
+            self.tags.setdefault((unit, function), []).append((register, tagType))
+        for registers in self.tags.values():
+            registers.sort()
+        self.decoders = {}
+
+    # Get the (registers, data types, decoder) of a read request.
+    def Decoder(self, unit, function, start, count):
+        key = (unit, function, start, count)
+        decoder = self.decoders.get(key)
+        if decoder is None:
+            if len(self.decoders) >= MAX_DECODERS:
+                self.decoders.clear()
+            decoder = self.Compile(unit, function, start, count)
+            self.decoders[key] = decoder
+        return decoder
+
+    def Compile(self, unit, function, start, count):
+        if len(self.tags) > 0:
+            tags = self.tags.get((unit, function), [])
+            first = bisect.bisect_left(tags, (start, ""))
+            schema = []
+            for register, dataType in tags[first:]:
+                if register >= start + count:
+                    break
+                if register + DataTypeRegisterCount(dataType) <= start + count:
+                    schema.append((register, dataType))
+        else:
+            schema = [(register, self.dataType) for register in range(start, start + count - self.registers + 1, self.registers)]
+
+        registers = [register for register, dataType in schema]
+        dataTypes = [dataType for register, dataType in schema]
+        decoder = BlockDecoder([(register - start, dataType) for register, dataType in schema]) if len(schema) > 0 else None
+        return registers, dataTypes, decoder
+
+#=== Matching =================================================================
+
+# Match responses to requests by TID and decode them. Yields records of
+# (tid, unit, function, start, registers, data types, values, error code).
+def MatchTransactions(frames, decoders, errors):
+    pending = {}    # TID: (unit, function, start, count) of a request waiting for its response.
+
+    for direction, frame in frames:
+        if len(frame) < 8:
+            errors["short"] += 1
+            continue
+        tid, pid, length = MBAP_HEADER.unpack_from(frame)
+
+        request = pending.get(tid) if direction != REQUEST else None
+        if request is None:
+            if direction == RESPONSE:
+                errors["unmatched"] += 1
+            elif len(frame) >= 12:
+                pending[tid] = REQUEST_FIELDS.unpack_from(frame, 6)
+            else:
+                errors["short"] += 1
+            continue
+        del pending[tid]
+
+        unit, function, start, count = request
+        responseFunction = frame[7]
+        if responseFunction == function | 0x80:
+            yield tid, unit, function, start, None, None, None, frame[8] if len(frame) > 8 else 0
+            continue
+        if responseFunction != function:
+            errors["mismatched"] += 1
+            continue
+        if function not in READ_FUNCTIONS:
+            yield tid, unit, function, start, [], [], [], None
+            continue
+
+        registers, dataTypes, decoder = decoders.Decoder(unit, function, start, count)
+        if len(frame) < 9 or frame[8] != 2 * count or len(frame) != 9 + 2 * count:
+            errors["length"] += 1
+            continue
+        values = decoder.Decode(frame[9:]) if decoder is not None else []
+        yield tid, unit, function, start, registers, dataTypes, values, None
+
+    errors["unanswered"] += len(pending)
+
+#=== Output ===================================================================
+
+# Write the records as CSV, one row per value.
+def WriteCsv(records, file):
+    writer = csv.writer(file, lineterminator="\n")
+    writer.writerow(("tid", "unit", "function", "register", "type", "value", "error"))
+    rows = []
+    for tid, unit, function, start, registers, dataTypes, values, errorCode in records:
+        if errorCode is not None:
+            rows.append((tid, unit, function, start, "", "", errorCode))
+        else:
+            rows.extend((tid, unit, function, register, dataType, value, "") for register, dataType, value in zip(registers, dataTypes, values))
+        if len(rows) >= WRITE_BATCH:
+            writer.writerows(rows)
+            rows = []
+    writer.writerows(rows)
+
+# Write the records as JSON lines, one line per response.
+def WriteJsonLines(records, file):
+    lines = []
+    for tid, unit, function, start, registers, dataTypes, values, errorCode in records:
+        record = {"tid": tid, "unit": unit, "function": function}
+        if errorCode is not None:
+            record["error"] = errorCode
+        else:
+            record["start"] = start
+            record["values"] = dict(zip(map(str, registers), values))
+        lines.append(json.dumps(record))
+        if len(lines) >= WRITE_BATCH:
+            file.write("\n".join(lines) + "\n")
+            lines = []
+    if len(lines) > 0:
+        file.write("\n".join(lines) + "\n")
+
+def WriteRecords(records, file, outputFormat):
+    if outputFormat == "csv":
+        WriteCsv(records, file)
+    elif outputFormat == "json":
+        WriteJsonLines(records, file)
+    else:
+        raise ValueError("Invalid output format: %s."%(outputFormat))
@@ -0,0 +1,244 @@
+'''
+Pipelined Modbus TCP client.
+
+Each connection can have many requests in flight at once. The requests are
+sent without waiting for the previous responses, and the responses are
+matched to the requests by their TID. A device can have more than one
+connection, and a pool keeps one client per device so a poller can talk to
+many devices from one process.
+
+A request that gets no response within the timeout is sent again, on a new
+connection if the old one was lost, up to the amount of retries.
+
+Usage (asyncio):
+    client = AsyncModbusClient("192.168.0.10", 502)
+    data = await client.ReadHoldingRegisters(1, 0, 10)
+    await client.Close()
+
+Usage (blocking):
+    client = ModbusClient("192.168.0.10", 502)
+    data = client.ReadHoldingRegisters(1, 0, 10)
+    client.Close()
+
+Request format:
+[TID TID] [PID PID] [LEN LEN] ADR FUNC [DATA ... DATA]
+'''
+
+import struct
+import asyncio
+import threading
+
+from modbus_framing import MbapFrameBuffer, FrameError
+from modbus_messages import ModbusError, ResponseError
+
+MBAP_HEADER = struct.Struct(">HHHB")    # [TID TID] [PID PID] [LEN LEN] ADR
+READ_REQUEST = struct.Struct(">BHH")    # FUNC [START START] [COUNT COUNT]
+
+#=== Connection ===============================================================
+
+class ClientConnection(asyncio.BufferedProtocol):
+    def __init__(self, maxInFlight):
+        self.transport = None
+        self.framer = MbapFrameBuffer()
+        self.pending = {}       # TID: future of the response.
+        self.nextTid = 0
+        self.slots = asyncio.Semaphore(maxInFlight)
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizeHint):
+        return self.framer.GetBuffer(sizeHint)
+
+    def buffer_updated(self, received):
+        self.framer.BufferUpdated(received)
+        try:
+            for frame in self.framer.Frames():
+                tid = (frame[0] << 8) | frame[1]
+                future = self.pending.pop(tid, None)
+                # A late response to a request that timed out has no future.
+                if future is not None and future.done() == False:
+                    future.set_result(bytes(frame[6:]))
+        except FrameError:
+            self.transport.close()
+
+    def connection_lost(self, exception):
+        self.closed = True
+        for future in self.pending.values():
+            if future.done() == False:
+                future.set_exception(ConnectionError("Connection lost."))
+        self.pending.clear()
+
+    # Get a TID that is not used by a request in flight.
+    def AllocateTid(self):
+        while True:
+            self.nextTid = (self.nextTid + 1) & 0xFFFF
+            if self.nextTid not in self.pending:
+                return self.nextTid
+
+    # Send a request and wait for its response, returns the address and PDU of the response.
+    async def Transact(self, unit, pdu, timeout):
+        async with self.slots:
+            if self.closed:
+                raise ConnectionError("Connection lost.")
+            tid = self.AllocateTid()
+            future = asyncio.get_running_loop().create_future()
+            self.pending[tid] = future
+            self.transport.write(MBAP_HEADER.pack(tid, 0, 1 + len(pdu), unit) + pdu)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                self.pending.pop(tid, None)
+
+    # Amount of requests in flight.
+    def Load(self):
+        return len(self.pending)
+
+#=== Client ===================================================================
+
+class AsyncModbusClient():
+    def __init__(self, host, port=502, connections=1, maxInFlight=16, timeout=1.0, retries=2):
+        self.host = host
+        self.port = port
+        self.maxConnections = connections
+        self.maxInFlight = maxInFlight
+        self.timeout = timeout
+        self.retries = retries
+        self.connections = []
+        self.connecting = None
+
+    # Get the least loaded open connection, opening a new one while there are fewer than allowed.
+    async def Connection(self):
+        self.connections = [connection for connection in self.connections if connection.closed == False]
+        if len(self.connections) < self.maxConnections:
+            # Requests arriving while a connection is opened wait for the same connection.
+            if self.connecting is None:
+                self.connecting = asyncio.ensure_future(self.Connect())
+            connecting = self.connecting
+            try:
+                connection = await asyncio.shield(connecting)
+            finally:
+                if self.connecting is connecting:
+                    self.connecting = None
+            if connection not in self.connections:
+                self.connections.append(connection)
+        return min(self.connections, key=ClientConnection.Load)
+
+    async def Connect(self):
+        loop = asyncio.get_running_loop()
+        transport, connection = await asyncio.wait_for(
+            loop.create_connection(lambda: ClientConnection(self.maxInFlight), self.host, self.port), self.timeout)
+        return connection
+
+    # Send a PDU to a unit and get the data of the response, after the function.
+    async def Request(self, unit, pdu):
+        error = None
+        for attempt in range(self.retries + 1):
+            try:
+                connection = await self.Connection()
+                response = await connection.Transact(unit, pdu, self.timeout)
+            except (asyncio.TimeoutError, OSError) as exception:
+                error = exception
+                continue
+
+            # A response to another unit or function is not an answer to the request.
+            if len(response) < 2 or response[0] != unit or response[1] & 0x7F != pdu[0]:
+                raise ResponseError("Response from %s:%d unit %d does not match the request."%(self.host, self.port, unit))
+            function = response[1]
+            if function & 0x80:
+                if len(response) != 3:
+                    raise ResponseError("Invalid exception response from %s:%d unit %d."%(self.host, self.port, unit))
+                raise ModbusError(function & 0x7F, response[2])
+            return response[2:]
+
+        if isinstance(error, asyncio.TimeoutError):
+            raise TimeoutError("No response from %s:%d unit %d."%(self.host, self.port, unit))
+        raise error
+
+    # Read count registers from start, returns the bytes of the registers.
+    async def Read(self, unit, function, start, count):
+        response = await self.Request(unit, READ_REQUEST.pack(function, start, count))
+        if len(response) != 1 + 2 * count or response[0] != 2 * count:
+            raise ResponseError("Invalid response length from %s:%d unit %d."%(self.host, self.port, unit))
+        return response[1:]
+
+    async def ReadHoldingRegisters(self, unit, start, count):
+        return await self.Read(unit, 0x03, start, count)
+
+    async def ReadInputRegisters(self, unit, start, count):
+        return await self.Read(unit, 0x04, start, count)
+
+    async def WriteRegister(self, unit, register, value):
+        await self.Request(unit, struct.pack(">BHH", 0x06, register, value))
+
+    # Write the bytes in data to the registers from start.
+    async def WriteRegisters(self, unit, start, data):
+        count = len(data) // 2
+        await self.Request(unit, struct.pack(">BHHB", 0x10, start, count, len(data)) + bytes(data))
+
+    # Read the planned reads of a tag list at once, decoding into values by tag index.
+    async def ReadPlan(self, plan, values):
+        results = await asyncio.gather(*[self.Read(read.unit, read.function, read.start, read.count) for read in plan])
+        for read, data in zip(plan, results):
+            read.Scatter(data, values)
+        return values
+
+    async def Close(self):
+        for connection in self.connections:
+            if connection.transport is not None:
+                connection.transport.close()
+        self.connections = []
+
+# One client per device, shared by everything polling the device.
+class ClientPool():
+    def __init__(self, **options):
+        self.options = options
+        self.clients = {}
+
+    def Client(self, host, port=502):
+        client = self.clients.get((host, port))
+        if client is None:
+            client = AsyncModbusClient(host, port, **self.options)
+            self.clients[(host, port)] = client
+        return client
+
+    async def Close(self):
+        for client in self.clients.values():
+            await client.Close()
+        self.clients = {}
+
+#=== Blocking client ==========================================================
+
+# Runs an AsyncModbusClient on an event loop in a background thread.
+class ModbusClient():
+    def __init__(self, host, port=502, **options):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = AsyncModbusClient(host, port, **options)
+
+    # Run a coroutine of the client and wait for its result.
+    def Call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def ReadHoldingRegisters(self, unit, start, count):
+        return self.Call(self.client.ReadHoldingRegisters(unit, start, count))
+
+    def ReadInputRegisters(self, unit, start, count):
+        return self.Call(self.client.ReadInputRegisters(unit, start, count))
+
+    def WriteRegister(self, unit, register, value):
+        return self.Call(self.client.WriteRegister(unit, register, value))
+
+    def WriteRegisters(self, unit, start, data):
+        return self.Call(self.client.WriteRegisters(unit, start, data))
+
+    def ReadPlan(self, plan, values):
+        return self.Call(self.client.ReadPlan(plan, values))
+
+    def Close(self):
+        self.Call(self.client.Close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
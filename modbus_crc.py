@@ -0,0 +1,92 @@
+'''
+Table driven CRC-16/Modbus.
+
+The CRC is calculated one byte at a time using a precomputed 256 entry table
+instead of shifting every bit of every byte.
+
+Usage:
+    * CalculateCRC(data): The CRC of a complete frame.
+    * CalculateCRC(chunk, crc): Continue a CRC over another chunk, so a frame
+      can be checked as it arrives in memoryview pieces.
+    * VerifyFrame(frame): Check a frame ending with its CRC (low byte first).
+    * VerifyFrames(frames): Check many frames at once, for batch and replay use.
+      When NumPy is installed, the frames of a length with many frames are
+      checked together, one byte column at a time. The column steps cost the
+      same for any amount of frames, so fewer frames are checked one by one.
+
+CRC format:
+[DATA ... DATA] CRC-LO CRC-HI
+'''
+
+from modbus_optional import OptionalModule
+
+CRC_INIT = 0xFFFF
+CRC_POLYNOMIAL = 0xA001     # Reversed 0x8005.
+VECTOR_FRAMES = 128         # Frames of one length from which they are checked together with NumPy.
+
+# Create the table with the CRC of every possible byte value.
+def CreateTable():
+    table = []
+    for value in range(256):
+        crc = value
+        for i in range(8):
+            if ((crc & 1) != 0):
+                crc >>= 1
+                crc ^= CRC_POLYNOMIAL
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = CreateTable()
+
+# Calculate the CRC of data, optionally continuing from a previous CRC.
+def CalculateCRC(data, crc=CRC_INIT):
+    table = CRC_TABLE
+    for pos in data:
+        crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
+    return crc
+
+# Check if the last two bytes of a frame is the CRC of the rest of the frame.
+def VerifyFrame(frame):
+    if len(frame) < 3:
+        return False
+    return CalculateCRC(frame[:-2]) == (frame[-2] | (frame[-1] << 8))
+
+# Check a list of frames, returns a list of bools in the same order.
+def VerifyFrames(frames):
+    # Group the frames by length.
+    groups = {}
+    for index, frame in enumerate(frames):
+        groups.setdefault(len(frame), []).append(index)
+
+    # Only groups with many frames are faster to check together.
+    numpy = None
+    if any(length >= 3 and len(indexes) >= VECTOR_FRAMES for length, indexes in groups.items()):
+        numpy = OptionalModule("numpy")
+
+    result = [False] * len(frames)
+    for length, indexes in groups.items():
+        if numpy is not None and length >= 3 and len(indexes) >= VECTOR_FRAMES:
+            checked = VerifyFramesNumpy([frames[i] for i in indexes])
+        else:
+            checked = [VerifyFrame(frames[i]) for i in indexes]
+        for i, ok in zip(indexes, checked):
+            result[i] = ok
+    return result
+
+# Check frames of equal length together, one byte column at a time.
+def VerifyFramesNumpy(frames):
+    numpy = OptionalModule("numpy")
+    length = len(frames[0])
+    table = numpy.array(CRC_TABLE, dtype=numpy.uint16)
+    block = numpy.frombuffer(b"".join(bytes(frame) for frame in frames), dtype=numpy.uint8)
+    block = block.reshape(len(frames), length)
+
+    # Run the table lookup for every frame at once.
+    crc = numpy.full(len(frames), CRC_INIT, dtype=numpy.uint16)
+    for column in range(length - 2):
+        crc = (crc >> 8) ^ table[(crc ^ block[:, column]) & 0xFF]
+
+    received = block[:, length - 2].astype(numpy.uint16) | (block[:, length - 1].astype(numpy.uint16) << 8)
+    return (crc == received).tolist()
@@ -0,0 +1,71 @@
+'''
+The data types of values stored in Modbus registers.
+
+Data types:
+	* ? = bool,		register is not 0
+	* b = INT8,		signed INT8, in the low byte of the register
+	* B = UINT8,	unsigned INT8, in the low byte of the register
+	* h = INT16,	signed INT16
+	* H = UINT16,	unsigned INT16
+	* i = INT32,	signed INT32
+	* I = UINT32,	unsigned INT32
+	* q = INT64,	signed INT64
+	* Q = UINT64,	unsigned INT64
+	* f = REAL32,	32-bits real number (float)
+	* d = REAL64,	64-bits real number (double)
+	* s# = string,	with # amount of characters
+
+Word swapped data types:
+	* iw, Iw, qw, Qw, fw, dw = As above, with the registers in reverse order
+	  (low word first). The bytes of each register are still big-endian.
+'''
+
+# Data type: (registers, struct format).
+DATA_TYPES = {
+    "?": (1, "H"),
+    "b": (1, "b"),
+    "B": (1, "B"),
+    "h": (1, "h"),
+    "H": (1, "H"),
+    "i": (2, "i"),
+    "I": (2, "I"),
+    "q": (4, "q"),
+    "Q": (4, "Q"),
+    "f": (2, "f"),
+    "d": (4, "d"),
+}
+
+# Data types stored in the low byte of a register.
+BYTE_TYPES = ("b", "B")
+
+# Data types that have a word swapped variant.
+WORD_SWAPPED_TYPES = ("i", "I", "q", "Q", "f", "d")
+
+MAX_STRING_LENGTH = 0xFF
+
+# Check if a data type is word swapped, such as "iw".
+def WordSwapped(dataType):
+    return len(dataType) == 2 and dataType[1] == "w" and dataType[0] in WORD_SWAPPED_TYPES
+
+# Get the amount of characters of a string data type, such as 10 for "s10", or 0 if it is not a string.
+def StringLength(dataType):
+    if len(dataType) < 2 or dataType[0] != "s" or dataType[1:].isdigit() == False:
+        return 0
+    return int(dataType[1:])
+
+# Check if a data type is valid.
+def ValidDataType(dataType):
+    if dataType in DATA_TYPES or WordSwapped(dataType):
+        return True
+    length = StringLength(dataType)
+    return length > 0 and length <= MAX_STRING_LENGTH
+
+# Get the amount of registers of a data type.
+def DataTypeRegisterCount(dataType):
+    if dataType in DATA_TYPES:
+        return DATA_TYPES[dataType][0]
+    elif WordSwapped(dataType):
+        return DATA_TYPES[dataType[0]][0]
+    elif ValidDataType(dataType):
+        return (StringLength(dataType) + 1) // 2
+    raise ValueError("Invalid data type: %s."%(dataType))
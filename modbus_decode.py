@@ -0,0 +1,124 @@
+'''
+Bulk decoding of typed values from blocks of registers.
+
+A schema lists the values of a block as (offset, data type), where the offset
+is in registers from the start of the block. The schema is compiled once into
+a byte gather order and one struct format, so a block is decoded with one
+gather and one unpack instead of one unpack per value. The gather puts each
+value in big-endian order: it picks the low byte of INT8 values and reverses
+the registers of word swapped values.
+
+Many blocks with the same schema, such as the same registers polled from many
+devices or over time, are decoded together into one column per value. This
+uses NumPy structured dtypes when NumPy is installed.
+
+Usage:
+    decoder = BlockDecoder([(0, "h"), (1, "f"), (3, "iw"), (5, "s4")])
+    values = decoder.Decode(payload)
+    columns = decoder.DecodeColumns([payload1, payload2, ...])
+
+See modbus_datatypes.py for the data types.
+'''
+
+import struct
+import operator
+
+from modbus_optional import OptionalModule
+from modbus_datatypes import DATA_TYPES, BYTE_TYPES, ValidDataType, WordSwapped, StringLength, DataTypeRegisterCount
+
+class BlockDecoder():
+    def __init__(self, schema):
+        self.schema = list(schema)
+        gather = []
+        formats = []
+        self.bools = []         # Indexes of the bool values.
+        self.strings = []       # Indexes of the string values.
+        self.registers = 0      # Registers needed in a block.
+
+        for index, (offset, dataType) in enumerate(self.schema):
+            if ValidDataType(dataType) == False:
+                raise ValueError("Invalid data type: %s."%(dataType))
+            count = DataTypeRegisterCount(dataType)
+            self.registers = max(self.registers, offset + count)
+            first = 2 * offset
+
+            length = StringLength(dataType)
+            if length > 0:
+                gather.extend(range(first, first + length))
+                formats.append("%ds"%(length))
+                self.strings.append(index)
+            elif dataType in BYTE_TYPES:
+                gather.append(first + 1)
+                formats.append(DATA_TYPES[dataType][1])
+            elif WordSwapped(dataType):
+                for register in reversed(range(offset, offset + count)):
+                    gather.extend((2 * register, 2 * register + 1))
+                formats.append(DATA_TYPES[dataType[0]][1])
+            else:
+                gather.extend(range(first, first + 2 * count))
+                formats.append(DATA_TYPES[dataType][1])
+                if dataType == "?":
+                    self.bools.append(index)
+
+        self.gather = gather
+        self.struct = struct.Struct(">" + "".join(formats))
+        self.formats = formats
+
+        # Values already in order need no gather, they are unpacked straight from the block.
+        self.contiguous = gather == list(range(len(gather)))
+        self.getter = operator.itemgetter(*gather) if len(gather) > 1 else None
+
+    # Check that a block has the registers of the schema.
+    def CheckLength(self, payload):
+        if len(payload) < 2 * self.registers:
+            raise ValueError("Block is %d bytes, the schema needs %d."%(len(payload), 2 * self.registers))
+
+    # Get the values of one block, in the order of the schema.
+    def Decode(self, payload):
+        self.CheckLength(payload)
+
+        if self.contiguous:
+            values = list(self.struct.unpack_from(payload))
+        elif self.getter is not None:
+            values = list(self.struct.unpack(bytes(self.getter(payload))))
+        else:
+            values = list(self.struct.unpack(bytes((payload[self.gather[0]],))))
+
+        for index in self.bools:
+            values[index] = values[index] != 0
+        for index in self.strings:
+            values[index] = values[index].decode("latin-1")
+        return values
+
+    # Get the values of many blocks with the same schema, as one column per value.
+    def DecodeColumns(self, payloads):
+        if OptionalModule("numpy") is None:
+            rows = [self.Decode(payload) for payload in payloads]
+            return [list(column) for column in zip(*rows)] if len(rows) > 0 else [[] for value in self.schema]
+        return self.DecodeColumnsNumpy(payloads)
+
+    # Gather the bytes of all blocks at once, then view them as records of the schema. Strings
+    # are kept as raw bytes and decoded like Decode does, a column of them is a list.
+    def DecodeColumnsNumpy(self, payloads):
+        numpy = OptionalModule("numpy")
+        for payload in payloads:
+            self.CheckLength(payload)
+        size = 2 * self.registers
+        block = numpy.frombuffer(b"".join(bytes(payload[:size]) for payload in payloads), dtype=numpy.uint8)
+        block = block.reshape(len(payloads), size)
+        gathered = numpy.ascontiguousarray(block[:, numpy.array(self.gather, dtype=numpy.intp)])
+
+        names = ["v%d"%(i) for i in range(len(self.formats))]
+        formats = [(">" + f) if f[-1] != "s" else ("V" + f[:-1]) for f in self.formats]
+        records = gathered.view(numpy.dtype({"names": names, "formats": formats})).reshape(len(payloads))
+
+        columns = [records[name] for name in names]
+        for index in self.bools:
+            columns[index] = columns[index] != 0
+        for index in self.strings:
+            columns[index] = [value.tobytes().decode("latin-1") for value in columns[index]]
+        return columns
+
+# Decode one block with a schema of (offset, data type).
+def DecodeBlock(payload, schema):
+    return BlockDecoder(schema).Decode(payload)
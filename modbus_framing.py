@@ -0,0 +1,235 @@
+'''
+Incremental Modbus TCP (MBAP) and Modbus RTU framing over a reusable receive
+buffer.
+
+A TCP stream or a serial line does not keep the boundaries of the requests
+sent by a client. One recv() can hold part of a frame, or several frames when
+a client pipelines its transactions. Modbus TCP frames are split by the LEN
+field in the MBAP header.
+
+Modbus RTU frames have no length field. The length is given by the function:
+most requests have a fixed length, the others a byte count at a fixed
+position. The frame is checked by its CRC. When the CRC is wrong the framer
+is out of step, such as after noise on a serial line, and it drops one byte
+at a time until a frame with a correct CRC starts. A frame of an unknown
+function ends where the CRC of the bytes so far is correct. On a serial line
+a silence of 3.5 characters ends a frame, the bytes of an incomplete frame
+are then dropped with Expire().
+
+Usage:
+    framer = MbapFrameBuffer()      # Or RtuFrameBuffer().
+    n = sock.recv_into(framer.GetBuffer())
+    framer.BufferUpdated(n)
+    for frame in framer.Frames():
+        ...
+
+    Or, with data already received as bytes:
+    for frame in framer.Feed(data):
+        ...
+
+    The frames are memoryviews into the receive buffer, no bytes are copied.
+    A frame is only valid until the buffer is written to again. The buffer is
+    used from the front to the back, and only the bytes of an incomplete
+    frame are moved to the front when the free space runs low.
+
+MBAP frame format:
+[TID TID] [PID PID] [LEN LEN] ADR FUNC [DATA ... DATA]
+                              |<------- LEN bytes ------->|
+
+RTU frame format:
+ADR FUNC [DATA ... DATA] [CRC CRC]
+'''
+
+from modbus_crc import CRC_INIT, CRC_TABLE, VerifyFrame
+
+MBAP_HEADER_LENGTH = 6      # TID, PID and LEN.
+MBAP_MIN_LENGTH = 2         # LEN of ADR and FUNC.
+MBAP_MAX_LENGTH = 254       # LEN of ADR and the largest PDU (253 bytes).
+MBAP_MAX_FRAME = MBAP_HEADER_LENGTH + MBAP_MAX_LENGTH
+
+RTU_MIN_FRAME = 4           # ADR FUNC and the CRC.
+RTU_MAX_FRAME = 256         # ADR, the largest PDU (253 bytes) and the CRC.
+RTU_EXCEPTION_FRAME = 5     # ADR FUNC ERROR and the CRC.
+
+# Length of the RTU frames of a function that always have the same length.
+RTU_REQUEST_LENGTHS = {
+    0x01: 8, 0x02: 8, 0x03: 8, 0x04: 8, 0x05: 8, 0x06: 8,
+    0x07: 4, 0x08: 8, 0x0B: 4, 0x0C: 4, 0x11: 4, 0x16: 10, 0x18: 6,
+}
+RTU_RESPONSE_LENGTHS = {
+    0x05: 8, 0x06: 8, 0x07: 5, 0x08: 8, 0x0B: 8, 0x0F: 8, 0x10: 8, 0x16: 10,
+}
+
+# Position of the byte count in the RTU frames of a function, the count is
+# followed by that many bytes and the CRC.
+RTU_REQUEST_COUNTS = {0x0F: 6, 0x10: 6, 0x14: 2, 0x15: 2, 0x17: 10}
+RTU_RESPONSE_COUNTS = {0x01: 2, 0x02: 2, 0x03: 2, 0x04: 2, 0x0C: 2, 0x11: 2, 0x14: 2, 0x15: 2, 0x17: 2}
+
+class FrameError(Exception):
+    pass
+
+# The receive buffer shared by the framers, NextFrame() is implemented by each protocol.
+class FrameBuffer():
+    def __init__(self, size, maxFrame):
+        self.maxFrame = maxFrame
+        self.buffer = bytearray(max(size, 2 * maxFrame))
+        self.view = memoryview(self.buffer)
+        self.start = 0      # First byte not yet returned as a frame.
+        self.end = 0        # First free byte.
+
+    # Get the free part of the buffer to receive into.
+    def GetBuffer(self, sizeHint=-1):
+        self.Compact()
+        return self.view[self.end:]
+
+    # Mark n bytes of the buffer given by GetBuffer() as received.
+    def BufferUpdated(self, n):
+        self.end += n
+
+    # Copy received data into the buffer and get the complete frames, for
+    # transports that return bytes. Data larger than the free space is copied
+    # in parts, returning the frames in between.
+    def Feed(self, data):
+        data = memoryview(data)
+        while True:
+            free = self.GetBuffer()
+            n = min(len(free), len(data))
+            free[:n] = data[:n]
+            self.BufferUpdated(n)
+            data = data[n:]
+            yield from self.Frames()
+            if len(data) == 0:
+                break
+
+    # Move the unread bytes to the front of the buffer when the free space runs low.
+    def Compact(self):
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        elif len(self.buffer) - self.end < self.maxFrame:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+    # Amount of received bytes not yet returned as a frame.
+    def Pending(self):
+        return self.end - self.start
+
+    def NextFrame(self):
+        # override in sub class.
+        pass
+
+    # Get every complete frame in the buffer, in the order they were received.
+    def Frames(self):
+        frame = self.NextFrame()
+        while frame is not None:
+            yield frame
+            frame = self.NextFrame()
+
+class MbapFrameBuffer(FrameBuffer):
+    def __init__(self, size=0x10000):
+        FrameBuffer.__init__(self, size, MBAP_MAX_FRAME)
+
+    # Get the next complete frame, or None if more bytes are needed.
+    def NextFrame(self):
+        available = self.end - self.start
+        if available < MBAP_HEADER_LENGTH:
+            return None
+
+        length = (self.buffer[self.start + 4] << 8) | self.buffer[self.start + 5]
+        if length < MBAP_MIN_LENGTH or length > MBAP_MAX_LENGTH:
+            raise FrameError("Invalid MBAP length: %d."%(length))
+
+        size = MBAP_HEADER_LENGTH + length
+        if available < size:
+            return None
+
+        frame = self.view[self.start:self.start + size]
+        self.start += size
+        return frame
+
+
+class RtuFrameBuffer(FrameBuffer):
+    # Requests are framed by a server, responses by a client. A frame with a wrong CRC that ends
+    # the received data is returned when passCorrupted is set, for a server that answers it.
+    def __init__(self, size=0x10000, requests=True, passCorrupted=False):
+        FrameBuffer.__init__(self, size, RTU_MAX_FRAME)
+        self.requests = requests
+        self.lengths = RTU_REQUEST_LENGTHS if requests else RTU_RESPONSE_LENGTHS
+        self.counts = RTU_REQUEST_COUNTS if requests else RTU_RESPONSE_COUNTS
+        self.passCorrupted = passCorrupted
+        self.dropped = 0    # Bytes dropped to get back in step.
+
+    # Get the length of the frame from start, -1 if more bytes are needed to know and 0 if the
+    # function is unknown.
+    def FrameLength(self, start):
+        function = self.buffer[start + 1]
+        length = self.lengths.get(function)
+        if length is not None:
+            return length
+        position = self.counts.get(function)
+        if position is not None:
+            if self.end - start <= position:
+                return -1
+            return position + 1 + self.buffer[start + position] + 2
+        if self.requests == False and function & 0x80:
+            return RTU_EXCEPTION_FRAME
+        return 0
+
+    # Get the length of the first frame from start with a correct CRC, 0 if there is none. The
+    # CRC of a frame including its CRC is 0.
+    def ScanLength(self, start):
+        crc = CRC_INIT
+        buffer = self.buffer
+        for i in range(start, min(self.end, start + RTU_MAX_FRAME)):
+            crc = (crc >> 8) ^ CRC_TABLE[(crc ^ buffer[i]) & 0xFF]
+            if crc == 0 and i - start + 1 >= RTU_MIN_FRAME:
+                return i - start + 1
+        return 0
+
+    # Check if a complete frame of a known function with a correct CRC is at start.
+    def KnownFrame(self, start):
+        length = self.FrameLength(start)
+        return length > 0 and start + length <= self.end and VerifyFrame(self.view[start:start + length])
+
+    # Get the next complete frame, or None if more bytes are needed.
+    def NextFrame(self):
+        while True:
+            available = self.end - self.start
+            if available < RTU_MIN_FRAME:
+                return None
+
+            length = self.FrameLength(self.start)
+            if length < 0:
+                return None
+            if length == 0:
+                length = self.ScanLength(self.start)
+                # A frame of an unknown function without a correct CRC is incomplete, corrupted or
+                # noise before a frame of a known function.
+                if length == 0 and available < RTU_MAX_FRAME:
+                    if any(self.KnownFrame(start) for start in range(self.start + 1, self.end - RTU_MIN_FRAME + 1)):
+                        length = -1
+                    elif self.passCorrupted:
+                        length = available
+                    else:
+                        return None
+            if available < length:
+                return None
+
+            if length > 0:
+                frame = self.view[self.start:self.start + length]
+                if VerifyFrame(frame) or (self.passCorrupted and available == length):
+                    self.start += length
+                    return frame
+
+            # Out of step, try the next byte as the start of a frame.
+            self.start += 1
+            self.dropped += 1
+
+    # Drop the bytes of an incomplete frame, after a silence of 3.5 characters on a serial line.
+    def Expire(self):
+        dropped = self.end - self.start
+        self.dropped += dropped
+        self.start = self.end
+        return dropped
@@ -0,0 +1,438 @@
+#!/usr/bin/python3
+
+'''
+Modbus TCP to Modbus RTU gateway, caching and coalescing reads.
+
+Modbus TCP clients connect to the gateway, and their requests are forwarded
+one at a time to Modbus RTU devices on a serial line, or on a TCP connection
+for Modbus RTU over TCP. Many clients polling the same registers of a slow
+device cost one transaction on the line:
+
+    * A read that is already waiting for the line, or on it, is not sent
+      again. Every client reading the same unit, function, start and count
+      gets the response of the one transaction.
+    * The response of a read is kept for a short time (the cache TTL) and
+      repeat reads are answered from it.
+    * A write removes the cached reads of the registers or coils it writes,
+      when it is sent and again when it is answered. Reads of them that are
+      waiting at that time are not cached, and later reads wait for the line.
+
+A request that gets no response in time is answered with exception 0x0B
+(gateway target device failed to respond), and with 0x0A (gateway path
+unavailable) if the line cannot be used. A request to unit 0 is a broadcast
+and is not answered.
+
+Usage:
+    ./modbus_gateway.py <ip> <port> <device | tcp:<host>:<port>> [options]
+
+    Testing with modbus_server.py as the Modbus RTU device:
+    ./modbus_server.py 127.0.0.1 5021 tcp rtu
+    ./modbus_gateway.py 127.0.0.1 5020 tcp:127.0.0.1:5021
+
+    In-process:
+    gateway = ModbusGateway(TcpRtuLink("127.0.0.1", 5021), cacheTtl=0.5)
+    await gateway.Serve("127.0.0.1", 5020)
+'''
+
+import os
+import sys
+import time
+import errno
+import struct
+import signal
+import asyncio
+import collections
+
+from modbus_crc import CalculateCRC
+from modbus_framing import RtuFrameBuffer, FrameError
+from modbus_serial import OpenSerial, WriteSerial, InterFrameTimeout
+from modbus_server import ModbusTcpServer, FUNCTION_BANKS, MBAP_HEADER
+from modbus_options import ParseOptions, ParseSeconds
+
+READ_FUNCTIONS = (0x01, 0x02, 0x03, 0x04)
+SINGLE_WRITE_FUNCTIONS = (0x05, 0x06)   # Write one coil or register, at the start.
+
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_FAILED = 0x0B
+BROADCAST = 0
+
+MAX_CACHE_ENTRIES = 4096    # Cached reads kept, all are dropped when there are more.
+
+RTU_CRC = struct.Struct("<H")
+
+#=== Modbus RTU line ==========================================================
+
+# A Modbus RTU line, with one transaction on it at a time.
+class RtuLink():
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout
+        self.framer = RtuFrameBuffer(requests=False)
+        self.lock = asyncio.Lock()
+        self.waiter = None      # Future of the response of the transaction on the line.
+        self.expected = None    # (unit, function) of the response.
+
+    async def Open(self):
+        # override in sub class.
+        pass
+
+    def Send(self, frame):
+        # override in sub class.
+        pass
+
+    # Take the response of the transaction from the received frames. Other frames,
+    # such as a late response to a transaction that timed out, are dropped.
+    def Received(self):
+        for frame in self.framer.Frames():
+            if self.waiter is not None and self.waiter.done() == False and (frame[0], frame[1] & 0x7F) == self.expected:
+                self.waiter.set_result(bytes(frame))
+
+    # The line was closed, the transaction on it fails.
+    def Lost(self):
+        if self.waiter is not None and self.waiter.done() == False:
+            self.waiter.set_exception(ConnectionError("Modbus RTU line closed."))
+
+    # Send a request frame and get the response frame, None for a broadcast.
+    async def Transact(self, frame):
+        async with self.lock:
+            await self.Open()
+            self.framer.Expire()
+            if frame[0] == BROADCAST:
+                self.Send(frame)
+                return None
+            self.waiter = asyncio.get_running_loop().create_future()
+            self.expected = (frame[0], frame[1])
+            try:
+                self.Send(frame)
+                return await asyncio.wait_for(self.waiter, self.timeout)
+            finally:
+                self.waiter = None
+
+# A serial line. Each request is sent after a silence of 3.5 characters.
+class SerialRtuLink(RtuLink):
+    def __init__(self, device, baudrate, parity="E", timeout=1.0):
+        RtuLink.__init__(self, timeout)
+        self.device = device
+        self.baudrate = baudrate
+        self.parity = parity
+        self.silence = InterFrameTimeout(baudrate)
+        self.fd = None
+
+    async def Open(self):
+        if self.fd is None:
+            self.fd = OpenSerial(self.device, self.baudrate, self.parity)
+            asyncio.get_running_loop().add_reader(self.fd, self.Read)
+        await asyncio.sleep(self.silence)
+
+    def Read(self):
+        try:
+            received = os.readv(self.fd, [self.framer.GetBuffer()])
+        except OSError as exception:
+            # The other end of a pseudo-terminal was closed.
+            if exception.errno != errno.EIO:
+                raise
+            received = 0
+        if received == 0:
+            self.Close()
+            return
+        self.framer.BufferUpdated(received)
+        self.Received()
+
+    def Send(self, frame):
+        WriteSerial(self.fd, frame)
+
+    def Close(self):
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        self.Lost()
+
+class RtuLinkProtocol(asyncio.BufferedProtocol):
+    def __init__(self, link):
+        self.link = link
+
+    def get_buffer(self, sizeHint):
+        return self.link.framer.GetBuffer(sizeHint)
+
+    def buffer_updated(self, received):
+        self.link.framer.BufferUpdated(received)
+        self.link.Received()
+
+    def connection_lost(self, exception):
+        self.link.Lost()
+
+# Modbus RTU over a TCP connection, opened again when it is lost.
+class TcpRtuLink(RtuLink):
+    def __init__(self, host, port, timeout=1.0):
+        RtuLink.__init__(self, timeout)
+        self.host = host
+        self.port = port
+        self.transport = None
+
+    async def Open(self):
+        if self.transport is None or self.transport.is_closing():
+            loop = asyncio.get_running_loop()
+            self.transport, protocol = await asyncio.wait_for(
+                loop.create_connection(lambda: RtuLinkProtocol(self), self.host, self.port), self.timeout)
+
+    def Send(self, frame):
+        self.transport.write(frame)
+
+    def Close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+#=== Cache ====================================================================
+
+# The responses of reads, kept for ttl seconds. The reads of a unit are kept by the bank
+# they read, so a write only checks the reads of its own bank.
+class ReadCache():
+    def __init__(self, ttl, maxEntries=MAX_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.banks = {}     # (unit, bank): {(start, count): (expires, PDU of the response)}
+        self.entries = 0
+
+    # Get the PDU of the response of a read, None if it is not cached.
+    def Get(self, unit, function, start, count):
+        entries = self.banks.get((unit, FUNCTION_BANKS[function]))
+        if entries is None:
+            return None
+        entry = entries.get((start, count))
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del entries[(start, count)]
+            self.entries -= 1
+            return None
+        return entry[1]
+
+    def Put(self, unit, function, start, count, pdu):
+        if self.ttl <= 0:
+            return
+        if self.entries >= self.maxEntries:
+            self.Clear()
+        entries = self.banks.setdefault((unit, FUNCTION_BANKS[function]), {})
+        if (start, count) not in entries:
+            self.entries += 1
+        entries[(start, count)] = (time.monotonic() + self.ttl, pdu)
+
+    # Remove the reads of count registers or coils from start of a bank of a unit, returns how many.
+    def Invalidate(self, unit, bank, start, count):
+        entries = self.banks.get((unit, bank))
+        if entries is None:
+            return 0
+        removed = [key for key in entries if key[0] < start + count and start < key[0] + key[1]]
+        for key in removed:
+            del entries[key]
+        self.entries -= len(removed)
+        return len(removed)
+
+    def Clear(self):
+        self.banks.clear()
+        self.entries = 0
+
+#=== Gateway ==================================================================
+
+# A read on its way to the line, shared by the clients sending the same read.
+class PendingRead():
+    def __init__(self):
+        self.task = None
+        self.stale = False  # Written while the read was on its way, its response is not cached.
+
+# Parses the requests of the Modbus TCP clients and encodes the exception responses
+# like ModbusTcpServer, the other responses come from the Modbus RTU line.
+class ModbusGateway(ModbusTcpServer):
+    def __init__(self, link, cacheTtl=0.5):
+        ModbusTcpServer.__init__(self)
+        self.link = link
+        self.cache = ReadCache(cacheTtl)
+        self.pending = {}   # (unit, function, start, count): PendingRead
+        self.counters = collections.Counter()
+
+    # Get the Modbus TCP response of a request, None if it is not answered.
+    async def Forward(self, frame):
+        request = self.ParseRequest(frame)
+        self.counters["requests"] += 1
+        try:
+            pdu = await self.Transact(request, bytes(frame[7:]))
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            return self.ExceptionResponse(request, GATEWAY_TARGET_FAILED)
+        except (OSError, FrameError):
+            self.counters["unavailable"] += 1
+            return self.ExceptionResponse(request, GATEWAY_PATH_UNAVAILABLE)
+        if pdu is None:
+            return None
+        return MBAP_HEADER.pack(request.tid, request.pid, 1 + len(pdu)) + bytes((request.slaveAddress,)) + pdu
+
+    def ExceptionResponse(self, request, error):
+        buffer = bytearray(9)
+        self.response.CreateNegativeResponse(request, error, buffer)
+        return bytes(buffer)
+
+    # Get the PDU of the response to a request, from the cache, a read on its way or the line.
+    async def Transact(self, request, pdu):
+        unit = request.slaveAddress
+        function = request.function
+        if function in READ_FUNCTIONS and unit != BROADCAST:
+            key = (unit, function, request.start, request.count)
+            cached = self.cache.Get(*key)
+            if cached is not None:
+                self.counters["cached"] += 1
+                return cached
+            read = self.pending.get(key)
+            if read is None:
+                read = PendingRead()
+                read.task = asyncio.ensure_future(self.Read(key, read, pdu))
+                self.pending[key] = read
+            else:
+                self.counters["coalesced"] += 1
+            # A client that goes away does not cancel the read of the others.
+            return await asyncio.shield(read.task)
+
+        bank = FUNCTION_BANKS.get(function)
+        if bank is None or function in READ_FUNCTIONS:
+            return await self.Downstream(unit, pdu)
+        count = 1 if function in SINGLE_WRITE_FUNCTIONS else request.writeCount
+        self.Invalidate(unit, bank, request.writeStart, count)
+        try:
+            return await self.Downstream(unit, pdu)
+        finally:
+            # Reads answered before the write reached the device are not kept either.
+            self.Invalidate(unit, bank, request.writeStart, count)
+
+    async def Read(self, key, read, pdu):
+        try:
+            response = await self.Downstream(key[0], pdu)
+            # Exception responses are not cached.
+            if read.stale == False and response[0] == key[1]:
+                self.cache.Put(*key, response)
+            return response
+        finally:
+            if self.pending.get(key) is read:
+                del self.pending[key]
+
+    # Remove the cached reads of a write, and stop the reads on their way from being cached.
+    def Invalidate(self, unit, bank, start, count):
+        self.counters["invalidated"] += self.cache.Invalidate(unit, bank, start, count)
+        for key, read in list(self.pending.items()):
+            if key[0] == unit and FUNCTION_BANKS[key[1]] == bank and key[2] < start + count and start < key[2] + key[3]:
+                read.stale = True
+                del self.pending[key]
+
+    # Send a PDU to a unit on the Modbus RTU line, returns the PDU of the response.
+    async def Downstream(self, unit, pdu):
+        frame = bytes((unit,)) + pdu
+        self.counters["downstream"] += 1
+        response = await self.link.Transact(frame + RTU_CRC.pack(CalculateCRC(frame)))
+        if response is None:
+            return None
+        return response[1:-2]
+
+    # Get the counters and the amount of cached reads.
+    def Stats(self):
+        stats = dict(self.counters)
+        stats["cache_entries"] = self.cache.entries
+        return stats
+
+    # Serve the Modbus TCP clients until the process is stopped.
+    async def Serve(self, ip, port):
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(lambda: GatewayConnection(self), ip, port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+# A Modbus TCP client of the gateway. Pipelined requests are forwarded at once and
+# answered as their responses arrive, the client matches them by TID.
+class GatewayConnection(asyncio.BufferedProtocol):
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.framer = self.gateway.CreateFramer()
+
+    def get_buffer(self, sizeHint):
+        return self.framer.GetBuffer(sizeHint)
+
+    def buffer_updated(self, received):
+        self.framer.BufferUpdated(received)
+        try:
+            for frame in self.framer.Frames():
+                task = asyncio.ensure_future(self.Answer(bytes(frame)))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except FrameError:
+            self.transport.close()
+
+    async def Answer(self, frame):
+        response = await self.gateway.Forward(frame)
+        if response is not None and self.transport.is_closing() == False:
+            self.transport.write(response)
+
+#=== Main =====================================================================
+
+# The --name=value options and their defaults.
+DEFAULT_OPTIONS = {
+    "baudrate": "19200",
+    "parity": "E",
+    "cache-ttl": "0.5",
+    "timeout": "1.0",
+}
+
+# Run the gateway from the command line arguments, the counters are printed when it stops.
+def Main(args):
+    if len(args) < 4:
+        print("Usage: %s <ip> <port> <device | tcp:<host>:<port>> [options]"%(os.path.basename(args[0])))
+        print("Options:")
+        print("    --baudrate=<N>         Baud rate of the serial line (default 19200)")
+        print("    --parity=<E|O|N>       Parity of the serial line (default E)")
+        print("    --cache-ttl=<seconds>  Time a read response is cached, 0 = no cache (default 0.5)")
+        print("    --timeout=<seconds>    Time to wait for a response from the device (default 1.0)")
+        sys.exit()
+
+    ip = args[1]
+    if args[2].isdigit() == False:
+        print("Invalid port")
+        sys.exit()
+    port = int(args[2])
+    options = ParseOptions(args[4:], DEFAULT_OPTIONS)
+
+    cacheTtl = ParseSeconds(options["cache-ttl"])
+    if cacheTtl is None:
+        print("Invalid cache TTL")
+        sys.exit()
+
+    timeout = ParseSeconds(options["timeout"])
+    if timeout is None or timeout == 0:
+        print("Invalid timeout")
+        sys.exit()
+
+    if args[3].startswith("tcp:"):
+        host, separator, linkPort = args[3][4:].rpartition(":")
+        if separator == "" or linkPort.isdigit() == False:
+            print("Invalid Modbus RTU line: %s"%(args[3]))
+            sys.exit()
+        link = TcpRtuLink(host, int(linkPort), timeout)
+    else:
+        if options["baudrate"].isdigit() == False:
+            print("Invalid baud rate")
+            sys.exit()
+        if options["parity"] not in ("E", "O", "N"):
+            print("Invalid parity")
+            sys.exit()
+        link = SerialRtuLink(args[3], int(options["baudrate"]), options["parity"], timeout)
+
+    gateway = ModbusGateway(link, cacheTtl)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    try:
+        asyncio.run(gateway.Serve(ip, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(gateway.Stats())
+
+if __name__ == "__main__":
+    Main(sys.argv)
@@ -0,0 +1,128 @@
+'''
+Leveled and sampled trace logging for the Modbus server.
+
+The trace of a request (hex dumps of the request and response, validity and
+registers) is only built when the "modbus" logger is enabled for DEBUG and the
+request is picked by the sampler, so it costs one level check when disabled.
+
+Options:
+    * Level: error, warning, info or debug. Request traces are logged at debug.
+    * Sample: Trace every N:th request.
+    * Log file: Write the log to a file instead of the console.
+    * Background: Write the log from a background thread, the serving thread
+      only puts the records on a queue.
+    * Trace file: Write the sampled requests and responses as raw frames to a
+      buffered binary file instead of as hex dumps.
+
+Trace file record format:
+[TIMESTAMP x 8] DIRECTION [LEN LEN] [FRAME ... FRAME]
+    * TIMESTAMP: Seconds since epoch, as a little-endian double.
+    * DIRECTION: 0 = request, 1 = response.
+    * LEN: Length of the frame, little-endian.
+'''
+
+import queue
+import struct
+import atexit
+import logging
+import logging.handlers
+
+LEVELS = {
+    "error": logging.ERROR,
+    "warning": logging.WARNING,
+    "info": logging.INFO,
+    "debug": logging.DEBUG,
+}
+
+REQUEST = 0
+RESPONSE = 1
+
+TRACE_RECORD = struct.Struct("<dBH")
+
+log = logging.getLogger("modbus")
+
+# Format data as hex bytes, 16 bytes per line.
+def HexDump(data):
+    text = bytes(data).hex(" ").upper()
+    # Each byte is three characters including the separator.
+    return "\n".join(text[i:i + 48].rstrip() for i in range(0, len(text), 48))
+
+# Picks every N:th request to trace, when the logger is enabled for DEBUG.
+class Sampler():
+    def __init__(self, sample=1):
+        self.sample = max(1, sample)
+        self.counter = 0
+
+    def Sampled(self):
+        if log.isEnabledFor(logging.DEBUG) == False:
+            return False
+        self.counter += 1
+        return self.counter % self.sample == 0
+
+# Writes frames logged with extra={"frame": data, "direction": ...} as binary records.
+class BinaryTraceHandler(logging.Handler):
+    def __init__(self, path, bufferSize=0x100000):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.file = open(path, "ab", buffering=bufferSize)
+
+    def emit(self, record):
+        frame = getattr(record, "frame", None)
+        if frame is None:
+            return
+        self.file.write(TRACE_RECORD.pack(record.created, getattr(record, "direction", REQUEST), len(frame)))
+        self.file.write(frame)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+        logging.Handler.close(self)
+
+# Shows only records without a raw frame, the frames are for the binary trace.
+class TextFilter(logging.Filter):
+    def filter(self, record):
+        return hasattr(record, "frame") == False
+
+# Read the records of a binary trace file, as (timestamp, direction, frame).
+def ReadTraceFile(path):
+    with open(path, "rb") as file:
+        while True:
+            header = file.read(TRACE_RECORD.size)
+            if len(header) < TRACE_RECORD.size:
+                return
+            timestamp, direction, length = TRACE_RECORD.unpack(header)
+            yield timestamp, direction, file.read(length)
+
+# Set up the "modbus" logger.
+def ConfigureLogging(level="warning", logFile=None, background=False, traceFile=None):
+    handlers = []
+
+    if logFile is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = logging.FileHandler(logFile)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+
+    if traceFile is not None:
+        handler.addFilter(TextFilter())
+        handlers.append(BinaryTraceHandler(traceFile))
+    handlers.append(handler)
+
+    log.setLevel(LEVELS[level])
+    log.propagate = False
+
+    # Registered first, so the handlers are closed after the background thread is stopped.
+    for handler in handlers:
+        atexit.register(handler.close)
+
+    # The serving thread only puts the records on a queue, a background thread writes them.
+    if background:
+        records = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers = [logging.handlers.QueueHandler(records)]
+
+    for handler in handlers:
+        log.addHandler(handler)
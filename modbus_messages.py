@@ -0,0 +1,110 @@
+'''
+Building Modbus TCP requests and decoding their responses, one object at a
+time.
+
+The functions have no side effects, so they can be used in-process instead of
+running ModbusTcpRequest.py and ModbusTcpResponse.py once per frame. The
+decoder of a data type is compiled on first use and kept.
+
+Usage:
+    request = BuildReadRequest(1, 1, 0x03, 10, "f")
+    ...
+    value = DecodeResponse(response, 1, "f")
+
+    A negative response raises ModbusError, a response that is not valid
+    raises ResponseError.
+
+Request format:
+[TID TID] [PID PID] [LEN LEN] ADR FUNC [START START] [COUNT COUNT]
+
+Positive response format:
+[TID TID] [PID PID] [LEN LEN] ADR FUNC COUNT [    DATA   ]
+  00  00    00  00    00  07   00   03    04  01 00 00 90
+
+Negative response format:
+[TID TID] [PID PID] [LEN LEN] ADR FUNC ERROR
+  00  00    00  00    00  03   00   83    02
+
+See modbus_datatypes.py for the data types.
+'''
+
+import struct
+
+from modbus_decode import BlockDecoder
+from modbus_datatypes import ValidDataType, DataTypeRegisterCount
+
+READ_REQUEST = struct.Struct(">HHHBBHH")    # [TID TID] [PID PID] [LEN LEN] ADR FUNC [START START] [COUNT COUNT]
+RESPONSE_HEADER = struct.Struct(">HHHBB")   # [TID TID] [PID PID] [LEN LEN] ADR FUNC
+
+decoders = {}      # Data type: BlockDecoder of one value.
+
+ERROR_MESSAGES = {
+    0x01: "Illegal function.",
+    0x02: "Illegal data address.",
+    0x03: "Illegal data value.",
+    0x04: "Slave device failure.",
+    0x05: "Acknowledge.",
+    0x06: "Slave device busy.",
+    0x07: "Negative acknowledge.",
+    0x08: "Memory parity error.",
+    0x0A: "Gateway path unavailable.",
+    0x0B: "Gateway target device failed to respond.",
+}
+
+# Look up an error message based on the error code.
+def LookupErrorMessage(errorCode):
+    return ERROR_MESSAGES.get(errorCode, "Unknown error code received.")
+
+# A negative response from the device.
+class ModbusError(Exception):
+    def __init__(self, function, errorCode):
+        Exception.__init__(self, "Function %d: %s"%(function, LookupErrorMessage(errorCode)))
+        self.function = function
+        self.errorCode = errorCode
+
+# A response that is not a valid answer to the request.
+class ResponseError(ValueError):
+    pass
+
+# Build a request reading one value of a data type from a register, the PID is 0.
+def BuildReadRequest(tid, unit, function, register, dataType):
+    if tid < 0 or tid > 0xFFFF:
+        raise ValueError("Invalid TID: %d."%(tid))
+    if unit < 0 or unit > 0xFF:
+        raise ValueError("Invalid address: %d."%(unit))
+    if function < 0 or function > 0xFF:
+        raise ValueError("Invalid function: %d."%(function))
+    if register < 0 or register > 0xFFFF:
+        raise ValueError("Invalid register: %d."%(register))
+    return READ_REQUEST.pack(tid, 0, 6, unit, function, register, DataTypeRegisterCount(dataType))
+
+# Decode the value of a data type from the response of a request with a TID.
+def DecodeResponse(response, tid, dataType):
+    decoder = decoders.get(dataType)
+    if decoder is None:
+        if ValidDataType(dataType) == False:
+            raise ValueError("Invalid data type: %s."%(dataType))
+        decoder = BlockDecoder([(0, dataType)])
+        decoders[dataType] = decoder
+
+    if len(response) < 9:
+        raise ResponseError("Invalid response length.")
+
+    TID, PID, LEN, ADR, FUNC = RESPONSE_HEADER.unpack_from(response)
+    if tid != TID:
+        raise ResponseError("TID in response is not equal to TID in request.")
+
+    # Negative response.
+    if FUNC > 0x80:
+        raise ModbusError(FUNC & 0x7F, response[8])
+    elif FUNC == 0x80:
+        raise ResponseError("Unknown response.")
+
+    # Check if the LEN's value is equal to total bytes of (ADR+FUNC+COUNT+DATA).
+    if len(response) - 6 != LEN:
+        raise ResponseError("Response's LEN is not equal to bytes in ADR, FUNC, COUNT and DATA.")
+    # Check if the COUNT value is equal to total bytes of DATA, and to the registers of the data type.
+    if response[8] != len(response) - 9 or response[8] != 2 * decoder.registers:
+        raise ResponseError("Response's COUNT is not equal to bytes in DATA.")
+
+    return decoder.Decode(memoryview(response)[9:])[0]
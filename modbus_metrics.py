@@ -0,0 +1,232 @@
+'''
+Traffic counters and latency histograms of the Modbus server.
+
+Each serving thread counts into its own ThreadMetrics, found through a
+threading.local, so counting takes no lock. The counts of all threads are only
+added together when they are read, by a metrics dump or a diagnostics request.
+Each worker process has its own counters.
+
+Latency is kept per stage of a request: parse, validate, lookup (reading and
+writing the registers), encode and send. Only every LATENCY_SAMPLE:th request
+is timed, reading the clock costs more than the counting. A histogram has four
+buckets per power of two nanoseconds, so a percentile is within 25 %.
+
+Counters:
+    * Requests per unit and function.
+    * Exception responses per error code.
+    * CRC failures of Modbus RTU requests.
+    * Bytes received and sent.
+
+Diagnostics (function 0x08) sub-functions:
+    0x00 Return query data.
+    0x0A Clear counters.
+    0x0B Bus message count: All requests.
+    0x0C Bus communication error count: CRC failures.
+    0x0D Bus exception error count: Exception responses.
+    0x0E Server message count: Requests to a hosted unit.
+    0x0F Server no response count: Requests that are not answered, broadcasts
+         and requests to units that are not hosted on Modbus RTU.
+    0x10 Server NAK count: Exception responses with error code 0x07.
+    0x11 Server busy count: Exception responses with error code 0x06.
+    0x12 Bus character overrun count: Always 0.
+
+Metrics dump format (JSON):
+    {"requests": {"<unit>/<function>": N}, "exceptions": {"<error code>": N},
+     "crc_errors": N, "bytes_in": N, "bytes_out": N, "unit_messages": N, "no_responses": N,
+     "latency": {"<stage>": {"count": N, "p50_us": u, "p99_us": u, "p999_us": u, "max_us": u}}}
+'''
+
+import json
+import threading
+import collections
+
+STAGES = ("parse", "validate", "lookup", "encode", "send")
+PARSE, VALIDATE, LOOKUP, ENCODE, SEND = range(len(STAGES))
+
+HISTOGRAM_BUCKETS = 160     # Up to 2^40 ns, about 18 minutes.
+LATENCY_SAMPLE = 16         # Time every N:th request.
+
+DIAGNOSTIC_QUERY_DATA = 0x00
+DIAGNOSTIC_CLEAR_COUNTERS = 0x0A
+DIAGNOSTIC_COUNTERS = (0x0B, 0x0C, 0x0D, 0x0E, 0x0F, 0x10, 0x11, 0x12)
+
+# Get the histogram bucket of a duration in nanoseconds.
+def BucketIndex(nanoseconds):
+    bits = nanoseconds.bit_length()
+    if bits <= 2:
+        return nanoseconds
+    return min(HISTOGRAM_BUCKETS - 1, (bits - 2) * 4 + ((nanoseconds >> (bits - 3)) & 3))
+
+# Get the highest duration in nanoseconds of a histogram bucket.
+def BucketLimit(index):
+    if index < 4:
+        return index
+    bits = index // 4 + 2
+    return ((4 + index % 4 + 1) << (bits - 3)) - 1
+
+# Counters of one serving thread, only written by that thread.
+class ThreadMetrics():
+    __slots__ = ("requests", "exceptions", "crcErrors", "bytesIn", "bytesOut", "unitMessages", "noResponses", "stages", "ticks", "sendTicks")
+
+    def __init__(self):
+        self.requests = collections.defaultdict(int)    # (unit, function): count
+        self.exceptions = collections.defaultdict(int)  # Error code: count
+        self.crcErrors = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.unitMessages = 0       # Requests to a hosted unit.
+        self.noResponses = 0        # Requests that are not answered.
+        self.stages = [[0] * HISTOGRAM_BUCKETS for stage in STAGES]
+        self.ticks = 0
+        self.sendTicks = 0
+
+    # Count a request and its response, a request that is not answered has sent 0 bytes.
+    def Count(self, request, received, sent, hosted):
+        self.requests[(request.slaveAddress, request.function)] += 1
+        if request.badCrc:
+            self.crcErrors += 1
+        if sent == 0:
+            self.noResponses += 1
+        elif request.valid == False:
+            self.exceptions[request.errorCode] += 1
+        self.unitMessages += hosted
+        self.bytesIn += received
+        self.bytesOut += sent
+
+    # Check if the stages of this request are timed.
+    def Sampled(self):
+        self.ticks += 1
+        return self.ticks % LATENCY_SAMPLE == 0
+
+    # Check if this send is timed.
+    def SendSampled(self):
+        self.sendTicks += 1
+        return self.sendTicks % LATENCY_SAMPLE == 0
+
+    # Add the durations of stages from the clock at the start of the first stage and at the end of
+    # each stage. The end of a stage that was skipped is None.
+    def Record(self, firstStage, stamps):
+        previous = stamps[0]
+        for stage, stamp in enumerate(stamps[1:], firstStage):
+            if stamp is not None:
+                self.stages[stage][BucketIndex(stamp - previous)] += 1
+                previous = stamp
+
+    # Add the counts of other metrics, or subtract them when sign is -1.
+    def Add(self, other, sign=1):
+        for key, count in dict(other.requests).items():
+            self.requests[key] += sign * count
+        for key, count in dict(other.exceptions).items():
+            self.exceptions[key] += sign * count
+        self.crcErrors += sign * other.crcErrors
+        self.bytesIn += sign * other.bytesIn
+        self.bytesOut += sign * other.bytesOut
+        self.unitMessages += sign * other.unitMessages
+        self.noResponses += sign * other.noResponses
+        for histogram, counts in zip(self.stages, other.stages):
+            for index, count in enumerate(list(counts)):
+                histogram[index] += sign * count
+
+class Metrics():
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()    # Only taken to add a thread and to read the totals.
+        self.threads = []               # (thread, metrics) of the threads that have counted.
+        self.retired = ThreadMetrics()  # Counts of threads that have ended.
+        self.cleared = ThreadMetrics()  # Totals when the counters were last cleared.
+
+    # Get the metrics of the current thread.
+    def Local(self):
+        try:
+            return self.local.metrics
+        except AttributeError:
+            metrics = ThreadMetrics()
+            self.local.metrics = metrics
+            # A thread per connection adds a thread per client, so the ended ones are retired here.
+            with self.lock:
+                self.Retire()
+                self.threads.append((threading.current_thread(), metrics))
+            return metrics
+
+    # Add the counts of the threads that have ended to the retired counts, taken with the lock.
+    # They count no more, so their counts are kept once.
+    def Retire(self):
+        alive = []
+        for thread, metrics in self.threads:
+            if thread.is_alive():
+                alive.append((thread, metrics))
+            else:
+                self.retired.Add(metrics)
+        self.threads = alive
+
+    # Add the counts of all threads since the counters were cleared.
+    def Totals(self):
+        with self.lock:
+            self.Retire()
+            totals = ThreadMetrics()
+            totals.Add(self.retired)
+            for thread, metrics in self.threads:
+                totals.Add(metrics)
+            totals.Add(self.cleared, -1)
+            return totals
+
+    # Clear the counters. The threads keep counting, the totals start over from here.
+    def Clear(self):
+        totals = self.Totals()
+        with self.lock:
+            self.cleared.Add(totals)
+
+    # Get a diagnostics (function 0x08) counter, as 16 bits.
+    def DiagnosticCounter(self, subFunction):
+        totals = self.Totals()
+        exceptions = sum(totals.exceptions.values())
+        counters = {
+            0x0B: sum(totals.requests.values()),
+            0x0C: totals.crcErrors,
+            0x0D: exceptions,
+            0x0E: totals.unitMessages,
+            0x0F: totals.noResponses,
+            0x10: totals.exceptions.get(0x07, 0),
+            0x11: totals.exceptions.get(0x06, 0),
+            0x12: 0,
+        }
+        return counters[subFunction] & 0xFFFF
+
+    # Get the totals as a JSON serializable dictionary.
+    def Dump(self):
+        totals = self.Totals()
+        latency = {}
+        for stage, histogram in zip(STAGES, totals.stages):
+            count = sum(histogram)
+            summary = {"count": count}
+            if count > 0:
+                for name, percent in (("p50_us", 50), ("p99_us", 99), ("p999_us", 99.9)):
+                    summary[name] = Percentile(histogram, count, percent) / 1e3
+                summary["max_us"] = BucketLimit(max(i for i, n in enumerate(histogram) if n > 0)) / 1e3
+            latency[stage] = summary
+
+        return {
+            "requests": {"%d/%d"%(unit, function): count for (unit, function), count in sorted(totals.requests.items()) if count != 0},
+            "exceptions": {"0x%02X"%(code): count for code, count in sorted(totals.exceptions.items()) if count != 0},
+            "crc_errors": totals.crcErrors,
+            "bytes_in": totals.bytesIn,
+            "bytes_out": totals.bytesOut,
+            "unit_messages": totals.unitMessages,
+            "no_responses": totals.noResponses,
+            "latency": latency,
+        }
+
+    # Write the dump to a file.
+    def Write(self, path):
+        with open(path, "w") as file:
+            json.dump(self.Dump(), file, indent=4)
+
+# Get the duration in nanoseconds that percent of a histogram is within.
+def Percentile(histogram, count, percent):
+    rank = max(1, int(count * percent / 100 + 0.5))
+    seen = 0
+    for index, n in enumerate(histogram):
+        seen += n
+        if seen >= rank:
+            return BucketLimit(index)
+    return BucketLimit(len(histogram) - 1)
@@ -0,0 +1,26 @@
+'''
+Optional dependencies, imported the first time they are used.
+
+NumPy and PyYAML take longer to import than all of the modbus modules
+together, so the modules do not import them when they are loaded. A module
+gets them here when it needs them, and falls back to plain Python when they
+are not installed.
+
+Usage:
+    numpy = OptionalModule("numpy")
+    if numpy is None:
+        ...
+'''
+
+import importlib
+
+modules = {}    # Name: module, or None when it is not installed.
+
+# Get an optional module, or None when it is not installed.
+def OptionalModule(name):
+    if name not in modules:
+        try:
+            modules[name] = importlib.import_module(name)
+        except ImportError:
+            modules[name] = None
+    return modules[name]
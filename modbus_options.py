@@ -0,0 +1,35 @@
+'''
+Command line options of the server, gateway, replayer and benchmark scripts.
+
+Options are given as --name=value after the positional arguments. Each
+script has its own defaults, which also are the names it accepts. An invalid
+or unknown option is printed and the script exits.
+
+Usage:
+    options = ParseOptions(args[5:], {"workers": "1", "log-file": None})
+    timeout = ParseSeconds(options["timeout"])
+'''
+
+import sys
+
+# Parse --name=value options into a copy of the defaults.
+def ParseOptions(args, defaults):
+    options = dict(defaults)
+    for arg in args:
+        if arg.startswith("--") == False or "=" not in arg:
+            print("Invalid option: %s"%(arg))
+            sys.exit()
+        name, value = arg[2:].split("=", 1)
+        if name not in options:
+            print("Unknown option: %s"%(arg))
+            sys.exit()
+        options[name] = value
+    return options
+
+# Parse a number of seconds, None if it is not valid.
+def ParseSeconds(text):
+    try:
+        seconds = float(text)
+    except ValueError:
+        return None
+    return seconds if seconds >= 0 else None
@@ -0,0 +1,143 @@
+'''
+Overload protection of the Modbus server.
+
+When clients send more requests than the server can answer, the requests wait
+in socket buffers and threads, and the latency of every client grows until
+they time out. With a load guard the server answers the requests it cannot
+take in time with exception 0x06 (slave device busy) without executing them.
+The requests it does execute are answered in time, and the clients know to
+back off instead of waiting for a timeout.
+
+A request is shed when:
+    * Its connection is over the connection limit. The requests of the first
+      receive are answered busy and the connection is closed.
+    * It is past the pipeline limit of requests in one receive of the
+      connection.
+    * It was received more than the deadline ago.
+    * Its client (IP address) is over the rate limit. Each client has a
+      token bucket of rate requests per second, holding up to burst requests.
+    * The in-flight limit of requests executed at once is reached, and no
+      request ends before the deadline. Without a deadline it is shed at once.
+
+With a pipeline limit, one receive reads no more than that many of the
+largest frames. The requests past it wait in the socket buffer of the
+connection, and TCP slows the client down, instead of one client filling the
+server's time with requests that are shed.
+
+Connections without a request for the idle timeout are closed.
+
+The limits are per process, each worker process has its own. A limit of 0 is
+no limit. A serial line has one master and is not guarded.
+
+Usage:
+    guard = LoadGuard(maxConnections=100, rate=50, deadline=0.1)
+    server = ModbusTcpServer(guard=guard)
+'''
+
+import threading
+import collections
+from time import perf_counter_ns
+
+SERVER_BUSY = 0x06      # Exception code of a shed request, slave device busy.
+MAX_CLIENTS = 4096      # Rate limited clients kept, the least recently seen are dropped when there are more.
+
+# A connection or datagram sender, as seen by the guard.
+class ClientState():
+    __slots__ = ("host", "refused", "received", "pipelined")
+
+    def __init__(self, host, refused=False):
+        self.host = host
+        self.refused = refused              # Over the connection limit.
+        self.received = perf_counter_ns()   # Clock of the last receive.
+        self.pipelined = 0                  # Requests of the last receive so far.
+
+    # Mark the start of the requests of a receive.
+    def Received(self):
+        self.received = perf_counter_ns()
+        self.pipelined = 0
+
+class LoadGuard():
+    def __init__(self, maxConnections=0, maxInFlight=0, maxPipeline=0, rate=0, burst=0, idleTimeout=0, deadline=0):
+        self.maxConnections = maxConnections
+        self.maxPipeline = maxPipeline
+        self.rate = rate
+        self.burst = burst if burst > 0 else max(1, rate)
+        self.idleTimeout = idleTimeout
+        self.deadline = int(deadline * 1e9)
+        self.inFlight = threading.BoundedSemaphore(maxInFlight) if maxInFlight > 0 else None
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.buckets = collections.OrderedDict()    # Host: [tokens, clock of the last request], least recently seen first.
+
+    # Get the state of a new connection from a host, refused when over the connection limit.
+    def Connect(self, host):
+        with self.lock:
+            if self.maxConnections > 0 and self.connections >= self.maxConnections:
+                return ClientState(host, True)
+            self.connections += 1
+        return ClientState(host)
+
+    # Get the bytes one receive of a connection reads, None for no limit.
+    def ReadLimit(self, framer):
+        if self.maxPipeline > 0:
+            return self.maxPipeline * framer.maxFrame
+        return None
+
+    def Disconnect(self, client):
+        if client.refused == False:
+            with self.lock:
+                self.connections -= 1
+
+    # Check if a request of a client can be executed, an admitted request is ended with Done().
+    def Admit(self, client):
+        if client.refused:
+            return False
+        client.pipelined += 1
+        if self.maxPipeline > 0 and client.pipelined > self.maxPipeline:
+            return False
+
+        now = perf_counter_ns()
+        if self.deadline > 0 and now - client.received > self.deadline:
+            return False
+        if self.rate > 0 and self.TakeToken(client.host, now) == False:
+            return False
+
+        if self.inFlight is None:
+            return True
+        # A request that cannot start before its deadline is shed.
+        if self.deadline > 0:
+            return self.inFlight.acquire(timeout=(self.deadline - (now - client.received)) / 1e9)
+        return self.inFlight.acquire(blocking=False)
+
+    def Done(self):
+        if self.inFlight is not None:
+            self.inFlight.release()
+
+    # Take a token from the bucket of a host, refilled at the rate since its last request.
+    def TakeToken(self, host, now):
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                self.DropBuckets(now)
+                bucket = [self.burst, now]
+                self.buckets[host] = bucket
+            else:
+                self.buckets.move_to_end(host)
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate / 1e9)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    # Drop the least recently seen buckets that have refilled, they are the same as a new bucket.
+    # When there still are MAX_CLIENTS, the least recently seen bucket is dropped anyway.
+    def DropBuckets(self, now):
+        while len(self.buckets) > 0:
+            tokens, last = next(iter(self.buckets.values()))
+            if tokens + (now - last) * self.rate / 1e9 < self.burst:
+                break
+            self.buckets.popitem(last=False)
+        if len(self.buckets) >= MAX_CLIENTS:
+            self.buckets.popitem(last=False)
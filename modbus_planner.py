@@ -0,0 +1,83 @@
+'''
+Read planner: turns a list of tags into the fewest read requests.
+
+A tag is (unit, function, register, data type), such as (1, 3, 100, "f").
+Tags of the same unit and function are sorted by register and merged into one
+read while the read stays within 125 registers and the gap of unused
+registers between two tags is at most the gap tolerance. Reading a few unused
+registers is often cheaper than another round trip.
+
+Each read keeps a scatter map of where its tags are in the response, compiled
+into a block decoder, so the response data is decoded straight into the
+values of the tags.
+
+Usage:
+    plan = PlanReads(tags, maxGap=4)
+    values = [None] * len(tags)
+    for read in plan:
+        data = ...      # Registers read from read.unit, read.function, read.start, read.count.
+        read.Scatter(data, values)
+'''
+
+from modbus_decode import BlockDecoder
+from modbus_datatypes import ValidDataType, DataTypeRegisterCount
+
+MAX_READ_COUNT = 125
+READ_FUNCTIONS = (0x03, 0x04)
+
+# One planned read request and the tags it reads.
+class PlannedRead():
+    __slots__ = ("unit", "function", "start", "count", "tags", "offsets", "decoder")
+
+    def __init__(self, unit, function, start, count, tags, offsets, dataTypes):
+        self.unit = unit
+        self.function = function
+        self.start = start
+        self.count = count
+        self.tags = tags            # Index of each tag in the tag list.
+        self.offsets = offsets      # Register offset of each tag in the response data.
+        self.decoder = BlockDecoder(zip(offsets, dataTypes))
+
+    # Decode the response data into the values of the tags, by tag index.
+    def Scatter(self, data, values):
+        for tag, value in zip(self.tags, self.decoder.Decode(data)):
+            values[tag] = value
+
+    def __repr__(self):
+        return "PlannedRead(unit=%d, function=%d, start=%d, count=%d, tags=%d)"%(self.unit, self.function, self.start, self.count, len(self.tags))
+
+# Plan the reads of a list of (unit, function, register, data type) tags.
+def PlanReads(tags, maxGap=0, maxCount=MAX_READ_COUNT):
+    entries = []
+    for index, (unit, function, register, dataType) in enumerate(tags):
+        if function not in READ_FUNCTIONS:
+            raise ValueError("Tag %d: Not a read function: %d."%(index, function))
+        if ValidDataType(dataType) == False:
+            raise ValueError("Tag %d: Invalid data type: %s."%(index, dataType))
+        count = DataTypeRegisterCount(dataType)
+        if count > maxCount or register + count > 0x10000:
+            raise ValueError("Tag %d: Registers %d to %d can not be read in one request."%(index, register, register + count - 1))
+        entries.append((unit, function, register, count, index, dataType))
+    entries.sort()
+
+    plan = []
+    current = None
+    for unit, function, register, count, index, dataType in entries:
+        end = register + count
+
+        # Merge with the current read if it is the same device and the merged read is small enough.
+        if current is not None and current[0] == unit and current[1] == function and register <= current[3] + maxGap and max(end, current[3]) - current[2] <= maxCount:
+            current[3] = max(end, current[3])
+            current[4].append(index)
+            current[5].append(register - current[2])
+            current[6].append(dataType)
+            continue
+
+        if current is not None:
+            plan.append(PlannedRead(current[0], current[1], current[2], current[3] - current[2], current[4], current[5], current[6]))
+        # Unit, function, start, end, tags, offsets, data types.
+        current = [unit, function, register, end, [index], [0], [dataType]]
+
+    if current is not None:
+        plan.append(PlannedRead(current[0], current[1], current[2], current[3] - current[2], current[4], current[5], current[6]))
+    return plan
@@ -0,0 +1,357 @@
+#!/usr/bin/python3
+
+'''
+Recording the traffic of modbus_server.py and replaying it against a server.
+
+The recorder appends every request and its response, as answered by
+ModbusServer.ExecuteInto(), with a timestamp to a recording file. The records
+are packed into a buffer in memory and written when the buffer is full, so
+recording costs one lock and three copies per request. Unlike the trace file,
+every request is recorded whatever the log level.
+
+The replayer maps the recording and streams it to a server over TCP, so a
+recording of any size is read page by page and never loaded as a whole. The
+requests are sent at their recorded times, speed times faster, or as fast as
+the server answers. Up to window requests are sent before their responses are
+received, and requests that are due together are sent at once. Each response
+is compared byte for byte with the recorded one.
+
+A recording of a UDP or serial line server is replayed over TCP, the frames
+of the data protocol are the same.
+
+Usage:
+    ./modbus_server.py 127.0.0.1 5020 tcp tcp --record-file=traffic.rec
+    ./modbus_recording.py 127.0.0.1 5020 traffic.rec --speed=10 --window=8
+
+    In-process:
+    server = ModbusTcpServer(recorder=TrafficRecorder("traffic.rec", "tcp"))
+    result = Replay("traffic.rec", "127.0.0.1", 5020, speed=0)
+
+Recording format:
+[MAGIC x 4] [VERSION x 2] PROTOCOL [RESERVED]
+Records: [TIMESTAMP x 8] [REQUEST LEN x 2] [RESPONSE LEN x 2] [REQUEST ... REQUEST] [RESPONSE ... RESPONSE]
+    * MAGIC: MBRC.
+    * PROTOCOL: 0 = Modbus TCP, 1 = Modbus RTU.
+    * TIMESTAMP: Nanoseconds since epoch.
+    * The header and lengths are little-endian, the frames as sent.
+'''
+
+import os
+import sys
+import mmap
+import time
+import queue
+import socket
+import struct
+import threading
+
+from modbus_log import HexDump
+from modbus_framing import MbapFrameBuffer, RtuFrameBuffer, FrameError
+from modbus_metrics import HISTOGRAM_BUCKETS, BucketIndex, Percentile
+from modbus_options import ParseOptions, ParseSeconds
+
+RECORDING_MAGIC = b"MBRC"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<4sHBx")
+RECORD = struct.Struct("<QHH")
+
+PROTOCOLS = ("tcp", "rtu")
+
+RECORD_BUFFER = 0x100000    # Bytes of records kept in memory before they are written.
+SEND_BATCH = 0x10000        # Bytes of requests sent at once, at most.
+MIN_SLEEP = 0.0005          # Seconds to a request before the sender sleeps instead of sending it.
+
+#=== Recorder =================================================================
+
+# Appends the requests and responses of a server to a recording file.
+class TrafficRecorder():
+    def __init__(self, path, dataProtocol="tcp", bufferSize=RECORD_BUFFER):
+        if dataProtocol not in PROTOCOLS:
+            raise ValueError("Invalid data protocol: %s."%(dataProtocol))
+        self.path = path
+        self.bufferSize = bufferSize
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.records = 0
+
+        # A record cut short when the last recording stopped is removed, so new records follow a whole one.
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            protocol, end = ScanRecording(path)
+            if protocol != dataProtocol:
+                raise ValueError("Recording %s is of Modbus %s, not Modbus %s."%(path, protocol.upper(), dataProtocol.upper()))
+            os.truncate(path, end)
+        self.file = open(path, "ab", buffering=0)
+        if self.file.tell() == 0:
+            self.file.write(RECORDING_HEADER.pack(RECORDING_MAGIC, RECORDING_VERSION, PROTOCOLS.index(dataProtocol)))
+
+    # Add a request and its response, written when the buffer is full.
+    def Record(self, request, response):
+        header = RECORD.pack(time.time_ns(), len(request), len(response))
+        with self.lock:
+            buffer = self.buffer
+            buffer += header
+            buffer += request
+            buffer += response
+            self.records += 1
+            if len(buffer) >= self.bufferSize:
+                self.file.write(buffer)
+                buffer.clear()
+
+    def Flush(self):
+        with self.lock:
+            if len(self.buffer) > 0:
+                self.file.write(self.buffer)
+                self.buffer.clear()
+
+    def Close(self):
+        self.Flush()
+        self.file.close()
+
+#=== Reading ==================================================================
+
+# Map a recording and check its header, returns (data protocol, mapping). The
+# records are read from RECORDING_HEADER.size on.
+def MapRecording(path):
+    with open(path, "rb") as file:
+        header = file.read(RECORDING_HEADER.size)
+        if len(header) < RECORDING_HEADER.size:
+            raise ValueError("Recording %s has no header."%(path))
+        magic, version, protocol = RECORDING_HEADER.unpack(header)
+        if magic != RECORDING_MAGIC:
+            raise ValueError("%s is not a recording."%(path))
+        if version != RECORDING_VERSION:
+            raise ValueError("Recording %s has version %d, expected %d."%(path, version, RECORDING_VERSION))
+        if protocol >= len(PROTOCOLS):
+            raise ValueError("Recording %s has an unknown data protocol: %d."%(path, protocol))
+        memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    # The records are read once from the front to the back.
+    if hasattr(memory, "madvise"):
+        memory.madvise(mmap.MADV_SEQUENTIAL)
+    return PROTOCOLS[protocol], memory
+
+# Read the (timestamp, request, response) records of a mapped recording. The frames are views
+# of the mapping. A record cut short at the end is skipped, and counted in errors.
+def ReadRecords(memory, errors=None):
+    view = memoryview(memory)
+    size = len(memory)
+    position = RECORDING_HEADER.size
+    while position + RECORD.size <= size:
+        timestamp, requestLength, responseLength = RECORD.unpack_from(memory, position)
+        start = position + RECORD.size
+        end = start + requestLength + responseLength
+        if end > size:
+            break
+        yield timestamp, view[start:start + requestLength], view[start + requestLength:end]
+        position = end
+    if position < size and errors is not None:
+        errors["truncated"] += 1
+
+# Get the data protocol of a recording and the end of its last whole record.
+def ScanRecording(path):
+    protocol, memory = MapRecording(path)
+    with memory:
+        position = RECORDING_HEADER.size
+        while position + RECORD.size <= len(memory):
+            timestamp, requestLength, responseLength = RECORD.unpack_from(memory, position)
+            end = position + RECORD.size + requestLength + responseLength
+            if end > len(memory):
+                break
+            position = end
+    return protocol, position
+
+#=== Replayer =================================================================
+
+# The outcome of a replay.
+class ReplayResult():
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.mismatches = 0
+        self.samples = []       # (record number, expected, received) of the first mismatches.
+        self.error = None       # Why the replay stopped early.
+        self.seconds = 0.0
+        self.maxLag = 0         # Nanoseconds the latest request was sent after its time.
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def __str__(self):
+        lines = ["Requests: %d, responses: %d, mismatches: %d"%(self.requests, self.responses, self.mismatches)]
+        if self.seconds > 0:
+            lines.append("Seconds: %.3f, requests per second: %.0f"%(self.seconds, self.requests / self.seconds))
+        if self.responses > 0:
+            lines.append("Latency p50: %.0f us, p99: %.0f us, p999: %.0f us, max lag: %.0f us"%(
+                Percentile(self.histogram, self.responses, 50) / 1000, Percentile(self.histogram, self.responses, 99) / 1000,
+                Percentile(self.histogram, self.responses, 99.9) / 1000, self.maxLag / 1000))
+        for number, expected, received in self.samples:
+            lines.append("Record %d, expected:\n%s\nReceived:\n%s"%(number, HexDump(expected), HexDump(received)))
+        if self.error is not None:
+            lines.append("Stopped: %s"%(self.error))
+        return "\n".join(lines)
+
+# Sends the requests of a recording on one connection and checks the responses in order.
+class Replayer():
+    def __init__(self, path, ip, port, speed=1.0, window=1, timeout=3.0, samples=10):
+        if speed < 0:
+            raise ValueError("Invalid speed: %s."%(speed))
+        if window < 1:
+            raise ValueError("Invalid window: %s."%(window))
+        self.protocol, self.memory = MapRecording(path)
+        self.address = (ip, port)
+        self.speed = speed      # 0 = as fast as the server answers.
+        self.timeout = timeout
+        self.maxSamples = samples
+        self.window = threading.BoundedSemaphore(window)
+        self.expected = queue.SimpleQueue()    # (record number, send time, response) in send order, None at the end.
+        self.stopped = threading.Event()
+        self.result = ReplayResult()
+
+    def Run(self):
+        self.sock = socket.create_connection(self.address, self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sender = threading.Thread(target=self.Send, daemon=True)
+        start = time.perf_counter()
+        try:
+            sender.start()
+            self.Receive()
+        except (OSError, FrameError) as exception:
+            self.result.error = str(exception) or type(exception).__name__
+        finally:
+            self.stopped.set()
+            self.sock.close()
+            sender.join()
+            self.memory.close()
+        self.result.seconds = time.perf_counter() - start
+        return self.result
+
+    # Send the requests at their times, as a batch when several are due.
+    def Send(self):
+        batch = bytearray()
+        first = None
+        try:
+            for number, (timestamp, request, response) in enumerate(ReadRecords(self.memory)):
+                if self.speed > 0:
+                    if first is None:
+                        first = (timestamp, time.perf_counter_ns())
+                    due = first[1] + int((timestamp - first[0]) / self.speed)
+                    delay = due - time.perf_counter_ns()
+                    if delay > MIN_SLEEP * 1e9:
+                        self.Flush(batch)
+                        time.sleep(delay / 1e9)
+                    elif delay < 0:
+                        self.result.maxLag = max(self.result.maxLag, -delay)
+
+                # A request that was answered with nothing gets no response.
+                if len(response) > 0 and self.window.acquire(blocking=False) == False:
+                    self.Flush(batch)
+                    while self.window.acquire(timeout=0.1) == False:
+                        if self.stopped.is_set():
+                            return
+                if self.stopped.is_set():
+                    return
+
+                if len(response) > 0:
+                    self.expected.put((number, time.perf_counter_ns(), response))
+                batch += request
+                self.result.requests += 1
+                if len(batch) >= SEND_BATCH:
+                    self.Flush(batch)
+            self.Flush(batch)
+        except OSError:
+            pass
+        finally:
+            self.expected.put(None)
+
+    def Flush(self, batch):
+        if len(batch) > 0:
+            self.sock.sendall(batch)
+            batch.clear()
+
+    # Match the responses to the requests in order.
+    def Receive(self):
+        framer = MbapFrameBuffer() if self.protocol == "tcp" else RtuFrameBuffer(requests=False)
+        frames = self.ReceiveFrames(framer)
+        result = self.result
+        while True:
+            item = self.expected.get()
+            if item is None:
+                return
+            number, sent, expected = item
+            received = next(frames)
+            result.histogram[BucketIndex(time.perf_counter_ns() - sent)] += 1
+            result.responses += 1
+            if received != expected:
+                result.mismatches += 1
+                if len(result.samples) < self.maxSamples:
+                    result.samples.append((number, bytes(expected), bytes(received)))
+            self.window.release()
+
+    # Get the frames received on the connection, receiving when there are no more.
+    def ReceiveFrames(self, framer):
+        while True:
+            n = self.sock.recv_into(framer.GetBuffer())
+            if n == 0:
+                raise ConnectionError("The server closed the connection.")
+            framer.BufferUpdated(n)
+            yield from framer.Frames()
+
+# Replay a recording against a server, speed = 0 sends as fast as the server answers.
+def Replay(path, ip, port, speed=1.0, window=1, timeout=3.0, samples=10):
+    return Replayer(path, ip, port, speed, window, timeout, samples).Run()
+
+#=== Main =====================================================================
+
+# The --name=value options and their defaults.
+DEFAULT_OPTIONS = {
+    "speed": "1",
+    "window": "1",
+    "timeout": "3.0",
+    "samples": "10",
+}
+
+# Replay a recording from the command line arguments and print the result.
+def Main(args):
+    if len(args) < 4:
+        print("Usage: %s <ip> <port> <recording> [options]"%(os.path.basename(args[0])))
+        print("Options:")
+        print("    --speed=<N | max>      Send N times faster than recorded, max = as fast as answered (default 1)")
+        print("    --window=<N>           Requests sent before their responses are received (default 1)")
+        print("    --timeout=<seconds>    Time to wait for a response (default 3.0)")
+        print("    --samples=<N>          Mismatching responses to print (default 10)")
+        sys.exit()
+
+    ip = args[1]
+    if args[2].isdigit() == False:
+        print("Invalid port")
+        sys.exit()
+    port = int(args[2])
+    options = ParseOptions(args[4:], DEFAULT_OPTIONS)
+
+    if options["speed"] == "max":
+        speed = 0.0
+    else:
+        try:
+            speed = float(options["speed"])
+        except ValueError:
+            speed = 0.0
+        if speed <= 0:
+            print("Invalid speed")
+            sys.exit()
+    if options["window"].isdigit() == False or int(options["window"]) < 1:
+        print("Invalid window")
+        sys.exit()
+    timeout = ParseSeconds(options["timeout"])
+    if timeout is None or timeout == 0:
+        print("Invalid timeout")
+        sys.exit()
+    if options["samples"].isdigit() == False:
+        print("Invalid samples")
+        sys.exit()
+
+    try:
+        replayer = Replayer(args[3], ip, port, speed, int(options["window"]), timeout, int(options["samples"]))
+    except (OSError, ValueError) as exception:
+        print("Invalid recording: %s"%(exception))
+        sys.exit()
+    print(replayer.Run())
+
+if __name__ == "__main__":
+    Main(sys.argv)
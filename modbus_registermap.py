@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+
+'''
+Register maps: the units and registers of the server, declared in a file and
+compiled into a snapshot that is mapped at start.
+
+A map lists points: a unit, a table, an address, a data type with its byte
+order, and an initial value. The first time a map is loaded it is compiled
+into a snapshot next to it, holding the registers of each bank as they are
+served, with an index of the banks and the SHA-256 of the map. Later starts
+map the snapshot instead of building the banks point by point, and the pages
+are only read when a request reads them. A snapshot whose hash or version is
+not the map's is compiled again.
+
+The banks of a snapshot are mapped copy-on-write and shared by the units of
+the map like the banks of a template: a unit copies a bank the first time it
+writes to it, and the snapshot is never written by the server.
+
+Map format (CSV, with a header naming the columns in any order):
+    unit,table,address,type,order,value,name
+    1,holding,0,f,ABCD,21.5,Temperature
+    1,holding,2,s8,BADC,PUMP-01,Tag
+    1,coil,0,,,1,Pump running
+
+Map format (JSON, or YAML with PyYAML installed):
+    {"points": [
+        {"unit": 1, "table": "holding", "address": 0, "type": "f", "value": 21.5},
+        {"unit": 1, "table": "coil", "address": 0, "value": true}
+    ]}
+
+Point fields:
+    * unit: Slave address (default 1).
+    * table: coil, discrete, holding or input, or the read function 1-4 (default holding).
+    * address: First register or bit, the only field needed.
+    * type: Data type of modbus_datatypes.py (default H). Coils and discrete inputs are bits.
+    * order: Byte order of the value, A is the highest byte (default ABCD):
+      ABCD = big-endian, CDAB = word swapped, BADC = byte swapped, DCBA = little-endian.
+    * value: Initial value (default 0). Other fields, such as name, are ignored.
+
+Every unit of a map has all four tables, the registers without a point are 0.
+
+Snapshot layout (header little-endian, registers big-endian):
+[MAGIC x 4] [VERSION x 2] [BANKS x 2] [HASH x 32]
+BANKS x ( UNIT FUNCTION [RESERVED x 2] [REGISTERS x 4] [OFFSET x 8] )
+Banks at their offsets: [SEQUENCE x 8] [REG 0 HI] [REG 0 LO] ... [REG REGISTERS-1 HI] [REG REGISTERS-1 LO]
+
+Usage:
+    units = LoadRegisterMap("plant.csv")    # Unit: {function: bank}, compiled to plant.csv.snapshot.
+
+    ./modbus_registermap.py <map> [snapshot]  Compile a map, if its snapshot is stale.
+'''
+
+import os
+import sys
+import csv
+import json
+import mmap
+import struct
+import hashlib
+import threading
+
+from modbus_optional import OptionalModule
+from modbus_registers import SharedRegisterBank, BitBank, REGISTER_COUNT, BIT_COUNT, SHARED_HEADER, REGISTER_FILE_ENTRY, MAX_UNIT
+from modbus_datatypes import DATA_TYPES, BYTE_TYPES, ValidDataType, WordSwapped, StringLength, DataTypeRegisterCount
+
+SNAPSHOT_MAGIC = b"MBSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHH32s")     # MAGIC VERSION BANKS HASH
+
+TABLES = {"coil": 0x01, "discrete": 0x02, "holding": 0x03, "input": 0x04}
+BIT_FUNCTIONS = (0x01, 0x02)
+ORDERS = ("ABCD", "CDAB", "BADC", "DCBA")
+
+#=== Map files ================================================================
+
+# Read the points of a map, as dicts of field: value, with where each point is in the file.
+def ReadMapPoints(path, content):
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".csv":
+        rows = csv.DictReader(content.decode("utf-8").splitlines())
+        if rows.fieldnames is None or "address" not in [name.strip() for name in rows.fieldnames]:
+            raise ValueError("Register map %s has no address column."%(path))
+        points = []
+        for row in rows:
+            point = {name.strip(): value.strip() for name, value in row.items() if name is not None and value is not None}
+            if all(value == "" for value in point.values()) or list(point.values())[0].startswith("#"):
+                continue
+            points.append((point, "%s line %d"%(path, rows.line_num)))
+        return points
+
+    if extension == ".json":
+        document = json.loads(content)
+    elif extension == ".yaml" or extension == ".yml":
+        yaml = OptionalModule("yaml")
+        if yaml is None:
+            raise ValueError("Register map %s: YAML maps need PyYAML."%(path))
+        document = yaml.safe_load(content)
+    else:
+        raise ValueError("Register map %s: Unknown format, expected .csv, .json, .yaml or .yml."%(path))
+
+    if isinstance(document, dict):
+        document = document.get("points")
+    if isinstance(document, list) == False or any(isinstance(point, dict) == False for point in document):
+        raise ValueError("Register map %s: Expected a list of points."%(path))
+    return [(point, "%s point %d"%(path, number)) for number, point in enumerate(document, 1)]
+
+# Get a field of a point, or the default if it is missing or empty.
+def Field(point, name, default):
+    value = point.get(name)
+    if value is None or value == "":
+        return default
+    return value
+
+def ParseInteger(value):
+    if isinstance(value, bool) or (isinstance(value, float) and value.is_integer() == False):
+        raise ValueError("Not an integer: %s"%(value))
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(value)
+    except ValueError:
+        return int(value, 0)    # Such as 0xDEAD.
+
+def ParseBool(value):
+    if isinstance(value, (bool, int)) and value in (0, 1):
+        return bool(value)
+    text = str(value).lower()
+    if text in ("1", "true", "on", "yes"):
+        return True
+    if text in ("0", "false", "off", "no"):
+        return False
+    raise ValueError("Not a bit: %s"%(value))
+
+# Check a point and get it as (unit, function, address, data type, order, value).
+def ParsePoint(point, where):
+    table = str(Field(point, "table", "holding")).lower()
+    function = TABLES.get(table, int(table) if table.isdigit() else None)
+    if function not in TABLES.values():
+        raise ValueError("%s: Invalid table: %s."%(where, table))
+    try:
+        unit = ParseInteger(Field(point, "unit", 1))
+        address = ParseInteger(Field(point, "address", None))
+    except (TypeError, ValueError):
+        raise ValueError("%s: Invalid unit or address."%(where))
+    if unit < 1 or unit > MAX_UNIT:
+        raise ValueError("%s: Invalid unit: %d."%(where, unit))
+
+    if function in BIT_FUNCTIONS:
+        dataType = str(Field(point, "type", "?"))
+        if dataType != "?":
+            raise ValueError("%s: Coils and discrete inputs are bits, not %s."%(where, dataType))
+        if address < 0 or address >= BIT_COUNT:
+            raise ValueError("%s: Invalid address: %d."%(where, address))
+        try:
+            return unit, function, address, dataType, "ABCD", ParseBool(Field(point, "value", 0))
+        except ValueError as exception:
+            raise ValueError("%s: %s."%(where, exception))
+
+    dataType = str(Field(point, "type", "H"))
+    order = str(Field(point, "order", "ABCD")).upper()
+    if ValidDataType(dataType) == False:
+        raise ValueError("%s: Invalid data type: %s."%(where, dataType))
+    if order not in ORDERS:
+        raise ValueError("%s: Invalid order: %s, expected one of %s."%(where, order, ", ".join(ORDERS)))
+    if WordSwapped(dataType) and order != "ABCD":
+        raise ValueError("%s: Data type %s is already word swapped, the order must be ABCD."%(where, dataType))
+    if address < 0 or address + DataTypeRegisterCount(dataType) > REGISTER_COUNT:
+        raise ValueError("%s: Invalid address: %d."%(where, address))
+
+    value = Field(point, "value", "" if StringLength(dataType) > 0 else 0)
+    try:
+        if StringLength(dataType) > 0:
+            value = str(value)
+        elif DATA_TYPES[dataType[0]][1] in ("f", "d"):
+            value = float(value)
+        elif dataType == "?":
+            value = int(ParseBool(value))
+        else:
+            value = ParseInteger(value)
+        return unit, function, address, dataType, order, EncodePoint(dataType, order, value)
+    except (ValueError, UnicodeError, struct.error) as exception:
+        raise ValueError("%s: Invalid value of data type %s: %s."%(where, dataType, exception))
+
+#=== Compiling ================================================================
+
+# Encode the value of a point as its registers, in the byte order of the point.
+def EncodePoint(dataType, order, value):
+    length = StringLength(dataType)
+    if length > 0:
+        data = value.encode("ascii")
+        if len(data) > length:
+            raise ValueError("Longer than %d characters"%(length))
+        data = data.ljust(2 * DataTypeRegisterCount(dataType), b"\x00")
+    elif dataType in BYTE_TYPES:
+        struct.pack(dataType, value)    # Checks the range of the byte.
+        data = struct.pack(">h" if dataType == "b" else ">H", value)
+    else:
+        data = struct.pack(">" + DATA_TYPES[dataType[0]][1], value)
+        if WordSwapped(dataType):
+            order = "CDAB"
+
+    if order == "BADC" or order == "DCBA":
+        swapped = bytearray(len(data))
+        swapped[0::2] = data[1::2]
+        swapped[1::2] = data[0::2]
+        data = bytes(swapped)
+    if order == "CDAB" or order == "DCBA":
+        data = b"".join(data[i:i + 2] for i in range(len(data) - 2, -1, -2))
+    return data
+
+# Get the bytes of the four banks of each unit of the points, as {(unit, function): bytearray}.
+def CompileRegisterMap(points):
+    banks = {}
+    spans = {}      # (unit, function): list of (first, end, where) of the points.
+    for point, where in points:
+        unit, function, address, dataType, order, value = ParsePoint(point, where)
+        if (unit, 0x01) not in banks:
+            for bankFunction in sorted(TABLES.values()):
+                size = (BIT_COUNT + 15) // 16 if bankFunction in BIT_FUNCTIONS else REGISTER_COUNT
+                banks[(unit, bankFunction)] = bytearray(2 * size)
+                spans[(unit, bankFunction)] = []
+
+        data = banks[(unit, function)]
+        if function in BIT_FUNCTIONS:
+            spans[(unit, function)].append((address, address + 1, where))
+            if value:
+                data[address >> 3] |= 1 << (address & 7)
+        else:
+            spans[(unit, function)].append((address, address + len(value) // 2, where))
+            data[2 * address:2 * address + len(value)] = value
+
+    for (unit, function), bankSpans in spans.items():
+        bankSpans.sort()
+        for (first, end, where), (nextFirst, nextEnd, nextWhere) in zip(bankSpans, bankSpans[1:]):
+            if nextFirst < end:
+                raise ValueError("%s: Address %d of unit %d overlaps %s."%(nextWhere, nextFirst, unit, where))
+    return banks
+
+#=== Snapshots ================================================================
+
+# A bank of a snapshot, mapped copy-on-write. It is only read, the units copy it to write.
+class SnapshotRegisterBank(SharedRegisterBank):
+    def __init__(self, memory, offset, size):
+        SharedRegisterBank.__init__(self, size, memory, threading.Lock(), offset)
+
+    # The mapping is private to the process, so worker processes get a copy in shared memory.
+    def Shared(self):
+        return SharedRegisterBank.FromBank(self)
+
+# Write the banks of a compiled map to a snapshot, with the hash of the map.
+def WriteSnapshot(path, digest, banks):
+    keys = sorted(banks)
+    offset = SNAPSHOT_HEADER.size + len(keys) * REGISTER_FILE_ENTRY.size
+    entries = []
+    for unit, function in keys:
+        offset = (offset + 7) & ~7
+        entries.append((unit, function, len(banks[(unit, function)]) // 2, offset))
+        offset += SHARED_HEADER + len(banks[(unit, function)])
+
+    # Written to a temporary file first, so a server never maps a half written snapshot.
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(keys), digest))
+        for entry in entries:
+            file.write(REGISTER_FILE_ENTRY.pack(*entry))
+        for unit, function, size, offset in entries:
+            file.seek(offset)
+            file.write(struct.pack("<Q", 0))
+            file.write(banks[(unit, function)])
+    os.replace(temporary, path)
+
+# Get the hash of the map a snapshot was compiled from, None if it is missing or of another version.
+def SnapshotHash(path):
+    try:
+        with open(path, "rb") as file:
+            header = file.read(SNAPSHOT_HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) < SNAPSHOT_HEADER.size:
+        return None
+    magic, version, count, digest = SNAPSHOT_HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    return digest
+
+# Map the banks of a snapshot, returns {unit: {function: bank}}.
+def OpenSnapshot(path):
+    with open(path, "rb") as file:
+        memory = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+    magic, version, count, digest = SNAPSHOT_HEADER.unpack_from(memory)
+
+    units = {}
+    for i in range(count):
+        unit, function, size, offset = REGISTER_FILE_ENTRY.unpack_from(memory, SNAPSHOT_HEADER.size + i * REGISTER_FILE_ENTRY.size)
+        if offset % 8 != 0 or offset + SHARED_HEADER + 2 * size > len(memory):
+            raise ValueError("Snapshot %s: Bank of function %d of unit %d is outside the file."%(path, function, unit))
+        bank = SnapshotRegisterBank(memory, offset, size)
+        if function in BIT_FUNCTIONS:
+            bank = BitBank(BIT_COUNT, bank)
+        units.setdefault(unit, {})[function] = bank
+    return units
+
+# Compile a map to its snapshot if the snapshot is stale, returns True if it was compiled.
+def CompileSnapshot(path, snapshotPath=None):
+    with open(path, "rb") as file:
+        content = file.read()
+    digest = hashlib.sha256(content).digest()
+    if SnapshotHash(snapshotPath or path + ".snapshot") == digest:
+        return False
+    WriteSnapshot(snapshotPath or path + ".snapshot", digest, CompileRegisterMap(ReadMapPoints(path, content)))
+    return True
+
+# Load the units of a map from its snapshot, compiled first if it is stale. Returns {unit: {function: bank}}.
+def LoadRegisterMap(path, snapshotPath=None):
+    CompileSnapshot(path, snapshotPath)
+    return OpenSnapshot(snapshotPath or path + ".snapshot")
+
+#=== Main =====================================================================
+
+def Main(args):
+    if len(args) < 2:
+        print("Usage: %s <map> [snapshot]"%(os.path.basename(args[0])))
+        sys.exit()
+
+    snapshotPath = args[2] if len(args) > 2 else args[1] + ".snapshot"
+    try:
+        compiled = CompileSnapshot(args[1], snapshotPath)
+        units = OpenSnapshot(snapshotPath)
+    except (OSError, ValueError) as exception:
+        print("Invalid register map: %s"%(exception))
+        sys.exit()
+    print("%s %s, units: %s"%("Compiled" if compiled else "Up to date:", snapshotPath, ",".join(str(unit) for unit in sorted(units))))
+
+if __name__ == "__main__":
+    Main(sys.argv)
@@ -0,0 +1,498 @@
+'''
+Register bank backed by one contiguous buffer.
+
+Every register is stored as two bytes in Modbus byte order (big-endian), so a
+read of any start and count is a single slice of the buffer, without decoding
+the registers.
+
+Writes are guarded by a sequence lock. A writer makes the sequence uneven
+while it writes and even again when done. A reader copies its slice and
+retries if the sequence was uneven or changed during the copy. Readers never
+wait for a lock and never see a half written multi-register value, such as an
+INT64 or REAL64 written by another connection.
+
+Units (slave addresses) are looked up in a table indexed by the address. A
+unit loads its banks from its template on first access, and units of the same
+template share the template's banks until the unit writes to one of them.
+
+Worker processes share the registers by moving the banks to shared memory
+before the workers are forked.
+
+The banks can instead be mapped from a register file, which outlives the
+server and can be written in place by other processes, such as a plant
+simulation, with the same sequence lock. See the register file section.
+
+Coils and discrete inputs are kept in bit banks, packed eight to a byte in
+the order of a Modbus response: the first bit is the lowest bit of the first
+byte. A read or write that does not start on a byte is shifted as one integer
+instead of bit by bit. The packed bytes are stored in a register bank, so bit
+banks are shared and mapped from a register file like the registers.
+
+Register layout:
+[REG 0 HI] [REG 0 LO] [REG 1 HI] [REG 1 LO] ... [REG size-1 HI] [REG size-1 LO]
+
+Bit layout (bit 0 is the lowest bit of a byte):
+[BITS 0-7] [BITS 8-15] ... [BITS size-8 - size-1]
+'''
+
+import os
+import mmap
+import time
+import struct
+import threading
+import multiprocessing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+REGISTER_COUNT = 0x10000    # Registers addressable by a Modbus request.
+MAX_READ_COUNT = 125        # Registers in one read (function 0x03 and 0x04).
+BIT_COUNT = 0x10000         # Coils or discrete inputs addressable by a Modbus request.
+MAX_READ_BITS = 2000        # Bits in one read (function 0x01 and 0x02).
+MAX_WRITE_BITS = 1968       # Coils in one write multiple coils (function 0x0F).
+SHARED_HEADER = 8           # Bytes in front of the registers of a shared bank.
+STALL_SPINS = 1000          # Retries of a read waiting for a writer, before the writer is checked.
+
+class RegisterBank():
+    def __init__(self, size=REGISTER_COUNT):
+        self.size = size
+        self.data = bytearray(2 * size)
+        self.view = memoryview(self.data)
+        self.sequence = 0                   # Uneven while a write is in progress.
+        self.writeLock = threading.Lock()   # Only serializes the writers.
+
+    # Check if all registers from start to start + count exists.
+    def ValidRange(self, start, count):
+        return start >= 0 and count > 0 and start + count <= self.size
+
+    # Get a consistent copy of the bytes of count registers from start.
+    def Read(self, start, count):
+        view = self.view[2 * start:2 * (start + count)]
+        spins = 0
+        while True:
+            sequence = self.sequence
+            if sequence & 1 == 0:
+                data = bytes(view)
+                if self.sequence == sequence:
+                    return data
+            # A writer is busy, let it finish.
+            spins += 1
+            if spins % STALL_SPINS == 0:
+                self.Stalled()
+            time.sleep(0)
+
+    # Called while a read waits long for a writer. The writers of a bank in memory are
+    # threads of this process, they finish their writes.
+    def Stalled(self):
+        pass
+
+    # Set the registers from start to the bytes in data, as one write.
+    def Write(self, start, data):
+        with self.writeLock:
+            self.sequence += 1
+            self.view[2 * start:2 * start + len(data)] = data
+            self.sequence += 1
+
+    # Replace count registers from start with update(bytes of the registers), as one write.
+    def Update(self, start, count, update):
+        with self.writeLock:
+            view = self.view[2 * start:2 * (start + count)]
+            self.sequence += 1
+            view[:] = update(bytes(view))
+            self.sequence += 1
+
+    # Set a value from start, padding an uneven amount of bytes to whole registers.
+    def SetValue(self, start, value):
+        if len(value) % 2 != 0:
+            value = bytes(value) + b"\x00"
+        self.Write(start, value)
+
+    # Get a new bank with a copy of the registers.
+    def Copy(self):
+        bank = RegisterBank(self.size)
+        bank.Write(0, self.Read(0, self.size))
+        return bank
+
+    # Get the bank in shared memory, for worker processes.
+    def Shared(self):
+        return SharedRegisterBank.FromBank(self)
+
+# A register bank in shared memory, for worker processes forked after it is
+# created. The sequence is kept in the shared memory in front of the registers,
+# and the writers of all processes serialize on a process shared lock.
+#
+# Shared memory layout:
+# [SEQUENCE x 8] [REG 0 HI] [REG 0 LO] ... [REG size-1 HI] [REG size-1 LO]
+class SharedRegisterBank(RegisterBank):
+    def __init__(self, size=REGISTER_COUNT, memory=None, lock=None, offset=0):
+        if memory is None:
+            memory = mmap.mmap(-1, SHARED_HEADER + 2 * size)
+        if lock is None:
+            lock = multiprocessing.Lock()
+        self.size = size
+        self.memory = memory
+        self.offset = offset    # Start of the bank in the memory.
+        self.sequenceView = memoryview(memory)[offset:offset + SHARED_HEADER].cast("Q")
+        self.view = memoryview(memory)[offset + SHARED_HEADER:offset + SHARED_HEADER + 2 * size]
+        self.data = self.view
+        self.writeLock = lock
+
+    # Create a shared bank with a copy of the registers of a bank.
+    @staticmethod
+    def FromBank(bank):
+        shared = SharedRegisterBank(bank.size)
+        shared.Write(0, bank.Read(0, bank.size))
+        return shared
+
+    def Read(self, start, count):
+        view = self.view[2 * start:2 * (start + count)]
+        sequenceView = self.sequenceView
+        spins = 0
+        while True:
+            sequence = sequenceView[0]
+            if sequence & 1 == 0:
+                data = bytes(view)
+                if sequenceView[0] == sequence:
+                    return data
+            # A writer is busy, let it finish.
+            spins += 1
+            if spins % STALL_SPINS == 0:
+                self.Stalled()
+            time.sleep(0)
+
+    def Write(self, start, data):
+        with self.writeLock:
+            self.sequenceView[0] += 1
+            self.view[2 * start:2 * start + len(data)] = data
+            self.sequenceView[0] += 1
+
+    def Update(self, start, count, update):
+        with self.writeLock:
+            view = self.view[2 * start:2 * (start + count)]
+            self.sequenceView[0] += 1
+            view[:] = update(bytes(view))
+            self.sequenceView[0] += 1
+
+    def Shared(self):
+        return self
+
+#=== Bit banks ================================================================
+
+# Coils or discrete inputs, packed into the bytes of a register bank.
+class BitBank():
+    def __init__(self, size=BIT_COUNT, bank=None):
+        self.size = size
+        self.bank = bank if bank is not None else RegisterBank((size + 15) // 16)
+
+    # Check if all bits from start to start + count exists.
+    def ValidRange(self, start, count):
+        return start >= 0 and count > 0 and start + count <= self.size
+
+    # Get the registers holding the bytes of count bits from start, as (first register,
+    # registers, offset of the first byte in the registers, bytes).
+    def Span(self, start, count):
+        first = start >> 3
+        length = ((start & 7) + count + 7) >> 3
+        register = first >> 1
+        return register, ((first + length + 1) >> 1) - register, first & 1, length
+
+    # Get count bits from start, packed with the first bit in the lowest bit of the first byte.
+    def Read(self, start, count):
+        register, registers, offset, length = self.Span(start, count)
+        data = self.bank.Read(register, registers)
+        shift = start & 7
+        if shift == 0 and count & 7 == 0:
+            return data[offset:offset + length]
+        bits = int.from_bytes(data[offset:offset + length], "little") >> shift
+        return (bits & ((1 << count) - 1)).to_bytes((count + 7) >> 3, "little")
+
+    # Set count bits from start to the packed bits in data, as one write.
+    def Write(self, start, count, data):
+        register, registers, offset, length = self.Span(start, count)
+        shift = start & 7
+        mask = ((1 << count) - 1) << shift
+        bits = (int.from_bytes(data, "little") << shift) & mask
+        def Merge(old):
+            value = (int.from_bytes(old[offset:offset + length], "little") & ~mask) | bits
+            return old[:offset] + value.to_bytes(length, "little") + old[offset + length:]
+        self.bank.Update(register, registers, Merge)
+
+    # Set bits from start to a list of values.
+    def SetBits(self, start, values):
+        bits = 0
+        for i, value in enumerate(values):
+            if value:
+                bits |= 1 << i
+        self.Write(start, len(values), bits.to_bytes((len(values) + 7) >> 3, "little"))
+
+    def Copy(self):
+        return BitBank(self.size, self.bank.Copy())
+
+    def Shared(self):
+        bank = self.bank.Shared()
+        return self if bank is self.bank else BitBank(self.size, bank)
+
+#=== Units ====================================================================
+
+MAX_UNIT = 247      # Highest Modbus slave address.
+
+# A device type. The register banks are defined on first use and shared by
+# every unit of the type until a unit writes to them.
+class RegisterTemplate():
+    def __init__(self, define):
+        self.define = define    # Function returning a dict of function: RegisterBank.
+        self.banks = None
+        self.lock = threading.Lock()
+
+    def Banks(self):
+        if self.banks is None:
+            with self.lock:
+                if self.banks is None:
+                    self.banks = self.define()
+        return self.banks
+
+# The register banks of one unit, loaded from its template on first access.
+class UnitRegisters():
+    def __init__(self, template):
+        self.template = template
+        self.banks = None
+        self.lock = threading.Lock()
+
+    # Load the banks from the template, the first time the unit is accessed.
+    def Load(self):
+        with self.lock:
+            if self.banks is None:
+                self.banks = dict(self.template.Banks())
+        return self.banks
+
+    # Get the bank of a function for reading, it can be shared with other units.
+    def Bank(self, function):
+        banks = self.banks
+        if banks is None:
+            banks = self.Load()
+        return banks.get(function)
+
+    # Move every bank of the unit to its own shared memory, banks already shared are kept.
+    def Share(self):
+        self.Load()
+        self.banks = {function: bank.Shared() for function, bank in self.banks.items()}
+
+    # Use other banks for the unit, such as the banks of a register file.
+    def Map(self, banks):
+        with self.lock:
+            self.banks = dict(banks)
+
+    # Get the bank of a function for writing, copying it first if it is shared.
+    def WritableBank(self, function):
+        bank = self.Bank(function)
+        if bank is not None and bank is self.template.Banks().get(function):
+            with self.lock:
+                bank = self.banks[function]
+                if bank is self.template.Banks()[function]:
+                    bank = bank.Copy()
+                    self.banks[function] = bank
+        return bank
+
+# The units hosted by the server, indexed by slave address.
+class UnitTable():
+    def __init__(self):
+        self.units = [None] * 256
+
+    # Host a unit with the registers of a template.
+    def Define(self, unit, template):
+        if unit < 1 or unit > MAX_UNIT:
+            raise ValueError("Invalid unit: %d."%(unit))
+        self.units[unit] = UnitRegisters(template)
+
+    def Defined(self, unit):
+        return self.units[unit] is not None
+
+    # Get the slave addresses of the hosted units.
+    def Hosted(self):
+        return [unit for unit, registers in enumerate(self.units) if registers is not None]
+
+    # Get the register bank of a function of a unit, or None if it does not exist.
+    def Bank(self, unit, function):
+        registers = self.units[unit]
+        if registers is None:
+            return None
+        return registers.Bank(function)
+
+    def WritableBank(self, unit, function):
+        registers = self.units[unit]
+        if registers is None:
+            return None
+        return registers.WritableBank(function)
+
+    # Move the banks of every unit to shared memory, before forking worker
+    # processes that should see each others writes. The units are loaded and
+    # no longer share the banks of their template.
+    def Share(self):
+        for registers in self.units:
+            if registers is not None:
+                registers.Share()
+
+    # Map the banks of every unit from a register file. The file is created
+    # with the registers of the templates if it does not exist. The bytes of a
+    # bit bank are stored as registers, the amount of bits is kept from the template.
+    def MapFile(self, path):
+        if os.path.exists(path) == False:
+            banks = []
+            for unit, registers in enumerate(self.units):
+                if registers is not None:
+                    for function, bank in sorted(registers.Load().items()):
+                        banks.append((unit, function, bank.bank if isinstance(bank, BitBank) else bank))
+            CreateRegisterFile(path, banks)
+
+        fileBanks = OpenRegisterFile(path)
+        for unit, registers in enumerate(self.units):
+            if registers is None:
+                continue
+            banks = {}
+            for function, template in registers.template.Banks().items():
+                bank = fileBanks.get((unit, function))
+                if bank is None:
+                    raise ValueError("Register file %s has no function %d of unit %d."%(path, function, unit))
+                if isinstance(template, BitBank):
+                    if 16 * bank.size < template.size:
+                        raise ValueError("Register file %s: Function %d of unit %d has too few bits."%(path, function, unit))
+                    bank = BitBank(template.size, bank)
+                banks[function] = bank
+            registers.Map(banks)
+
+#=== Register file ============================================================
+
+# A register file holds register banks of one or more units, each with the
+# sequence lock of a shared bank in front of its registers. The header is
+# little-endian, the registers big-endian.
+#
+# Register file layout:
+# [MAGIC x 4] [VERSION x 2] [BANKS x 2] [RESERVED x 8]
+# BANKS x ( UNIT FUNCTION [RESERVED x 2] [REGISTERS x 4] [OFFSET x 8] )
+# Banks at their offsets: [SEQUENCE x 8] [REG 0 HI] [REG 0 LO] ... [REG REGISTERS-1 HI] [REG REGISTERS-1 LO]
+#
+# A writer, in any process, locks the 8 bytes of the sequence with
+# fcntl.lockf() (F_SETLKW), adds 1 to the sequence, writes the registers, adds
+# 1 to the sequence again and unlocks. Readers copy the registers and retry if
+# the sequence was uneven or changed while copying.
+#
+# Usage (a producer writing live values):
+#     banks = OpenRegisterFile("plant.registers")
+#     banks[(1, 0x04)].Write(100, struct.pack(">f", 21.5))
+
+REGISTER_FILE_MAGIC = b"MBRF"
+REGISTER_FILE_VERSION = 1
+REGISTER_FILE_HEADER = struct.Struct("<4sHH8x")     # MAGIC VERSION BANKS
+REGISTER_FILE_ENTRY = struct.Struct("<BB2xIQ")      # UNIT FUNCTION REGISTERS OFFSET
+
+# A shared bank in a register file. The writers of other processes, that do not
+# share a lock with this one, are serialized by a lock on the sequence bytes.
+class FileRegisterBank(SharedRegisterBank):
+    def __init__(self, file, memory, offset, size):
+        SharedRegisterBank.__init__(self, size, memory, threading.Lock(), offset)
+        self.file = file
+
+    def Write(self, start, data):
+        # The file lock is held by a process, the threads of the process serialize on the write lock.
+        with self.writeLock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX, SHARED_HEADER, self.offset)
+            try:
+                self.sequenceView[0] += 1
+                self.view[2 * start:2 * start + len(data)] = data
+                self.sequenceView[0] += 1
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN, SHARED_HEADER, self.offset)
+
+    def Update(self, start, count, update):
+        with self.writeLock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX, SHARED_HEADER, self.offset)
+            try:
+                view = self.view[2 * start:2 * (start + count)]
+                self.sequenceView[0] += 1
+                view[:] = update(bytes(view))
+                self.sequenceView[0] += 1
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN, SHARED_HEADER, self.offset)
+
+    # A writer of another process can have died in the middle of a write, leaving the sequence
+    # uneven. Its file lock was released when it died, so the sequence is made even when the
+    # lock is free. The write lock keeps the writers of this process out meanwhile.
+    def Stalled(self):
+        with self.writeLock:
+            self.Recover()
+
+    # Make the sequence even if a writer ended in the middle of a write.
+    def Recover(self):
+        if self.sequenceView[0] & 1 == 0:
+            return
+        try:
+            fcntl.lockf(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB, SHARED_HEADER, self.offset)
+        except OSError:
+            return  # A writer is busy.
+        try:
+            if self.sequenceView[0] & 1:
+                self.sequenceView[0] += 1
+        finally:
+            fcntl.lockf(self.file, fcntl.LOCK_UN, SHARED_HEADER, self.offset)
+
+# Create a register file with copies of banks, a list of (unit, function, bank).
+def CreateRegisterFile(path, banks):
+    offset = REGISTER_FILE_HEADER.size + len(banks) * REGISTER_FILE_ENTRY.size
+    entries = []
+    for unit, function, bank in banks:
+        offset = (offset + 7) & ~7
+        entries.append((unit, function, bank.size, offset))
+        offset += SHARED_HEADER + 2 * bank.size
+
+    # Written to a temporary file first, so a server never maps a half written file.
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as file:
+        file.write(REGISTER_FILE_HEADER.pack(REGISTER_FILE_MAGIC, REGISTER_FILE_VERSION, len(banks)))
+        for entry in entries:
+            file.write(REGISTER_FILE_ENTRY.pack(*entry))
+        for (unit, function, size, offset), (unit, function, bank) in zip(entries, banks):
+            file.seek(offset)
+            file.write(struct.pack("<Q", 0))
+            file.write(bank.Read(0, bank.size))
+    os.replace(temporary, path)
+
+# Map the banks of a register file, returns a dict of (unit, function): FileRegisterBank.
+def OpenRegisterFile(path):
+    if fcntl is None:
+        raise OSError("Register files need fcntl.")
+    file = open(path, "r+b")
+    memory = None
+    # The entries are checked before any bank is mapped, the memory cannot be closed after.
+    try:
+        if os.fstat(file.fileno()).st_size < REGISTER_FILE_HEADER.size:
+            raise ValueError("Register file %s is too short."%(path))
+        memory = mmap.mmap(file.fileno(), 0)
+
+        magic, version, count = REGISTER_FILE_HEADER.unpack_from(memory)
+        if magic != REGISTER_FILE_MAGIC:
+            raise ValueError("%s is not a register file."%(path))
+        if version != REGISTER_FILE_VERSION:
+            raise ValueError("Register file %s has version %d, version %d is supported."%(path, version, REGISTER_FILE_VERSION))
+        if REGISTER_FILE_HEADER.size + count * REGISTER_FILE_ENTRY.size > len(memory):
+            raise ValueError("Register file %s is too short for %d banks."%(path, count))
+
+        entries = []
+        for i in range(count):
+            unit, function, size, offset = REGISTER_FILE_ENTRY.unpack_from(memory, REGISTER_FILE_HEADER.size + i * REGISTER_FILE_ENTRY.size)
+            if offset % 8 != 0 or offset + SHARED_HEADER + 2 * size > len(memory):
+                raise ValueError("Register file %s: Bank of function %d of unit %d is outside the file."%(path, function, unit))
+            entries.append((unit, function, size, offset))
+    except Exception:
+        if memory is not None:
+            memory.close()
+        file.close()
+        raise
+
+    banks = {}
+    for unit, function, size, offset in entries:
+        bank = FileRegisterBank(file, memory, offset, size)
+        bank.Recover()
+        banks[(unit, function)] = bank
+    return banks
@@ -0,0 +1,147 @@
+'''
+Deadline driven polling scheduler.
+
+Tags are polled in scan groups, each with its own interval, such as 100 ms,
+1 s or 60 s. The tags of a group are planned into reads once, when the group
+is added. The scheduler keeps the next deadline of every group in a heap,
+sleeps until the earliest one and starts the scan of that group without
+waiting for it to finish.
+
+A device only gets a limited amount of outstanding requests at once, shared
+by all groups polling it. A scan that is still running when the group is due
+again is an overrun, the due scan is skipped. How late each scan started
+compared to its deadline is kept as the lateness (jitter) of the group. When
+the scheduler itself is so late that later deadlines of a group have passed
+too, such as when the event loop was blocked, those scans are skipped and
+counted apart from the overruns.
+
+Usage:
+    scheduler = PollScheduler(ClientPool())
+    scheduler.AddGroup("fast", 0.1, "192.168.0.10", 502, tags, OnValues)
+    await scheduler.Run()
+
+    OnValues(group, values) gets the decoded values of a scan, by tag index.
+'''
+
+import heapq
+import asyncio
+import collections
+
+from modbus_planner import PlanReads
+
+LATENESS_SAMPLES = 1000     # Latest scans kept for the lateness statistics.
+
+class ScanGroup():
+    def __init__(self, name, interval, host, port, tags, callback, maxGap=0):
+        self.name = name
+        self.interval = interval
+        self.host = host
+        self.port = port
+        self.tags = tags
+        self.callback = callback
+        self.plan = PlanReads(tags, maxGap)
+        self.running = False
+        self.scans = 0
+        self.overruns = 0
+        self.skipped = 0        # Deadlines passed while the scheduler was late.
+        self.errors = 0
+        self.lateness = collections.deque(maxlen=LATENESS_SAMPLES)
+
+    # Get the statistics of the group, lateness in seconds.
+    def Stats(self):
+        lateness = sorted(self.lateness)
+        stats = {
+            "group": self.name,
+            "interval": self.interval,
+            "tags": len(self.tags),
+            "reads": len(self.plan),
+            "scans": self.scans,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "errors": self.errors,
+        }
+        if len(lateness) > 0:
+            stats["lateness_mean"] = sum(lateness) / len(lateness)
+            stats["lateness_p50"] = lateness[len(lateness) // 2]
+            stats["lateness_p99"] = lateness[min(len(lateness) - 1, (len(lateness) * 99) // 100)]
+            stats["lateness_max"] = lateness[-1]
+        return stats
+
+class PollScheduler():
+    def __init__(self, pool, maxOutstanding=4):
+        self.pool = pool
+        self.maxOutstanding = maxOutstanding    # Requests in flight per device.
+        self.groups = []
+        self.deadlines = []                     # Heap of (deadline, group number).
+        self.limits = {}                        # Device: semaphore of outstanding requests.
+        self.tasks = set()
+
+    # Add a scan group, polled every interval seconds from when the scheduler runs.
+    def AddGroup(self, name, interval, host, port, tags, callback, maxGap=0):
+        group = ScanGroup(name, interval, host, port, tags, callback, maxGap)
+        self.groups.append(group)
+        if (host, port) not in self.limits:
+            self.limits[(host, port)] = asyncio.Semaphore(self.maxOutstanding)
+        return group
+
+    # Poll the groups until stopped, or for duration seconds.
+    async def Run(self, duration=None):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        stop = None if duration is None else now + duration
+        self.deadlines = [(now, number) for number in range(len(self.groups))]
+        heapq.heapify(self.deadlines)
+
+        while len(self.deadlines) > 0:
+            deadline, number = self.deadlines[0]
+            if stop is not None and deadline >= stop:
+                break
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            group = self.groups[number]
+            now = loop.time()
+            if group.running:
+                group.overruns += 1
+            else:
+                group.lateness.append(now - deadline)
+                task = asyncio.ensure_future(self.Scan(group))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+            # Keep the phase of the group, skipping the deadlines that have already passed.
+            following = deadline + group.interval
+            if following <= now:
+                missed = int((now - following) / group.interval) + 1
+                group.skipped += missed
+                following += missed * group.interval
+            heapq.heapreplace(self.deadlines, (following, number))
+
+        if len(self.tasks) > 0:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    # Read all planned reads of a group and pass the values to its callback.
+    async def Scan(self, group):
+        group.running = True
+        try:
+            client = self.pool.Client(group.host, group.port)
+            limit = self.limits[(group.host, group.port)]
+            values = [None] * len(group.tags)
+
+            async def Read(read):
+                async with limit:
+                    data = await client.Read(read.unit, read.function, read.start, read.count)
+                read.Scatter(data, values)
+
+            results = await asyncio.gather(*[Read(read) for read in group.plan], return_exceptions=True)
+            group.errors += sum(1 for result in results if isinstance(result, BaseException))
+            group.scans += 1
+            if group.callback is not None:
+                group.callback(group, values)
+        finally:
+            group.running = False
+
+    def Stats(self):
+        return [group.Stats() for group in self.groups]
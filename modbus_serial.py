@@ -0,0 +1,69 @@
+'''
+Serial line access for Modbus RTU on POSIX systems.
+
+The line is opened in raw mode with termios, so it also works with Linux
+pseudo-terminals (os.openpty(), socat pty,raw) for testing without a serial
+port. A Modbus RTU frame ends with a silence of 3.5 characters, and a
+character is 11 bits: start, 8 data, parity or a second stop bit, and stop.
+Above 19200 baud the silence is a fixed 1.75 ms.
+
+Usage:
+    fd = OpenSerial("/dev/ttyUSB0", 19200)
+    timeout = InterFrameTimeout(19200)
+'''
+
+import os
+
+try:
+    import termios
+except ImportError:
+    termios = None
+
+CHARACTER_BITS = 11
+FIXED_TIMEOUT_BAUDRATE = 19200
+FIXED_INTER_FRAME_TIMEOUT = 0.00175
+
+# Seconds to send one character.
+def CharacterTime(baudrate):
+    return CHARACTER_BITS / baudrate
+
+# Seconds of silence that end a frame.
+def InterFrameTimeout(baudrate):
+    if baudrate > FIXED_TIMEOUT_BAUDRATE:
+        return FIXED_INTER_FRAME_TIMEOUT
+    return 3.5 * CharacterTime(baudrate)
+
+# Open a serial device in raw mode at a baud rate, 8 data bits and no flow control.
+def OpenSerial(device, baudrate, parity="E"):
+    if termios is None:
+        raise OSError("Serial lines need termios.")
+    speed = getattr(termios, "B%d"%(baudrate), None)
+    if speed is None:
+        raise ValueError("Unsupported baud rate: %d."%(baudrate))
+
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+    try:
+        iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+        iflag = 0
+        oflag = 0
+        lflag = 0
+        cflag = termios.CS8 | termios.CREAD | termios.CLOCAL
+        if parity == "E":
+            cflag |= termios.PARENB
+        elif parity == "O":
+            cflag |= termios.PARENB | termios.PARODD
+        else:
+            cflag |= termios.CSTOPB     # No parity has two stop bits.
+        cc[termios.VMIN] = 1
+        cc[termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, speed, speed, cc])
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+# Write all of data to a serial device.
+def WriteSerial(fd, data):
+    data = memoryview(data)
+    while len(data) > 0:
+        data = data[os.write(fd, data):]
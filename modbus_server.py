@@ -1,35 +1,64 @@
 #!/usr/bin/python3
 
+'''
+Modbus TCP and Modbus RTU server, over UDP, TCP or a serial line.
+
+Importing the module has no side effects, the command line is only read when
+it is run as a script. The servers can be used in-process, such as to answer
+requests from another transport or to test a client without sockets.
+
+Usage:
+    server = ModbusTcpServer(CreateUnits([1, 2]))
+    response = server.Execute(request)
+
+    Or, serving clients until the process is stopped:
+    Serve(ModbusTcpServer(), "tcp", "127.0.0.1", 502, "async")
+
+Command line:
+    ./modbus_server.py <ip> <port> <udp | tcp | serial> <tcp | rtu> [options]
+'''
+
 import os
 import sys
+import errno
+import select
+import socket
 import struct
+import atexit
+import signal
+import asyncio
 import socketserver
+from time import perf_counter_ns
 
-if len(sys.argv) < 5:
-    print("Usage: %s <ip> <port> <transport protcol: udp = UDP tcp = TCP> <data protocol: tcp = Modbus TCP, rtu = Modbus rtu>"%(os.path.basename(sys.argv[0])))
-    sys.exit()
-
-print("")
-print(sys.argv)
-print("")
-    
-ip = sys.argv[1]
-port = int(sys.argv[2])
-
-if sys.argv[3]  != "udp" and sys.argv[3] != "tcp":
-    print("Invalid transport protocol")
-    sys.exit()
-
-if sys.argv[4] != "tcp" and sys.argv[4] != "rtu":
-    print("Invalid data protocol")
-    sys.exit()
+from modbus_crc import CalculateCRC
+from modbus_framing import MbapFrameBuffer, RtuFrameBuffer, FrameError
+from modbus_serial import OpenSerial, WriteSerial, InterFrameTimeout
+from modbus_registers import RegisterBank, BitBank, RegisterTemplate, UnitTable, MAX_READ_COUNT, MAX_READ_BITS, MAX_WRITE_BITS, MAX_UNIT
+from modbus_buffers import BufferPool, MAX_RESPONSE_LENGTH
+from modbus_log import log, LEVELS, REQUEST, RESPONSE, HexDump, Sampler, ConfigureLogging
+from modbus_metrics import Metrics, PARSE, SEND
+from modbus_simulation import SimulatedRegisterBank, PlantPoints
+from modbus_recording import TrafficRecorder
+from modbus_overload import LoadGuard, ClientState, SERVER_BUSY
+from modbus_registermap import LoadRegisterMap
+from modbus_options import ParseOptions, ParseSeconds
+from modbus_metrics import DIAGNOSTIC_QUERY_DATA, DIAGNOSTIC_CLEAR_COUNTERS, DIAGNOSTIC_COUNTERS
 
 #=== Misc =====================================================================
 
-def CreateRegisterValue(count, value):
-    dict = {}
-    dict[count] = value
-    return dict
+# Parse a list of slave addresses and ranges, such as 1,5-8.
+def ParseUnits(text):
+    result = []
+    for part in text.split(","):
+        first, separator, last = part.partition("-")
+        if first.isdigit() == False or (separator and last.isdigit() == False):
+            raise ValueError("Invalid units: %s"%(text))
+        first = int(first)
+        last = int(last) if separator else first
+        if first < 1 or last > MAX_UNIT or first > last:
+            raise ValueError("Invalid units: %s"%(text))
+        result.extend(range(first, last + 1))
+    return result
 
 def DefineRegisters():
     ''''
@@ -54,99 +83,404 @@ def DefineRegisters():
     STR8: 39, 4, ABCDEFGH
     STR10: 43, 5, ABCDEFGHIJ
     STR12: 48, 6, ABCDEFGHIJKL
+
+    Coils and discrete inputs, bits 0-9: 1, 0, 1, 1, 0, 0, 1, 0, 1, 1
     '''
     
+    bank = RegisterBank()
+    bank.SetValue(0, struct.pack(">h", -1))                     # INT8
+    bank.SetValue(1, struct.pack(">H", 0x00DE))                 # UINT8
+    bank.SetValue(2, struct.pack(">h", -1))                     # INT16
+    bank.SetValue(3, struct.pack(">H", 0xDEAD))                 # UINT16
+    bank.SetValue(4, struct.pack(">i", -1))                     # INT24
+    bank.SetValue(6, struct.pack(">I", 0x00DEADBE))             # UINT24
+    bank.SetValue(8, struct.pack(">i", -1))                     # INT32
+    bank.SetValue(10, struct.pack(">I", 0xDEADBEEF))            # UINT32
+    bank.SetValue(12, struct.pack(">q", -1)[2:])                # INT48
+    bank.SetValue(15, struct.pack(">Q", 0x0000DEADBEEFBABE)[2:])# UINT48
+    bank.SetValue(18, struct.pack("q", -1))                     # INT64
+    bank.SetValue(22, struct.pack(">Q", 0xDEADBEEFBABECAFE))    # UINT64
+    bank.SetValue(26, struct.pack("f", 0xDEADBEEF))             # REAL32
+    bank.SetValue(28, struct.pack("d", 0xDEADBEEFBABECAFE))     # REAL64
+    bank.SetValue(32, bytearray("A", 'ascii'))                  # STR1
+    bank.SetValue(33, bytearray("AB", 'ascii'))                 # STR2
+    bank.SetValue(34, bytearray("ABCD", 'ascii'))               # STR4
+    bank.SetValue(36, bytearray("ABCDEF", 'ascii'))             # STR6
+    bank.SetValue(39, bytearray("ABCDEFGH", 'ascii'))           # STR8
+    bank.SetValue(43, bytearray("ABCDEFGHIJ", 'ascii'))         # STR10
+    bank.SetValue(48, bytearray("ABCDEFGHIJKL", 'ascii'))       # STR12
+
+    # Holding registers (function 0x03) and input registers (function 0x04) start with the same values.
+    inputBank = bank.Copy()
+
+    # Coils (function 0x01) and discrete inputs (function 0x02) start with the same bits.
+    coils = BitBank()
+    coils.SetBits(0, [1, 0, 1, 1, 0, 0, 1, 0, 1, 1])
+    inputBits = coils.Copy()
+
     registers = {}
-    registers[0] = CreateRegisterValue(1, struct.pack(">h", -1))                    # INT8
-    registers[1] = CreateRegisterValue(1, struct.pack(">H", 0x00DE))                # UINT8
-    registers[2] = CreateRegisterValue(1, struct.pack(">h", -1))                    # INT16
-    registers[3] = CreateRegisterValue(1, struct.pack(">H", 0xDEAD))                # UINT16
-    registers[4] = CreateRegisterValue(2, struct.pack(">i", -1))                    # INT24
-    registers[6] = CreateRegisterValue(2, struct.pack(">I", 0x00DEADBE))            # UINT24
-    registers[8] = CreateRegisterValue(2, struct.pack(">i", -1))                    # INT32
-    registers[10] = CreateRegisterValue(2, struct.pack(">I", 0xDEADBEEF))           # UINT32
-    registers[12] = CreateRegisterValue(3, struct.pack(">q", -1))                   # INT48
-    registers[15] = CreateRegisterValue(3, struct.pack(">Q", 0x0000DEADBEEFBABE))   # UINT48
-    registers[18] = CreateRegisterValue(4, struct.pack("q", -1))                    # INT64
-    registers[22] = CreateRegisterValue(4, struct.pack(">Q", 0xDEADBEEFBABECAFE))   # UINT64
-    registers[26] = CreateRegisterValue(2, struct.pack("f", 0xDEADBEEF))            # REAL32
-    registers[28] = CreateRegisterValue(4, struct.pack("d", 0xDEADBEEFBABECAFE))    # REAL64
-    registers[32] = CreateRegisterValue(1, bytearray("A", 'ascii'))                 # STR1
-    registers[33] = CreateRegisterValue(1, bytearray("AB", 'ascii'))                # STR2
-    registers[34] = CreateRegisterValue(2, bytearray("ABCD", 'ascii'))              # STR4
-    registers[36] = CreateRegisterValue(3, bytearray("ABCDEF", 'ascii'))            # STR6
-    registers[39] = CreateRegisterValue(4, bytearray("ABCDEFGH", 'ascii'))          # STR8
-    registers[43] = CreateRegisterValue(5, bytearray("ABCDEFGHIJ", 'ascii'))        # STR10
-    registers[48] = CreateRegisterValue(6, bytearray("ABCDEFGHIJKL", 'ascii'))      # STR12
+    registers[0x01] = coils
+    registers[0x02] = inputBits
+    registers[0x03] = bank
+    registers[0x04] = inputBank
     return registers
-    
-def PrintData(data):
-    tstr = ""
-    for j in range(len(data)):
-        if j%16 == 0 and j != 0:
-            tstr = tstr + '\n'
-        tstr = tstr + "%02X "%data[j]
-    print(tstr) 
-
-def Execute(request):
-    response = b""
-    server = 0
-    
-    if dataProtocol == "tcp":
-        server = ModbustcpServer()
-    elif dataProtocol == "rtu":
-        server = ModbusRtuServer()
+
+# Every hosted unit uses the registers of DefineRegisters(), shared until written.
+defaultTemplate = RegisterTemplate(DefineRegisters)
+
+SIMULATED_REGISTER = 100    # First simulated register, after the registers of DefineRegisters().
+
+# The registers of DefineRegisters() with an amount of simulated points from SIMULATED_REGISTER
+# in the holding and input registers, with values changing over time.
+def DefineSimulatedRegisters(points):
+    registers = DefineRegisters()
+    for function in (0x03, 0x04):
+        bank = SimulatedRegisterBank(PlantPoints(points, SIMULATED_REGISTER))
+        bank.Write(0, registers[function].Read(0, SIMULATED_REGISTER))
+        registers[function] = bank
+    return registers
+
+# Host units with the registers of a template, or the units of a loaded register map with
+# their own registers. The registers in a register file keep their values between runs and
+# can be written by other processes, the file is created if it does not exist.
+def CreateUnits(unitList=(1,), registerFile=None, template=defaultTemplate, registerMap=None):
+    units = UnitTable()
+    if registerMap is not None:
+        for unit, banks in sorted(registerMap.items()):
+            units.Define(unit, RegisterTemplate(lambda banks=banks: banks))
     else:
-        print("Invalid data protocol")
-        sys.exit()
-    
-    print("Request")
-    PrintData(request)
+        for unit in unitList:
+            units.Define(unit, template)
+    if registerFile is not None:
+        units.MapFile(registerFile)
+    return units
     
-    server.ParseRequest(request)
-    response = server.CreateResponse()
-    
-    print("")
-    print("Reponse")
-    PrintData(response)
-    
-    return response
+# Hex dump of a frame, only built if the log record is written as text.
+class HexData():
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return HexDump(self.data)
 
 #=== Servers ==================================================================
-    
+
+# Send a response, timing the sampled sends.
+def TimedSend(stats, send, *args):
+    if stats.SendSampled() == False:
+        send(*args)
+        return
+    start = perf_counter_ns()
+    send(*args)
+    stats.Record(SEND, (start, perf_counter_ns()))
+
+# The socketserver handlers get the Modbus server from the socket server, as server.modbus.
 class UdpServer(socketserver.BaseRequestHandler):
     def handle(self):
+        modbus = self.server.modbus
         request = self.request[0]   # Gets the request sent from the Modbus client
-        socket = self.request[1]    # Gets the Modbus client's network connection
-        response = Execute(request)
-        socket.sendto(response, self.client_address)    # Send response to Modbus client
+        connection = self.request[1]    # Gets the Modbus client's network connection
+        client = ClientState(self.client_address[0]) if modbus.guard is not None else None
+        output = modbus.buffers.Acquire()
+        try:
+            # Send response to Modbus client
+            modbus.ExecuteFrames((request,), output, lambda view: connection.sendto(view, self.client_address), client)
+        finally:
+            modbus.buffers.Release(output)
 
 class TcpServer(socketserver.BaseRequestHandler):
     def handle(self):
-        request = self.request.recv(1024).strip()
-        response = Execute(request)
-        self.request.sendall(response)
+        modbus = self.server.modbus
+        guard = modbus.guard
+        client = guard.Connect(self.client_address[0]) if guard is not None else None
+        framer = modbus.CreateFramer()
+        output = modbus.buffers.Acquire()
+        if guard is not None and guard.idleTimeout > 0:
+            self.request.settimeout(guard.idleTimeout)
+        readLimit = guard.ReadLimit(framer) if guard is not None else None
+
+        # Serve the Modbus client until it closes the connection. Pipelined requests are answered in order.
+        try:
+            while True:
+                received = self.request.recv_into(framer.GetBuffer()[:readLimit])
+                if received == 0:
+                    break
+                framer.BufferUpdated(received)
+                if client is not None:
+                    client.Received()
+                modbus.ExecuteFrames(framer.Frames(), output, self.request.sendall, client)
+                # A connection over the limit is closed when its first requests are answered.
+                if client is not None and client.refused:
+                    break
+        # The connection was idle for the idle timeout.
+        except (FrameError, socket.timeout):
+            pass
+        finally:
+            modbus.buffers.Release(output)
+            if client is not None:
+                guard.Disconnect(client)
+
+class AsyncTcpServer(asyncio.BufferedProtocol):
+    def __init__(self, modbus, connections=None):
+        self.modbus = modbus
+        self.connections = connections  # The open connections, to close the idle ones.
+
+    def connection_made(self, transport):
+        self.transport = transport  # The Modbus client's connection, kept open between requests.
+        self.framer = self.modbus.CreateFramer()
+        self.output = self.modbus.buffers.Acquire()
+        guard = self.modbus.guard
+        self.client = guard.Connect(transport.get_extra_info("peername")[0]) if guard is not None else None
+        self.readLimit = guard.ReadLimit(self.framer) if guard is not None else None
+        if self.connections is not None:
+            self.connections.add(self)
+
+    def connection_lost(self, exception):
+        self.modbus.buffers.Release(self.output)
+        if self.client is not None:
+            self.modbus.guard.Disconnect(self.client)
+        if self.connections is not None:
+            self.connections.discard(self)
+
+    # The transport may keep what it could not send yet, so it gets a copy.
+    def Send(self, view):
+        self.transport.write(bytes(view))
+
+    def get_buffer(self, sizeHint):
+        if self.readLimit is not None:
+            return self.framer.GetBuffer(sizeHint)[:self.readLimit]
+        return self.framer.GetBuffer(sizeHint)
+
+    # Pipelined requests are answered in order.
+    def buffer_updated(self, received):
+        self.framer.BufferUpdated(received)
+        if self.client is not None:
+            self.client.Received()
+        try:
+            self.modbus.ExecuteFrames(self.framer.Frames(), self.output, self.Send, self.client)
+        except FrameError:
+            self.transport.close()
+        # A connection over the limit is closed when its first requests are answered.
+        if self.client is not None and self.client.refused:
+            self.transport.close()
+
+class AsyncUdpServer(asyncio.DatagramProtocol):
+    def __init__(self, modbus):
+        self.modbus = modbus
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if self.modbus.guard is None:
+            response = self.modbus.Execute(data)
+            if len(response) == 0:
+                return
+            TimedSend(self.modbus.metrics.Local(), self.transport.sendto, response, address)
+            return
+        output = self.modbus.buffers.Acquire()
+        try:
+            self.modbus.ExecuteFrames((data,), output, lambda view: self.transport.sendto(bytes(view), address), ClientState(address[0]))
+        finally:
+            self.modbus.buffers.Release(output)
+
+# Close the connections without a request for the idle timeout, checked twice per timeout.
+async def ReapIdle(connections, idleTimeout):
+    while True:
+        await asyncio.sleep(idleTimeout / 2)
+        oldest = perf_counter_ns() - int(idleTimeout * 1e9)
+        for connection in list(connections):
+            if connection.client.received < oldest:
+                connection.transport.close()
+
+# Serve a serial line until it is closed. A silence of 3.5 characters ends a frame, the bytes of
+# an incomplete frame are then dropped.
+def ServeSerial(modbus, device, baudrate):
+    fd = OpenSerial(device, baudrate)
+    framer = RtuFrameBuffer()
+    output = modbus.buffers.Acquire()
+    timeout = InterFrameTimeout(baudrate)
+    try:
+        while True:
+            ready = select.select([fd], [], [], timeout if framer.Pending() > 0 else None)[0]
+            if len(ready) == 0:
+                framer.Expire()
+                continue
+            try:
+                received = os.readv(fd, [framer.GetBuffer()])
+            except OSError as exception:
+                # The other end of a pseudo-terminal was closed.
+                if exception.errno == errno.EIO:
+                    break
+                raise
+            if received == 0:
+                break
+            framer.BufferUpdated(received)
+            modbus.ExecuteFrames(framer.Frames(), output, lambda view: WriteSerial(fd, view))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        modbus.buffers.Release(output)
+        os.close(fd)
+
+# Serve every client on one event loop until the process is stopped.
+async def ServeAsync(modbus, transportProtocol, ip, port, reusePort=False):
+    loop = asyncio.get_running_loop()
+
+    if transportProtocol == "udp":
+        transport, protocol = await loop.create_datagram_endpoint(lambda: AsyncUdpServer(modbus), local_addr=(ip, port), reuse_port=reusePort)
+        try:
+            await asyncio.Future()
+        finally:
+            transport.close()
+    elif transportProtocol == "tcp":
+        connections = set()
+        server = await loop.create_server(lambda: AsyncTcpServer(modbus, connections), ip, port, backlog=1024, reuse_port=reusePort)
+        # The task is kept, the event loop only holds a weak reference to it.
+        if modbus.guard is not None and modbus.guard.idleTimeout > 0:
+            reaper = asyncio.create_task(ReapIdle(connections, modbus.guard.idleTimeout))
+        async with server:
+            await server.serve_forever()
 
 #=== Modbus request ===========================================================
         
+# The register bank each supported function reads or writes.
+FUNCTION_BANKS = {
+    0x01: 0x01,     # Read coils.
+    0x02: 0x02,     # Read discrete inputs.
+    0x05: 0x01,     # Write single coil.
+    0x0F: 0x01,     # Write multiple coils.
+    0x03: 0x03,     # Read holding registers.
+    0x04: 0x04,     # Read input registers.
+    0x06: 0x03,     # Write single register.
+    0x10: 0x03,     # Write multiple registers.
+    0x17: 0x03,     # Read/write multiple registers.
+}
+
+DIAGNOSTICS = 0x08              # Diagnostics, answered from the metrics instead of a register bank.
+
+BROADCAST = 0                   # Slave address of a Modbus RTU request to every unit, it is not answered.
+BROADCAST_FUNCTIONS = (0x05, 0x06, 0x0F, 0x10)  # The writes a broadcast can be.
+
+COIL_ON = 0xFF00                # Values of a write single coil (function 0x05).
+COIL_OFF = 0x0000
+
+MAX_WRITE_COUNT = 123           # Registers in one write multiple registers (function 0x10).
+MAX_READ_WRITE_COUNT = 121      # Registers written by one read/write multiple registers (function 0x17).
+
+REQUEST_HEADER = struct.Struct(">BBHH")   # ADR FUNC [START START] [COUNT COUNT]
+READ_WRITE_HEADER = struct.Struct(">HH")  # [WRITE START] [WRITE COUNT]
+RTU_CRC = struct.Struct("<H")
+MBAP_HEADER = struct.Struct(">HHH")       # [TID TID] [PID PID] [LEN LEN]
+
 class ModbusRequest():
+    __slots__ = ("request", "slaveAddress", "function", "start", "count", "writeStart", "writeCount",
+                 "byteCount", "values", "valid", "errorCode", "badCrc")
+
     def __init__(self,  request,  data):
+        # Pad too short requests, they are rejected by the length check.
+        if len(data) < 6:
+            data = bytes(data).ljust(6, b"\x00")
+
         self.request = request
-        self.slaveAddress = data[0]
-        self.function = data[1]
-        self.start = struct.unpack('>h',  data[2:4])[0]
-        self.count = struct.unpack('>h',  data[4:6])[0]
+        self.slaveAddress, self.function, self.start, self.count = REQUEST_HEADER.unpack_from(data)
+        self.writeStart = 0
+        self.writeCount = 0
+        self.byteCount = 0
+        self.values = b""
         self.valid = False
         self.errorCode = 0
+        self.badCrc = False
+
+        # Diagnostics: [ADR FUNC] [SUB SUB] [DATA DATA], the sub-function is kept as start and the data as count.
+        # Write single register: [ADR FUNC] [REG REG] [VALUE VALUE]
+        # Write single coil: [ADR FUNC] [COIL COIL] [VALUE VALUE], the value is kept as writeCount.
+        if self.function == 0x06 or self.function == 0x05:
+            self.writeStart = self.start
+            self.writeCount = 1 if self.function == 0x06 else self.count
+            self.values = data[4:6]
+            self.count = 1
+        # Write multiple registers: [ADR FUNC] [START START] [COUNT COUNT] BYTES [VALUES]
+        # Write multiple coils: [ADR FUNC] [START START] [COUNT COUNT] BYTES [VALUES], eight coils per byte.
+        elif self.function == 0x10 or self.function == 0x0F:
+            self.writeStart = self.start
+            self.writeCount = self.count
+            self.byteCount = data[6] if len(data) > 6 else 0
+            self.values = data[7:]
+        # Read/write multiple registers: [ADR FUNC] [READ START] [READ COUNT] [WRITE START] [WRITE COUNT] BYTES [VALUES]
+        elif self.function == 0x17:
+            if len(data) >= 10:
+                self.writeStart, self.writeCount = READ_WRITE_HEADER.unpack_from(data, 6)
+            self.byteCount = data[10] if len(data) > 10 else 0
+            self.values = data[11:]
         
-    def ValidateRequest(self):
+    # Check the request against the units hosted by the server.
+    def ValidateRequest(self, units):
         # override in sub class.
         pass
+
+    # Get the expected length of the address and PDU of the function.
+    def ExpectedLength(self):
+        if self.function == 0x10 or self.function == 0x0F:
+            return 7 + self.byteCount
+        elif self.function == 0x17:
+            return 11 + self.byteCount
+        return 6
+
+    # Check the parts of the request that is the same for RTU and TCP.
+    def CheckRequest(self, okLength, okCrc, units):
+        okSlaveAddress = units.Defined(self.slaveAddress)
+        okFunction = self.function in FUNCTION_BANKS or (self.function == DIAGNOSTICS and self.ValidSubFunction())
+        # The registers can only be checked for a supported function of a hosted unit.
+        okRegister = okFunction == False or okSlaveAddress == False or self.ValidRegisters(units)
+        okCount = self.ValidCount()
+        self.valid = okLength and okSlaveAddress and okFunction and okCrc and okRegister and okCount
+
+        if self.valid == False:
+            self.SetErrorCode(okLength, okSlaveAddress, okFunction, okCrc, okRegister, okCount)
         
-    def SetErrorCode(self, okLength, okSlaveAddress, okFunction, okCrc, okRegister):
+    # Check if the diagnostics sub-function is supported.
+    def ValidSubFunction(self):
+        return self.start in (DIAGNOSTIC_QUERY_DATA, DIAGNOSTIC_CLEAR_COUNTERS) or self.start in DIAGNOSTIC_COUNTERS
+
+    # Check if the requested registers is inside the register bank of the function.
+    def ValidRegisters(self, units):
+        if self.function == DIAGNOSTICS:
+            return True
+        bank = units.Bank(self.slaveAddress, FUNCTION_BANKS.get(self.function))
+        if bank is None:
+            return False
+        if self.function == 0x17 and bank.ValidRange(self.writeStart, self.writeCount) == False:
+            return False
+        return bank.ValidRange(self.start, self.count)
+
+    # Check if the amount of registers fits in one request and response.
+    def ValidCount(self):
+        if self.function == 0x06:
+            return True
+        elif self.function == 0x05:
+            return self.writeCount == COIL_ON or self.writeCount == COIL_OFF
+        elif self.function == 0x01 or self.function == 0x02:
+            return self.count > 0 and self.count <= MAX_READ_BITS
+        elif self.function == 0x0F:
+            return self.count > 0 and self.count <= MAX_WRITE_BITS and self.byteCount == (self.count + 7) // 8
+        # Only the query data sub-function has data, the others have 0x0000.
+        elif self.function == DIAGNOSTICS:
+            return self.start == DIAGNOSTIC_QUERY_DATA or self.count == 0
+        elif self.function == 0x10:
+            return self.count > 0 and self.count <= MAX_WRITE_COUNT and self.byteCount == 2 * self.count
+        elif self.function == 0x17:
+            okWrite = self.writeCount > 0 and self.writeCount <= MAX_READ_WRITE_COUNT and self.byteCount == 2 * self.writeCount
+            return okWrite and self.count > 0 and self.count <= MAX_READ_COUNT
+        return self.count > 0 and self.count <= MAX_READ_COUNT
+
+    def SetErrorCode(self, okLength, okSlaveAddress, okFunction, okCrc, okRegister, okCount=True):
         # Illegal function.
         if okFunction == False:
             self.errorCode = 0x01
+        # Illegal data value, the quantity is checked before the address.
+        elif okCount == False:
+            self.errorCode = 0x03
         # Illegal data address.
         elif okRegister == False:
             self.errorCode = 0x02
@@ -155,170 +489,621 @@ class ModbusRequest():
             self.errorCode = 0x03
         # Gateway target device failed to respond.
         elif okSlaveAddress == False:
-            self.errorCode = 0x11
+            self.errorCode = 0x0B
 
 class ModbusRtuRequest(ModbusRequest):
+    __slots__ = ("crc",)
+
     def __init__(self,  data):
-        ModbusRequest.__init__(self, data, data[0:6])
-        self.crc = struct.unpack('H', data[6:8])[0]
+        ModbusRequest.__init__(self, data, data[0:-2])
+        self.crc = RTU_CRC.unpack_from(data, len(data) - 2)[0] if len(data) >= 2 else 0
         
-    def ValidateRequest(self):
-        calcedCrc = self.CalculateCRC(self.request[0:6])
-        okLength = len(self.request) == 8
-        okSlaveAddress = self.slaveAddress == slaveAddress
-        okFunction = self.function == 0x03 or self.function == 0x04
+    def ValidateRequest(self, units):
+        calcedCrc = CalculateCRC(self.request[0:-2])
+        okLength = len(self.request) == self.ExpectedLength() + 2
         okCrc = calcedCrc == self.crc
-        okRegister = self.start in registers and self.count in registers[self.start]
-        self.valid = okLength and okSlaveAddress and okFunction and okCrc and okRegister
-
-        if self.valid == False:
-            self.SetErrorCode(okLength, okSlaveAddress, okFunction, okCrc, okRegister)
-        
-    def CalculateCRC(self,  data):
-        crc = 0xFFFF
-        for pos in data:
-            crc ^= pos 
-            for i in range(8):
-                if ((crc & 1) != 0):
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return crc
+        self.badCrc = okCrc == False
+        self.CheckRequest(okLength, okCrc, units)
         
 class ModbusTcpRequest(ModbusRequest):
+    __slots__ = ("tid", "pid", "length")
+
     def __init__(self,  data):
-        ModbusRequest.__init__(self, data, data[6:12])
+        ModbusRequest.__init__(self, data, data[6:])
+        if len(data) >= 6:
+            self.tid, self.pid, self.length = MBAP_HEADER.unpack_from(data)
+        else:
+            self.tid, self.pid, self.length = 0, 0, 0
     
-    def ValidateRequest(self):
-        okLength = len(self.request) == (6 + self.count)
-        okSlaveAddress = self.slaveAddress == slaveAddress
-        okFunction = self.function == 0x03 or self.function == 0x04
-        okRegister = self.start in registers and self.count in registers[self.start]
-        self.valid = okLength and okSlaveAddress and okFunction and okRegister
-        
-        if self.valid == False:
-            self.SetErrorCode(okLength, okSlaveAddress, okFunction, True, okRegister)
+    def ValidateRequest(self, units):
+        expected = self.ExpectedLength()
+        okLength = len(self.request) == 6 + expected and self.length == expected
+        self.CheckRequest(okLength, True, units)
     
 #=== Modbus response ==========================================================
 
+# The responses are stateless codecs, built once and shared by every request.
+# They encode into buffer from offset and return the end of the response.
 class ModbusResponse():
-    def __init__(self,  slaveAddress, function):
-        self.slaveAddress = slaveAddress
-        self.function = function
-        
-    def CreatePositiveResponse(self, data):
+    def CreatePositiveResponse(self, request, data, buffer, offset=0):
         # override in sub class.
         pass
         
-    def CreateNegativeResponse(self, error):
+    def CreateNegativeResponse(self, request, error, buffer, offset=0):
+        # override in sub class.
+        pass
+
+    def CreateWriteResponse(self, request, start, value, buffer, offset=0):
         # override in sub class.
         pass
 
 class ModbusRtuResponse(ModbusResponse):
-    def __init__(self,  slaveAddress, function):
-        ModbusResponse.__init__(self, slaveAddress, function)
-        
-    def CreatePositiveResponse(self, data):
-        response = struct.pack("BBB", self.slaveAddress, self.function, len(data))
-        response += data 
-        crc = self.CalculateCRC(response)
-        response += struct.pack("H", crc)
-        return response
+    HEADER = struct.Struct("BBB")       # ADR FUNC COUNT or ADR FUNC ERROR
+    WRITE = struct.Struct(">BBHH")      # ADR FUNC [START START] [VALUE VALUE]
         
-    def CreateNegativeResponse(self, error):
-        response = struct.pack("BBB", self.slaveAddress, (0x80 + self.function), error)
-        crc = self.CalculateCRC(response)
-        response += struct.pack("H", crc)
-        return response
+    # The CRC is calculated from the values and continued over the data,
+    # instead of over a slice of the buffer.
+    def CreatePositiveResponse(self, request, data, buffer, offset=0):
+        header = (request.slaveAddress, request.function, len(data))
+        self.HEADER.pack_into(buffer, offset, *header)
+        end = offset + 3 + len(data)
+        buffer[offset + 3:end] = data
+        RTU_CRC.pack_into(buffer, end, CalculateCRC(data, CalculateCRC(header)))
+        return end + 2
         
-    def CalculateCRC(self,  data):
-        crc = 0xFFFF
-        for pos in data:
-            crc ^= pos 
-            for i in range(8):
-                if ((crc & 1) != 0):
-                    crc >>= 1
-                    crc ^= 0xA001
-                else:
-                    crc >>= 1
-        return crc
+    def CreateNegativeResponse(self, request, error, buffer, offset=0):
+        header = (request.slaveAddress, (0x80 + request.function), error)
+        self.HEADER.pack_into(buffer, offset, *header)
+        RTU_CRC.pack_into(buffer, offset + 3, CalculateCRC(header))
+        return offset + 5
+
+    def CreateWriteResponse(self, request, start, value, buffer, offset=0):
+        self.WRITE.pack_into(buffer, offset, request.slaveAddress, request.function, start, value)
+        crc = CalculateCRC((request.slaveAddress, request.function, start >> 8, start & 0xFF, value >> 8, value & 0xFF))
+        RTU_CRC.pack_into(buffer, offset + 6, crc)
+        return offset + 8
         
 class ModbusTcpResponse(ModbusResponse):
-    def __init__(self,  slaveAddress, function):
-        ModbusResponse.__init__(self, slaveAddress, function)
+    # The response has the same TID as the request, so pipelined requests can be matched.
+    HEADER = struct.Struct(">HHHBBB")   # [TID TID] [PID PID] [LEN LEN] ADR FUNC COUNT or ERROR
+    WRITE = struct.Struct(">HHHBBHH")   # [TID TID] [PID PID] [LEN LEN] ADR FUNC [START START] [VALUE VALUE]
         
-    def CreatePositiveResponse(self, data):
-        return b""
+    def CreatePositiveResponse(self, request, data, buffer, offset=0):
+        self.HEADER.pack_into(buffer, offset, request.tid, request.pid, 3 + len(data), request.slaveAddress, request.function, len(data))
+        end = offset + 9 + len(data)
+        buffer[offset + 9:end] = data
+        return end
         
-    def CreateNegativeResponse(self, error):
-        return b""
+    def CreateNegativeResponse(self, request, error, buffer, offset=0):
+        self.HEADER.pack_into(buffer, offset, request.tid, request.pid, 3, request.slaveAddress, (0x80 + request.function), error)
+        return offset + 9
+
+    def CreateWriteResponse(self, request, start, value, buffer, offset=0):
+        self.WRITE.pack_into(buffer, offset, request.tid, request.pid, 6, request.slaveAddress, request.function, start, value)
+        return offset + 12
         
 #=== Modbus server ============================================================
         
+# Built once per data protocol, the server keeps no state between requests. The units, metrics,
+# trace sampler and output buffers are its own, so servers in one process do not share them.
+# With a recorder, every request and its response is recorded. With a load guard, the requests
+# of a client that cannot be taken in time are answered busy, see modbus_overload.py.
 class ModbusServer():
-    def __init__(self):
-        self.request = 0
-        self.response = 0
+    def __init__(self, response, units=None, metrics=None, sampler=None, buffers=None, recorder=None, guard=None):
+        self.response = response
+        self.units = units if units is not None else CreateUnits()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.sampler = sampler if sampler is not None else Sampler()
+        self.buffers = buffers if buffers is not None else BufferPool()
+        self.recorder = recorder
+        self.guard = guard
         
     def ParseRequest(self,  request):
         # override in sub class.
         pass
+
+    # Get the framer splitting a stream into requests.
+    def CreateFramer(self):
+        # override in sub class.
+        pass
         
-    def AcceptableRequest(self):
-        self.request.ValidateRequest()
-        print("Request is valid: %s"%(self.request.valid))
+    def AcceptableRequest(self, request):
+        request.ValidateRequest(self.units)
+        return request.valid
+
+    # Check if a request is answered, valid or not.
+    def Answered(self, request):
+        return True
+
+    # Parse a request and encode the response into buffer from offset, returns the end of the response.
+    # A request that is not answered ends at offset.
+    def ExecuteInto(self, request, buffer, offset=0):
+        # Nothing is formatted unless debug logging is enabled and the request is sampled.
+        traced = self.sampler.Sampled()
+        if traced:
+            request = bytes(request)
+            log.debug("Request\n%s", HexData(request), extra={"frame": request, "direction": REQUEST})
         
-        start = self.request.start
-        count = self.request.count
-        defined = start in registers and count in registers[start]
-        print("Register is defined: %s"%(defined))
+        # The stages of a sampled request are timed.
+        stats = self.metrics.Local()
+        stamps = [perf_counter_ns()] if stats.Sampled() else None
+        parsed = self.ParseRequest(request)
+        end = self.CreateResponse(parsed, buffer, offset, stamps)
+        if stamps is not None:
+            stats.Record(PARSE, stamps)
+        stats.Count(parsed, len(request), end - offset, self.units.Defined(parsed.slaveAddress))
+
+        if traced:
+            response = bytes(buffer[offset:end])
+            log.debug("Request is valid: %s, function: %s, start: %s, count: %s, error code: %s",
+                parsed.valid, parsed.function, parsed.start, parsed.count, parsed.errorCode)
+            log.debug("Reponse\n%s", HexData(response), extra={"frame": response, "direction": RESPONSE})
+
+        if self.recorder is not None:
+            self.recorder.Record(request, memoryview(buffer)[offset:end])
         
-        return self.request.valid and defined
+        return end
+
+    # Parse a request and get the response, empty if it is not answered.
+    def Execute(self, request):
+        buffer = self.buffers.Acquire()
+        try:
+            end = self.ExecuteInto(request, buffer)
+            return bytes(buffer[:end])
+        finally:
+            self.buffers.Release(buffer)
+
+    # Answer a request with exception 0x06 (slave device busy), without executing it.
+    def ShedInto(self, request, buffer, offset=0):
+        parsed = self.ParseRequest(request)
+        parsed.valid = False
+        parsed.errorCode = SERVER_BUSY
+        end = offset
+        if self.Answered(parsed):
+            end = self.response.CreateNegativeResponse(parsed, SERVER_BUSY, buffer, offset)
+        self.metrics.Local().Count(parsed, len(request), end - offset, self.units.Defined(parsed.slaveAddress))
+        if self.recorder is not None:
+            self.recorder.Record(request, memoryview(buffer)[offset:end])
+        return end
+
+    # Answer the requests in order, sending as few times as the output buffer allows. The requests
+    # of a client are admitted by the load guard, or shed.
+    def ExecuteFrames(self, frames, output, send, client=None):
+        stats = self.metrics.Local()
+        guard = self.guard if client is not None else None
+        end = 0
+        for frame in frames:
+            if guard is None:
+                end = self.ExecuteInto(frame, output, end)
+            elif guard.Admit(client):
+                try:
+                    end = self.ExecuteInto(frame, output, end)
+                finally:
+                    guard.Done()
+            else:
+                end = self.ShedInto(frame, output, end)
+            if len(output) - end < MAX_RESPONSE_LENGTH:
+                TimedSend(stats, send, memoryview(output)[:end])
+                end = 0
+        if end > 0:
+            TimedSend(stats, send, memoryview(output)[:end])
       
-    def CreateResponse(self):
-        if (self.AcceptableRequest()):
-            print("Start: %s"%self.request.start)
-            print("Count: %s"%self.request.count)
-            data = registers[self.request.start][self.request.count]
-            PrintData(data)
-            return self.response.CreatePositiveResponse(data)
+    # Create the response. For a timed request, the clock is added to stamps at the end of
+    # the parse, validate, lookup and encode stages.
+    def CreateResponse(self, request, buffer, offset=0, stamps=None):
+        units = self.units
+        if stamps is not None:
+            stamps.append(perf_counter_ns())
+        acceptable = self.AcceptableRequest(request)
+        if stamps is not None:
+            stamps.append(perf_counter_ns())
+
+        if acceptable == False:
+            end = self.response.CreateNegativeResponse(request, request.errorCode, buffer, offset)
+            if stamps is not None:
+                stamps.extend((None, perf_counter_ns()))
+            return end
+
+        # Diagnostics echoes the sub-function with the data or a counter.
+        if request.function == DIAGNOSTICS:
+            value = self.Diagnostic(request)
+            response = self.response.CreateWriteResponse
+            args = (request, request.start, value, buffer, offset)
+        # Write single register echoes the register and value.
+        elif request.function == 0x06:
+            units.WritableBank(request.slaveAddress, FUNCTION_BANKS[request.function]).Write(request.writeStart, request.values)
+            value = (request.values[0] << 8) | request.values[1]
+            response = self.response.CreateWriteResponse
+            args = (request, request.writeStart, value, buffer, offset)
+        # Write single coil echoes the coil and value.
+        elif request.function == 0x05:
+            units.WritableBank(request.slaveAddress, FUNCTION_BANKS[request.function]).Write(request.writeStart, 1, b"\x01" if request.writeCount == COIL_ON else b"\x00")
+            response = self.response.CreateWriteResponse
+            args = (request, request.writeStart, request.writeCount, buffer, offset)
+        # Write multiple coils echoes the start and count.
+        elif request.function == 0x0F:
+            units.WritableBank(request.slaveAddress, FUNCTION_BANKS[request.function]).Write(request.writeStart, request.writeCount, request.values)
+            response = self.response.CreateWriteResponse
+            args = (request, request.writeStart, request.writeCount, buffer, offset)
+        # Write multiple registers echoes the start and count.
+        elif request.function == 0x10:
+            units.WritableBank(request.slaveAddress, FUNCTION_BANKS[request.function]).Write(request.writeStart, request.values)
+            response = self.response.CreateWriteResponse
+            args = (request, request.writeStart, request.writeCount, buffer, offset)
         else:
-            return self.response.CreateNegativeResponse(self.request.errorCode)
+            bankFunction = FUNCTION_BANKS[request.function]
+            # Read/write multiple registers writes before it reads.
+            if request.function == 0x17:
+                units.WritableBank(request.slaveAddress, bankFunction).Write(request.writeStart, request.values)
+            data = units.Bank(request.slaveAddress, bankFunction).Read(request.start, request.count)
+            response = self.response.CreatePositiveResponse
+            args = (request, data, buffer, offset)
+
+        if stamps is not None:
+            stamps.append(perf_counter_ns())
+        end = response(*args)
+        if stamps is not None:
+            stamps.append(perf_counter_ns())
+        return end
+
+    # Get the data of a diagnostics response.
+    def Diagnostic(self, request):
+        if request.start == DIAGNOSTIC_QUERY_DATA:
+            return request.count
+        elif request.start == DIAGNOSTIC_CLEAR_COUNTERS:
+            self.metrics.Clear()
+            return 0
+        return self.metrics.DiagnosticCounter(request.start)
 
 class ModbusRtuServer(ModbusServer):
-    def __init__(self,):
-        ModbusServer.__init__(self)
+    def __init__(self, units=None, metrics=None, sampler=None, buffers=None, recorder=None, guard=None):
+        ModbusServer.__init__(self, ModbusRtuResponse(), units, metrics, sampler, buffers, recorder, guard)
         
     def ParseRequest(self, request):
-        self.request = ModbusRtuRequest(request)
-        self.response = ModbusRtuResponse(self.request.slaveAddress, self.request.function)
+        return ModbusRtuRequest(request)
+
+    # A request with a wrong CRC is answered, when it is not followed by more data.
+    def CreateFramer(self):
+        return RtuFrameBuffer(passCorrupted=True)
+
+    # A Modbus RTU line can have other slaves, so a request to a unit that is not hosted is left
+    # for them to answer. A broadcast is not answered.
+    def Answered(self, request):
+        return request.slaveAddress != BROADCAST and self.units.Defined(request.slaveAddress)
+
+    # A broadcast write is written to every hosted unit.
+    def CreateResponse(self, request, buffer, offset=0, stamps=None):
+        if self.Answered(request):
+            return ModbusServer.CreateResponse(self, request, buffer, offset, stamps)
+        if request.slaveAddress == BROADCAST and request.function in BROADCAST_FUNCTIONS:
+            self.Broadcast(request, buffer, offset)
+        return offset
+
+    # Execute a write on every hosted unit it is valid for. The responses are encoded and dropped.
+    def Broadcast(self, request, buffer, offset):
+        for unit in self.units.Hosted():
+            request.slaveAddress = unit
+            ModbusServer.CreateResponse(self, request, buffer, offset)
+        request.slaveAddress = BROADCAST
         
 class ModbusTcpServer(ModbusServer):
-    def __init___(self):
-        ModbusServer.__init__(self)
+    def __init__(self, units=None, metrics=None, sampler=None, buffers=None, recorder=None, guard=None):
+        ModbusServer.__init__(self, ModbusTcpResponse(), units, metrics, sampler, buffers, recorder, guard)
 
     def ParseRequest(self,  request):
-        self.request = ModbusTcpRequest(request)
-        self.response = ModbusTcpResponse(self.request.slaveAddress, self.request.function)
+        return ModbusTcpRequest(request)
+
+    def CreateFramer(self):
+        return MbapFrameBuffer()
+
+# Create the server of a data protocol, tcp = Modbus TCP or rtu = Modbus RTU.
+def CreateServer(dataProtocol, units=None, metrics=None, sampler=None, buffers=None, recorder=None, guard=None):
+    if dataProtocol == "tcp":
+        return ModbusTcpServer(units, metrics, sampler, buffers, recorder, guard)
+    elif dataProtocol == "rtu":
+        return ModbusRtuServer(units, metrics, sampler, buffers, recorder, guard)
+    raise ValueError("Invalid data protocol: %s."%(dataProtocol))
 
 #=== Main =====================================================================
 
-transportProtocol = sys.argv[3]
-dataProtocol = sys.argv[4]
-slaveAddress = 1
-registers = DefineRegisters()
+# Set up logging, each worker process writes its own trace file.
+def StartLogging(options, worker=None):
+    traceFile = options["trace-file"]
+    if traceFile is not None and worker is not None:
+        traceFile = "%s.%d"%(traceFile, worker)
+    ConfigureLogging(options["log-level"], options["log-file"], options["log-background"] == "yes", traceFile)
         
-if __name__ == "__main__":
-    server = 0
+# Write the metrics on SIGUSR1 and on exit, each worker process writes its own file.
+def StartMetrics(metrics, metricsFile, worker=None):
+    if metricsFile is None:
+        return
+    if worker is not None:
+        metricsFile = "%s.%d"%(metricsFile, worker)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: metrics.Write(metricsFile))
+    atexit.register(metrics.Write, metricsFile)
+
+# Record every request and response, each worker process writes its own recording.
+def StartRecording(modbus, recordFile, dataProtocol, worker=None):
+    if recordFile is None:
+        return
+    if worker is not None:
+        recordFile = "%s.%d"%(recordFile, worker)
+    try:
+        modbus.recorder = TrafficRecorder(recordFile, dataProtocol)
+    except (OSError, ValueError) as exception:
+        print("Invalid record file: %s"%(exception))
+        sys.exit()
+    atexit.register(modbus.recorder.Close)
+
+# Exit normally on SIGTERM, so buffered logs and traces are written.
+def Terminate(signum, frame):
+    sys.exit()
+
+# Serve the clients until the process is stopped, server = sync or async. Worker processes bind
+# the same port with SO_REUSEPORT and the kernel spreads the clients over them. A serial line is
+# given as the device and baud rate.
+def Serve(modbus, transportProtocol, ip, port, server="sync", reusePort=False):
+    if transportProtocol == "serial":
+        ServeSerial(modbus, ip, port)
+        return
+
+    if server == "async":
+        try:
+            asyncio.run(ServeAsync(modbus, transportProtocol, ip, port, reusePort))
+        except KeyboardInterrupt:
+            pass
+        return
     
     if transportProtocol == "udp":
-        server = socketserver.UDPServer((ip,  port),  UdpServer)
+        socketServer = socketserver.UDPServer((ip,  port),  UdpServer, bind_and_activate=False)
     elif transportProtocol == "tcp":
-        server = socketserver.TCPServer((ip,  port),  TcpServer)
+        # Connections stay open until the client closes them, so serve each in its own thread.
+        socketServer = socketserver.ThreadingTCPServer((ip,  port),  TcpServer, bind_and_activate=False)
+        socketServer.daemon_threads = True
     else:
+        raise ValueError("Invalid transport protocol: %s."%(transportProtocol))
+
+    socketServer.modbus = modbus
+    socketServer.allow_reuse_port = reusePort
+    socketServer.server_bind()
+    socketServer.server_activate()
+
+    try:
+        socketServer.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        socketServer.server_close()
+
+# Fork worker processes serving the same port. The registers are moved to shared memory first,
+# so a write in one worker is read by all of them. Each worker calls start(worker) before it
+# serves, and the signals are passed on to the workers.
+def ServeWorkers(modbus, transportProtocol, ip, port, workers, server="sync", start=None, signals=()):
+    modbus.units.Share()
+    children = []
+
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            if start is not None:
+                start(worker)
+            Serve(modbus, transportProtocol, ip, port, server, True)
+            sys.exit()
+        children.append(pid)
+
+    def SignalWorkers(signum, frame):
+        for pid in children:
+            os.kill(pid, signum)
+    for signum in signals:
+        signal.signal(signum, SignalWorkers)
+
+    # Stop the workers when the main process is stopped.
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+# Print the command line usage.
+def PrintUsage(program):
+    print("Usage: %s <ip> <port> <transport protcol: udp = UDP tcp = TCP serial = serial line> <data protocol: tcp = Modbus TCP, rtu = Modbus rtu> [options]"%(os.path.basename(program)))
+    print("Serial line: %s <device> <baud rate> serial rtu [options]"%(os.path.basename(program)))
+    print("Options:")
+    print("    --server=<sync | async>    sync = one client at a time (socketserver), async = persistent concurrent clients (asyncio)")
+    print("    --log-level=<level>        error, warning (default), info or debug = trace requests")
+    print("    --log-sample=<N>           Trace every N:th request (default 1)")
+    print("    --log-file=<path>          Write the log to a file instead of the console")
+    print("    --log-background=<yes|no>  Write the log from a background thread (default no)")
+    print("    --trace-file=<path>        Write traced requests and responses to a binary trace file")
+    print("    --record-file=<path>       Record every request and response, to replay with modbus_recording.py")
+    print("    --units=<list>             Slave addresses to host, such as 1,5-8 (default 1)")
+    print("    --workers=<N>              Worker processes sharing the port and registers (default 1)")
+    print("    --metrics-file=<path>      Write the metrics as JSON on SIGUSR1 and on exit")
+    print("    --register-file=<path>     Map the registers from a file, created if it does not exist")
+    print("    --register-map=<path>      Host the units and registers of a map (CSV, JSON or YAML) instead of --units")
+    print("    --max-connections=<N>      Connections served at once, more are answered busy and closed (default 0 = no limit)")
+    print("    --max-in-flight=<N>        Requests executed at once by the sync server's threads (default 0 = no limit)")
+    print("    --max-pipeline=<N>         Requests executed per receive of a connection, the rest are answered busy (default 0)")
+    print("    --rate-limit=<N>           Requests per second of a client IP address, more are answered busy (default 0)")
+    print("    --rate-burst=<N>           Requests a client can send at once within its rate limit (default the rate limit)")
+    print("    --idle-timeout=<seconds>   Close connections without a request for this time (default 0 = never)")
+    print("    --deadline=<seconds>       Answer requests busy instead of executing them this long after they were received (default 0)")
+    print("    --simulate=<N>             Simulate N points with changing values from register %d, with one worker (default 0)"%(SIMULATED_REGISTER))
+
+# The --name=value options and their defaults.
+DEFAULT_OPTIONS = {
+    "server": "sync",
+    "log-level": "warning",
+    "log-sample": "1",
+    "log-file": None,
+    "log-background": "no",
+    "trace-file": None,
+    "record-file": None,
+    "units": "1",
+    "workers": "1",
+    "metrics-file": None,
+    "register-file": None,
+    "register-map": None,
+    "simulate": "0",
+    "max-connections": "0",
+    "max-in-flight": "0",
+    "max-pipeline": "0",
+    "rate-limit": "0",
+    "rate-burst": "0",
+    "idle-timeout": "0",
+    "deadline": "0",
+}
+
+# Create the load guard of the overload options, in the order of the arguments of LoadGuard().
+# None if every limit is 0.
+def CreateGuard(options):
+    limits = []
+    for name in ("max-connections", "max-in-flight", "max-pipeline", "rate-limit", "rate-burst"):
+        if options[name].isdigit() == False:
+            raise ValueError("Invalid %s"%(name.replace("-", " ")))
+        limits.append(int(options[name]))
+    for name in ("idle-timeout", "deadline"):
+        seconds = ParseSeconds(options[name])
+        if seconds is None:
+            raise ValueError("Invalid %s"%(name.replace("-", " ")))
+        limits.append(seconds)
+
+    if any(limit > 0 for limit in limits) == False:
+        return None
+    return LoadGuard(*limits)
+
+# Run the server from the command line arguments.
+def Main(args):
+    if len(args) < 5:
+        PrintUsage(args[0])
+        sys.exit()
+
+    print("")
+    print(args)
+    print("")
+
+    ip = args[1]
+    if args[2].isdigit() == False:
+        print("Invalid port")
+        sys.exit()
+    port = int(args[2])
+    transportProtocol = args[3]
+    dataProtocol = args[4]
+
+    if transportProtocol != "udp" and transportProtocol != "tcp" and transportProtocol != "serial":
         print("Invalid transport protocol")
         sys.exit()
-    
-    server.serve_forever()
-    
+
+    if dataProtocol != "tcp" and dataProtocol != "rtu":
+        print("Invalid data protocol")
+        sys.exit()
+
+    if transportProtocol == "serial" and dataProtocol != "rtu":
+        print("Invalid data protocol, a serial line uses Modbus RTU")
+        sys.exit()
+
+    options = ParseOptions(args[5:], DEFAULT_OPTIONS)
+
+    if options["server"] != "sync" and options["server"] != "async":
+        print("Invalid server")
+        sys.exit()
+
+    if options["log-level"] not in LEVELS:
+        print("Invalid log level")
+        sys.exit()
+
+    if options["log-sample"].isdigit() == False or int(options["log-sample"]) == 0:
+        print("Invalid log sample")
+        sys.exit()
+
+    if options["log-background"] != "yes" and options["log-background"] != "no":
+        print("Invalid log background")
+        sys.exit()
+
+    if options["workers"].isdigit() == False or int(options["workers"]) == 0:
+        print("Invalid workers")
+        sys.exit()
+
+    if transportProtocol == "serial" and options["workers"] != "1":
+        print("Invalid workers, a serial line is served by one process")
+        sys.exit()
+
+    try:
+        unitList = ParseUnits(options["units"])
+    except ValueError as exception:
+        print(exception)
+        sys.exit()
+
+    if options["simulate"].isdigit() == False:
+        print("Invalid simulate")
+        sys.exit()
+    # The banks of a register file would replace the simulated banks.
+    if options["simulate"] != "0" and options["register-file"] is not None:
+        print("Invalid simulate: Not possible with a register file")
+        sys.exit()
+    # Each worker would evaluate its own copy of the simulated banks, and writes to them would
+    # not be seen by the other workers.
+    if options["simulate"] != "0" and int(options["workers"]) > 1:
+        print("Invalid simulate: Not possible with more than one worker")
+        sys.exit()
+
+    template = defaultTemplate
+    if options["simulate"] != "0":
+        try:
+            points = int(options["simulate"])
+            template = RegisterTemplate(lambda: DefineSimulatedRegisters(points))
+            template.Banks()
+        except ValueError as exception:
+            print("Invalid simulate: %s"%(exception))
+            sys.exit()
+
+    # The map is compiled to a snapshot next to it, if the snapshot is stale.
+    registerMap = None
+    if options["register-map"] is not None:
+        if options["simulate"] != "0":
+            print("Invalid register map: Not possible with simulate")
+            sys.exit()
+        try:
+            registerMap = LoadRegisterMap(options["register-map"])
+        except (OSError, ValueError) as exception:
+            print("Invalid register map: %s"%(exception))
+            sys.exit()
+
+    try:
+        units = CreateUnits(unitList, options["register-file"], template, registerMap)
+    except (OSError, ValueError) as exception:
+        print("Invalid register file: %s"%(exception))
+        sys.exit()
+
+    try:
+        guard = CreateGuard(options)
+    except ValueError as exception:
+        print(exception)
+        sys.exit()
+
+    modbus = CreateServer(dataProtocol, units, sampler=Sampler(int(options["log-sample"])), guard=guard)
+    signal.signal(signal.SIGTERM, Terminate)
+
+    workers = int(options["workers"])
+    if workers > 1:
+        # Each worker writes its own metrics, so the request to write them is passed on.
+        def StartWorker(worker):
+            StartLogging(options, worker)
+            StartMetrics(modbus.metrics, options["metrics-file"], worker)
+            StartRecording(modbus, options["record-file"], dataProtocol, worker)
+        signals = (signal.SIGUSR1,) if options["metrics-file"] is not None else ()
+        ServeWorkers(modbus, transportProtocol, ip, port, workers, options["server"], StartWorker, signals)
+    else:
+        StartLogging(options)
+        StartMetrics(modbus.metrics, options["metrics-file"])
+        StartRecording(modbus, options["record-file"], dataProtocol)
+        Serve(modbus, transportProtocol, ip, port, options["server"])
+
+if __name__ == "__main__":
+    Main(sys.argv)
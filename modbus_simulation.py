@@ -0,0 +1,294 @@
+'''
+Simulated registers with values that change over time, for load testing
+clients.
+
+A simulated bank is a register bank with points: a register, a data type and
+a signal giving the value over time. The time is counted in ticks (0.1 s by
+default) from when the bank was created, and a value is the same for the
+whole tick. The points are evaluated lazily: a read evaluates the points it
+covers the first time they are read in a tick, and encodes them into the
+registers before it copies them. Registers that are not points keep their
+values, and a write to a point only lasts until the point is evaluated again.
+
+With NumPy installed, a bank with many points is evaluated as a whole the
+first time it is read in a tick. Every point of a signal is evaluated in one
+vectorized step, and the values of a data type are encoded and scattered into
+the registers with one indexed assignment, so the cost per request does not
+grow with the amount of points.
+
+Signals:
+    * Ramp(low, high, period): From low to high in period seconds, then again.
+    * Sine(amplitude, period, offset=0, phase=0): offset + amplitude * sin(2 pi t / period + phase).
+    * RandomWalk(step, low, high, start=None): A random step each tick, with a
+      standard deviation of step, kept between low and high.
+    * Counter(step=1, start=0): Adds step each tick, integer data types wrap.
+
+Usage:
+    bank = SimulatedRegisterBank([
+        (0, "f", Sine(10.0, 60.0, 20.0)),
+        (2, "H", Counter()),
+        (3, "iw", RandomWalk(5, -1000, 1000)),
+    ])
+    registers = {0x03: bank, 0x04: bank.Copy()}
+
+See modbus_datatypes.py for the data types, strings are not simulated.
+'''
+
+import math
+import time
+import bisect
+import random
+import struct
+
+from modbus_optional import OptionalModule
+from modbus_registers import RegisterBank, REGISTER_COUNT
+from modbus_datatypes import DATA_TYPES, BYTE_TYPES, ValidDataType, WordSwapped, StringLength, DataTypeRegisterCount
+
+TICK = 0.1              # Seconds a simulated value is the same.
+VECTOR_POINTS = 256     # Points from which a bank is evaluated with NumPy, when it is installed.
+MAX_POINT_REGISTERS = 4
+
+RAMP = 0
+SINE = 1
+RANDOM_WALK = 2
+COUNTER = 3
+
+#=== Signals ==================================================================
+
+# The kind and parameters of a simulated value.
+class Signal():
+    def __init__(self, kind, *parameters):
+        self.kind = kind
+        self.parameters = parameters
+
+def Ramp(low, high, period):
+    if period <= 0:
+        raise ValueError("Invalid ramp period: %s."%(period))
+    return Signal(RAMP, low, high, period)
+
+def Sine(amplitude, period, offset=0.0, phase=0.0):
+    if period <= 0:
+        raise ValueError("Invalid sine period: %s."%(period))
+    return Signal(SINE, amplitude, period, offset, phase)
+
+def RandomWalk(step, low, high, start=None):
+    if low > high:
+        raise ValueError("Invalid random walk range: %s to %s."%(low, high))
+    return Signal(RANDOM_WALK, step, low, high, (low + high) / 2 if start is None else start)
+
+def Counter(step=1, start=0):
+    return Signal(COUNTER, step, start)
+
+# A plant of simulated points from a register, cycling through the signals and data types.
+def PlantPoints(count, first=0):
+    kinds = (
+        ("f", lambda i: Sine(10.0 + i % 7, 30.0 + i % 11, 20.0)),
+        ("H", lambda i: Counter(1 + i % 3)),
+        ("i", lambda i: RandomWalk(5, -10000, 10000)),
+        ("fw", lambda i: Ramp(0.0, 100.0, 10.0 + i % 13)),
+        ("h", lambda i: RandomWalk(1, -500, 500)),
+        ("d", lambda i: Sine(1000.0, 60.0)),
+    )
+    points = []
+    register = first
+    for i in range(count):
+        dataType, signal = kinds[i % len(kinds)]
+        points.append((register, dataType, signal(i)))
+        register += DataTypeRegisterCount(dataType)
+    return points
+
+#=== Encoding =================================================================
+
+# Encode a value as the registers of a data type. Integers are rounded and wrapped.
+def EncodeValue(dataType, value):
+    if dataType == "?":
+        return b"\x00\x01" if value else b"\x00\x00"
+    valueFormat = DATA_TYPES[dataType[0]][1]
+    if valueFormat != "f" and valueFormat != "d":
+        value = int(round(value)) & ((1 << (8 * struct.calcsize(valueFormat))) - 1)
+        valueFormat = valueFormat.upper()
+    if dataType in BYTE_TYPES:
+        return bytes((0, value))
+    data = struct.pack(">" + valueFormat, value)
+    if WordSwapped(dataType):
+        data = b"".join(data[i:i + 2] for i in range(len(data) - 2, -1, -2))
+    return data
+
+# Encode an array of values as the registers of a data type, one row of bytes per value.
+def EncodeValues(dataType, values):
+    numpy = OptionalModule("numpy")
+    registers = DataTypeRegisterCount(dataType)
+    valueFormat = DATA_TYPES[dataType[0]][1]
+    if dataType == "?":
+        encoded = (values != 0).astype(">u2")
+    elif valueFormat == "f" or valueFormat == "d":
+        encoded = values.astype(">f%d"%(struct.calcsize(valueFormat)))
+    else:
+        integers = numpy.rint(values).astype(numpy.int64)
+        if dataType in BYTE_TYPES:
+            integers &= 0xFF
+        encoded = integers.astype(">u%d"%(2 * registers))
+    data = encoded.view(numpy.uint8).reshape(len(values), 2 * registers)
+    if WordSwapped(dataType):
+        data = data.reshape(len(values), registers, 2)[:, ::-1, :].reshape(len(values), 2 * registers)
+    return data
+
+#=== Simulated bank ===========================================================
+
+class Point():
+    __slots__ = ("register", "dataType", "signal", "registers", "tick", "value")
+
+    def __init__(self, register, dataType, signal):
+        self.register = register
+        self.dataType = dataType
+        self.signal = signal
+        self.registers = DataTypeRegisterCount(dataType)
+        self.tick = None        # Tick the value was evaluated in.
+        self.value = None
+
+class SimulatedRegisterBank(RegisterBank):
+    def __init__(self, points, size=REGISTER_COUNT, resolution=TICK, vectorized=None):
+        RegisterBank.__init__(self, size)
+        self.definitions = list(points)
+        self.resolution = resolution
+        self.firstTick = self.Tick()
+        self.random = random.Random()
+
+        self.points = []
+        for register, dataType, signal in sorted(self.definitions, key=lambda point: point[0]):
+            if ValidDataType(dataType) == False or StringLength(dataType) > 0:
+                raise ValueError("Invalid data type of simulated register %d: %s."%(register, dataType))
+            point = Point(register, dataType, signal)
+            if self.ValidRange(register, point.registers) == False:
+                raise ValueError("Simulated register %d is outside the bank."%(register))
+            if len(self.points) > 0 and self.points[-1].register + self.points[-1].registers > register:
+                raise ValueError("Simulated register %d overlaps register %d."%(register, self.points[-1].register))
+            self.points.append(point)
+        self.starts = [point.register for point in self.points]
+
+        if vectorized is None:
+            vectorized = len(self.points) >= VECTOR_POINTS and OptionalModule("numpy") is not None
+        self.vectorized = vectorized
+        self.tick = None    # Tick the whole bank was evaluated in.
+        if self.vectorized:
+            self.CompileVectors()
+
+    def Tick(self):
+        return int(time.monotonic() / self.resolution)
+
+    # Get a consistent copy of the bytes of count registers from start, evaluating the
+    # points they cover first.
+    def Read(self, start, count):
+        tick = self.Tick()
+        if self.vectorized:
+            if tick != self.tick:
+                self.Refresh(tick)
+        else:
+            self.Evaluate(start, count, tick)
+        return RegisterBank.Read(self, start, count)
+
+    # Evaluate the points covered by count registers from start, that are not evaluated in the tick.
+    def Evaluate(self, start, count, tick):
+        first = bisect.bisect_left(self.starts, start - MAX_POINT_REGISTERS + 1)
+        last = bisect.bisect_left(self.starts, start + count)
+        stale = [point for point in self.points[first:last] if point.tick != tick and point.register + point.registers > start]
+        if len(stale) == 0:
+            return
+
+        with self.writeLock:
+            self.sequence += 1
+            for point in stale:
+                # Another thread can have evaluated the point while this one waited for the lock.
+                if point.tick != tick:
+                    self.EvaluatePoint(point, tick)
+                    self.view[2 * point.register:2 * (point.register + point.registers)] = EncodeValue(point.dataType, point.value)
+            self.sequence += 1
+
+    def EvaluatePoint(self, point, tick):
+        parameters = point.signal.parameters
+        kind = point.signal.kind
+        seconds = (tick - self.firstTick) * self.resolution
+        if kind == RAMP:
+            low, high, period = parameters
+            value = low + (high - low) * ((seconds % period) / period)
+        elif kind == SINE:
+            amplitude, period, offset, phase = parameters
+            value = offset + amplitude * math.sin(2 * math.pi * seconds / period + phase)
+        elif kind == COUNTER:
+            step, start = parameters
+            value = start + step * (tick - self.firstTick)
+        else:
+            step, low, high, start = parameters
+            if point.value is None:
+                value = start
+            else:
+                # The steps of the ticks since the last read add up to one step of sqrt(ticks) times the size.
+                value = point.value + self.random.gauss(0.0, step * math.sqrt(tick - point.tick))
+            value = min(high, max(low, value))
+        point.tick = tick
+        point.value = value
+
+    # Build the parameter arrays of each signal and the register bytes of each data type.
+    def CompileVectors(self):
+        numpy = OptionalModule("numpy")
+        self.array = numpy.frombuffer(self.data, dtype=numpy.uint8)
+        self.signals = {}
+        for kind in (RAMP, SINE, RANDOM_WALK, COUNTER):
+            indexes = [i for i, point in enumerate(self.points) if point.signal.kind == kind]
+            if len(indexes) == 0:
+                continue
+            parameters = numpy.array([self.points[i].signal.parameters for i in indexes], dtype=numpy.float64)
+            self.signals[kind] = (numpy.array(indexes, dtype=numpy.intp), parameters.T)
+        self.walk = None    # Values of the random walks.
+
+        self.dataTypes = {}
+        for dataType in set(point.dataType for point in self.points):
+            indexes = [i for i, point in enumerate(self.points) if point.dataType == dataType]
+            registers = numpy.array([self.points[i].register for i in indexes], dtype=numpy.intp)
+            size = 2 * DataTypeRegisterCount(dataType)
+            offsets = 2 * registers[:, None] + numpy.arange(size, dtype=numpy.intp)
+            self.dataTypes[dataType] = (numpy.array(indexes, dtype=numpy.intp), offsets)
+
+    # Evaluate every point of the bank in a tick.
+    def Refresh(self, tick):
+        numpy = OptionalModule("numpy")
+        with self.writeLock:
+            if tick == self.tick:
+                return
+            values = numpy.empty(len(self.points), dtype=numpy.float64)
+            seconds = (tick - self.firstTick) * self.resolution
+            for kind, (indexes, parameters) in self.signals.items():
+                if kind == RAMP:
+                    low, high, period = parameters
+                    values[indexes] = low + (high - low) * ((seconds % period) / period)
+                elif kind == SINE:
+                    amplitude, period, offset, phase = parameters
+                    values[indexes] = offset + amplitude * numpy.sin(2 * numpy.pi * seconds / period + phase)
+                elif kind == COUNTER:
+                    step, start = parameters
+                    values[indexes] = start + step * (tick - self.firstTick)
+                else:
+                    step, low, high, start = parameters
+                    if self.walk is None:
+                        walk = start.copy()
+                    else:
+                        walk = self.walk + numpy.random.standard_normal(len(indexes)) * step * math.sqrt(tick - self.tick)
+                    self.walk = numpy.clip(walk, low, high)
+                    values[indexes] = self.walk
+
+            self.sequence += 1
+            for dataType, (indexes, offsets) in self.dataTypes.items():
+                self.array[offsets] = EncodeValues(dataType, values[indexes])
+            self.sequence += 1
+            self.tick = tick
+
+    # Get a new bank with the same points and a copy of the registers.
+    def Copy(self):
+        bank = SimulatedRegisterBank(self.definitions, self.size, self.resolution, self.vectorized)
+        bank.Write(0, RegisterBank.Read(self, 0, self.size))
+        bank.firstTick = self.firstTick
+        return bank
+
+    # The values are generated by each process, so the bank is not moved to shared memory.
+    def Shared(self):
+        return self